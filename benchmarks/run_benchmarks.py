@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the downloader. Generates a synthetic bucket on local disk (see mirrulations_synthetic.py)
+and times each stage against it: building the copy plan and filter rules, listing the bucket into the manifest,
+resolving selections, and transferring with every mode the downloader supports.
+
+The transfer benchmarks need rclone on the PATH, everything else runs without it.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import click
+
+# Add parent directory to path so we can import the main script
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT)
+
+from mirrulations_synthetic import generate_bucket
+
+#(name, downloader arguments) of every transfer mode we time. Each one starts from an empty destination
+#unless it is listed in RERUN_MODES, which time a second run on top of the first. {files_from} is replaced with a
+#list of bucket paths written by write_files_from(), and {state_dir} with the mode's own state directory.
+TRANSFER_MODES = [
+    ('getall', ['--getall']),
+    ('textonly', ['--textonly']),
+    ('parallel-agency', ['--getall', '--parallel', '4', '--shard-by', 'agency']),
+    ('parallel-docket', ['--getall', '--parallel', '4', '--shard-by', 'docket']),
+    ('auto-tune', ['--getall', '--shard-by', 'agency', '--auto-tune']),
+    ('use-manifest', ['--getall', '--use-manifest']),
+    ('delta', ['--getall', '--delta']),
+    ('pack', ['--getall', '--pack']),
+    ('dedup', ['--getall', '--dedup']),
+    ('text-first', ['--getall', '--parallel', '4', '--text-first']),
+    ('staging', ['--getall', '--staging']),
+    ('shard', ['--getall', '--shard', '1/2']),
+    ('total-bwlimit', ['--getall', '--parallel', '4', '--total-bwlimit', '1G']),
+    ('retry-failed', ['--getall', '--retry-failed']),
+    ('files-from', ['--files-from', '{files_from}']),
+    ('sample', ['--getall', '--sample', '10%', '--max-file-size', '100K']),
+    ('min-comments', ['--getall', '--min-comments', '100']),
+    ('posted-after', ['--getall', '--posted-after', '2023-01-01']),
+    ('index', ['--getall', '--index']),
+    ('events-file', ['--getall', '--events-file', '{state_dir}/events.jsonl']),
+    ('metrics-dir', ['--getall', '--parallel', '4', '--metrics-dir', '{state_dir}/metrics', '--metrics-interval', '1']),
+    ('bwlimit-schedule', ['--getall', '--parallel', '4', '--bwlimit-schedule', '00:00,1G']),
+]
+RERUN_MODES = ['getall', 'delta', 'staging']
+
+#Every how many objects of the bucket go into the --files-from list
+FILES_FROM_STEP = 10
+
+
+def timed(function, repeat=1):
+    """Run function repeat times and return (best seconds, last result)"""
+    best = None
+    result = None
+    for this_run in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_planning(bucket_dir, repeat):
+    """Time turning a selection into copy jobs and compiled filter rules, for a wide and a narrow selection"""
+    from mirrulations_planning import plan_copy_jobs, compile_filter_rules
+
+    agencies = sorted(os.listdir(os.path.join(bucket_dir, 'raw-data')))
+    years = list(range(1990, 2026))
+
+    def plan_wide():
+        jobs = plan_copy_jobs(agencies, years, [], ['*.txt', '*.json', '*.htm'])
+        return [compile_filter_rules(this_job, True) for this_job in jobs]
+
+    def plan_everything():
+        jobs = plan_copy_jobs(['*'], ['*'], [], ['*'])
+        return [compile_filter_rules(this_job, False) for this_job in jobs]
+
+    results = []
+    seconds, rules = timed(plan_wide, repeat)
+    results.append({'name': 'plan: every agency x 36 years, textonly', 'seconds': seconds, 'rules': sum(len(these_rules) for these_rules in rules)})
+    seconds, rules = timed(plan_everything, repeat)
+    results.append({'name': 'plan: --getall', 'seconds': seconds, 'rules': sum(len(these_rules) for these_rules in rules)})
+    return results
+
+
+def benchmark_listing(bucket_dir, repeat):
+    """Time listing the bucket into a fresh manifest, and refreshing a manifest that is already up to date"""
+    import mirrulations_manifest
+
+    manifest_path = mirrulations_manifest.get_manifest_path()
+    results = []
+
+    def build():
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        connection = mirrulations_manifest.open_manifest()
+        totals = {'added': 0}
+        for this_data_directory in ['derived-data', 'raw-data']:
+            counts = mirrulations_manifest.refresh_manifest(connection, mirrulations_manifest.iter_remote_listing(bucket_dir + '/', None, f"{this_data_directory}/"), f"{this_data_directory}/")
+            totals['added'] += counts['added']
+        connection.close()
+        return totals
+
+    def refresh():
+        connection = mirrulations_manifest.open_manifest()
+        counts = mirrulations_manifest.refresh_manifest(connection, mirrulations_manifest.iter_remote_listing(bucket_dir + '/', None, 'raw-data/'), 'raw-data/')
+        connection.close()
+        return counts
+
+    seconds, totals = timed(build, repeat)
+    results.append({'name': 'list: build the manifest', 'seconds': seconds, 'objects': totals['added']})
+    seconds, counts = timed(refresh, repeat)
+    results.append({'name': 'list: refresh raw-data, nothing changed', 'seconds': seconds, 'objects': counts['unchanged']})
+    return results
+
+
+def benchmark_filtering(bucket_dir, repeat):
+    """Time resolving selections against the manifest, and (with rclone) applying the compiled filter rules"""
+    import mirrulations_manifest
+    from mirrulations_planning import plan_copy_jobs, compile_filter_rules, write_filter_file
+
+    agencies = sorted(os.listdir(os.path.join(bucket_dir, 'raw-data')))
+    connection = mirrulations_manifest.open_manifest()
+    results = []
+
+    for textonly in [False, True]:
+        file_types = ['*.txt', '*.json', '*.htm'] if textonly else ['*']
+        jobs = plan_copy_jobs(agencies, ['*'], [], file_types)
+        seconds, paths = timed(lambda: [mirrulations_manifest.select_job_paths(connection, this_job, textonly) for this_job in jobs], repeat)
+        results.append({'name': f"filter: manifest selection{', textonly' if textonly else ''}", 'seconds': seconds, 'objects': sum(len(these_paths) for these_paths in paths)})
+
+    if shutil.which('rclone'):
+        jobs = plan_copy_jobs(agencies[:1], ['*'], [], ['*.txt', '*.json', '*.htm'])
+        filter_file = write_filter_file(compile_filter_rules(jobs[0], True))
+        command = ['rclone', 'lsf', '-R', '--files-only', '--filter-from', filter_file, os.path.join(bucket_dir, jobs[0]['prefix'])]
+        seconds, result = timed(lambda: subprocess.run(command, capture_output=True, text=True), repeat)
+        results.append({'name': 'filter: rclone lsf with compiled rules, textonly', 'seconds': seconds, 'objects': len(result.stdout.splitlines())})
+
+    connection.close()
+    return results
+
+
+def run_downloader(arguments, dest_dir, state_dir, log_file):
+    with open(log_file, 'a') as file_handle:
+        result = subprocess.run([sys.executable, os.path.join(PROJECT_ROOT, 'mirrulations_bulk_downloader.py'), '--noconfirm'] + arguments,
+                                env=dict(os.environ, MIRRULATIONS_DESTINATION_PATH=dest_dir, MIRRULATIONS_STATE_PATH=state_dir),
+                                stdout=file_handle, stderr=subprocess.STDOUT, cwd=os.path.dirname(log_file))
+    return result.returncode
+
+
+def write_files_from(work_dir):
+    """Write every FILES_FROM_STEP-th object of the manifest to a --files-from list, scattered over the bucket like a
+    repair list from mirrulations_verify.py, and return its path"""
+    import mirrulations_manifest
+
+    connection = mirrulations_manifest.open_manifest()
+    paths = [row[0] for row in connection.execute("SELECT path FROM objects ORDER BY path")][::FILES_FROM_STEP]
+    connection.close()
+    files_from = os.path.join(work_dir, 'files-from.txt')
+    with open(files_from, 'w') as file_handle:
+        file_handle.write("".join(f"{this_path}\n" for this_path in paths))
+    return files_from
+
+
+def benchmark_transfers(work_dir, modes):
+    """Time a download into an empty destination for each mode, and a second run on top of it for the rerun modes"""
+    import mirrulations_manifest
+
+    results = []
+    log_file = os.path.join(work_dir, 'downloader.log')
+    files_from = write_files_from(work_dir)
+
+    for name, arguments in TRANSFER_MODES:
+        if modes and name not in modes:
+            continue
+        #Each mode gets its own copy of the manifest, so what one mode records (like --delta's sync state) cannot affect the next
+        dest_dir = os.path.join(work_dir, f"dest-{name}")
+        state_dir = os.path.join(work_dir, f"state-{name}")
+        arguments = [this_argument.format(files_from=files_from, state_dir=state_dir) for this_argument in arguments]
+        os.makedirs(dest_dir)
+        os.makedirs(state_dir)
+        shutil.copy(mirrulations_manifest.get_manifest_path(), state_dir)
+
+        seconds, exit_code = timed(lambda: run_downloader(arguments, dest_dir, state_dir, log_file))
+        file_count = sum(len(these_files) for this_root, these_dirs, these_files in os.walk(dest_dir))
+        results.append({'name': f"transfer: {name}", 'seconds': seconds, 'exit_code': exit_code, 'files': file_count})
+
+        if name in RERUN_MODES:
+            seconds, exit_code = timed(lambda: run_downloader(arguments, dest_dir, state_dir, log_file))
+            results.append({'name': f"transfer: {name}, rerun with nothing new", 'seconds': seconds, 'exit_code': exit_code})
+
+        shutil.rmtree(dest_dir)
+        shutil.rmtree(state_dir)
+
+    return results
+
+
+@click.command()
+@click.option('--agencies', default=3, type=int, help="How many agencies in the synthetic bucket (default is 3)")
+@click.option('--dockets', default=10, type=int, help="How many dockets per agency (default is 10)")
+@click.option('--comments', default=200, type=int, help="How many comments per docket (default is 200)")
+@click.option('--attachment-rate', default=0.3, type=float, help="The fraction of comments with attachments (default is 0.3)")
+@click.option('--attachment-size', default=50000, type=int, help="The mean size of an attachment in bytes (default is 50000)")
+@click.option('--seed', default=0, type=int, help="The random seed for the synthetic bucket (default is 0)")
+@click.option('--bucket', default='', help="Use this existing synthetic bucket instead of generating one")
+@click.option('--mode', 'modes', multiple=True, help="Only time these transfer modes (can be given more than once, default is all of them)")
+@click.option('--repeat', default=3, type=int, help="How many times to repeat the in-process benchmarks, the best time counts (default is 3)")
+@click.option('--output', default='', help="Also write the results to this JSON file, to compare runs")
+@click.option('--keep', is_flag=True, help="Keep the working directory afterwards")
+def main(agencies, dockets, comments, attachment_rate, attachment_size, seed, bucket, modes, repeat, output, keep):
+    """Time the downloader's stages against a synthetic bucket on local disk"""
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_benchmark_")
+    bucket_dir = os.path.abspath(bucket) if bucket else os.path.join(work_dir, 'bucket')
+
+    #Everything the downloader keeps between runs goes into the working directory too
+    os.environ['MIRRULATIONS_REMOTE'] = bucket_dir + '/'
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+    os.environ.setdefault('RCLONE_CONFIG_FILE', os.path.join(PROJECT_ROOT, 'rclone.conf.example'))
+
+    results = []
+    try:
+        if not bucket:
+            seconds, totals = timed(lambda: generate_bucket(bucket_dir, agencies, dockets, comments, (2020, 2025), attachment_rate, 2000, attachment_size, seed))
+            print(f"Generated {totals['files']} files ({totals['bytes'] / 1024 ** 2:.1f} MiB) in {seconds:.2f}s")
+
+        results += benchmark_planning(bucket_dir, repeat)
+        results += benchmark_listing(bucket_dir, repeat)
+        results += benchmark_filtering(bucket_dir, repeat)
+        if shutil.which('rclone'):
+            results += benchmark_transfers(work_dir, modes)
+        else:
+            print("rclone is not on the PATH, skipping the transfer benchmarks")
+
+        print("\n" + "=" * 80)
+        print(f"{'Benchmark':<55} {'Seconds':>10}  Details")
+        print("=" * 80)
+        for this_result in results:
+            details = ", ".join(f"{key}={value}" for key, value in this_result.items() if key not in ['name', 'seconds'])
+            print(f"{this_result['name']:<55} {this_result['seconds']:>10.3f}  {details}")
+
+        if output:
+            with open(output, 'w') as file_handle:
+                json.dump({'time': time.time(), 'parameters': {'agencies': agencies, 'dockets': dockets, 'comments': comments,
+                                                                'attachment_rate': attachment_rate, 'attachment_size': attachment_size,
+                                                                'seed': seed, 'bucket': bucket}, 'results': results}, file_handle, indent=2)
+            print(f"\nResults written to {output}")
+    finally:
+        if keep:
+            print(f"Working directory kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
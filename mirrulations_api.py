@@ -0,0 +1,791 @@
+import os
+import time
+import asyncio
+import datetime
+import hashlib
+import tempfile
+import concurrent.futures
+
+from mirrulations_config import get_state_dir
+import mirrulations_manifest
+import mirrulations_journal
+import mirrulations_tuning
+import mirrulations_metrics
+import mirrulations_archive
+import mirrulations_dedup
+import mirrulations_index
+import mirrulations_events
+import mirrulations_partition
+import mirrulations_pacing
+import mirrulations_catalog
+import mirrulations_sampling
+import mirrulations_retry
+import mirrulations_planning
+
+#The downloader as a library. download() plans a run and starts it in the background, returning a DownloadHandle
+#to follow it with. Several downloads can run at once from one event loop:
+#
+#    handle = await mirrulations_api.download({'agencies': ['CMS'], 'years': [2025]}, {'parallel': 4})
+#    print(handle.progress())
+#    result = await handle.wait()
+#
+#The rclone processes are asyncio subprocesses, and the slow bookkeeping between them (the manifest, packing, promoting
+#staged dockets) runs on a thread of its own for each download, so none of it blocks the event loop.
+#Problems are raised as DownloadError subclasses instead of printing and exiting.
+
+#What can be selected, and what is selected when it is left out. 'attributes' picks dockets by their metadata (see
+#mirrulations_catalog.py), e.g. {'document_types': ['Proposed Rule'], 'min_comments': 100, 'derived': ['ai_summary']}.
+#'sampling' takes part of each docket (see mirrulations_sampling.py), e.g. {'sample': '5%', 'seed': 1, 'max_file_size': '20M'}
+DEFAULT_SELECTION = {
+    'agencies': [],
+    'years': [],
+    'dockets': [],
+    'textonly': False,
+    'getall': False,
+    'files_from': '',
+    'attributes': {},
+    'sampling': {},
+}
+
+#How the selection is downloaded. These match the downloader's command line options, plus:
+#    dest_dir, rclone_config_file   default to MIRRULATIONS_DESTINATION_PATH and RCLONE_CONFIG_FILE
+#    log_dir      where the rclone logs go, a new directory under the state directory when left as None
+#    progress     show rclone's progress bar on the terminal when running one rclone process at a time
+#    confirm      called with the rclone commands before they run, returning False cancels the download
+#    on_event     called with each completion event (see mirrulations_events.py)
+DEFAULT_OPTIONS = {
+    'transfers': 50,
+    'parallel': 1,
+    'shard_by': 'none',
+    'use_manifest': False,
+    'delta': False,
+    'resume': False,
+    'auto_tune': False,
+    'metrics_dir': '',
+    'metrics_interval': 15,
+    'pack': False,
+    'dedup': False,
+    'dedup_link_mode': 'reflink',
+    'index': False,
+    'retry_failed': False,
+    'text_first': False,
+    'text_bwlimit': '',
+    'binary_bwlimit': '',
+    'bwlimit_schedule': '',
+    'total_bwlimit': '',
+    'events_file': '',
+    'events_socket': '',
+    'staging': False,
+    'shard': '',
+    'on_event': None,
+    'dest_dir': None,
+    'rclone_config_file': None,
+    'log_dir': None,
+    'progress': False,
+    'confirm': None,
+}
+
+
+class DownloadError(Exception):
+    """Base class of everything the API raises"""
+
+
+class SelectionError(DownloadError):
+    """The selection or the options do not make sense (nothing selected, options that do not go together...)"""
+
+
+class ConfigurationError(DownloadError):
+    """The destination directory or the rclone config file is missing, or a setting like metrics_interval is out of range"""
+
+
+class ListingError(DownloadError):
+    """Listing the bucket failed"""
+
+
+class ManifestError(DownloadError):
+    """The selection needs the manifest, but it is empty"""
+
+
+class DownloadCancelled(DownloadError):
+    """The download was declined before it started, or cancelled while it ran"""
+
+
+class ShardsFailedError(DownloadError):
+    """Some shards did not finish. The full result, with the status of every shard, is in .result"""
+
+    def __init__(self, result):
+        super().__init__(f"{result['failed_shards']} of {len(result['shards'])} shards failed")
+        self.result = result
+
+
+def merge_defaults(given, defaults, kind):
+    unknown = sorted(set(given or {}) - set(defaults))
+    if unknown:
+        raise SelectionError(f"Unknown {kind}: {', '.join(unknown)}")
+    return {**defaults, **(given or {})}
+
+
+def open_checked_manifest():
+    """Open the manifest, which has to have been built with mirrulations_manifest.py first"""
+    manifest_connection = mirrulations_manifest.open_manifest()
+    if mirrulations_manifest.manifest_object_count(manifest_connection) == 0:
+        manifest_connection.close()
+        raise ManifestError(f"Error: the manifest {mirrulations_manifest.get_manifest_path()} is empty. Run mirrulations_manifest.py first")
+    return manifest_connection
+
+
+def journal_run_key(run):
+    """What decides the files a run's jobs copy besides their names: the whole selection (with the content of a
+    --files-from list, whose path a later repair list may reuse) and this machine's --shard"""
+    selection = dict(run['selection'])
+    if selection['files_from']:
+        with open(selection['files_from'], 'rb') as file_handle:
+            selection['files_from'] = hashlib.sha1(file_handle.read()).hexdigest()
+    return {'selection': selection, 'shard': run['options']['shard']}
+
+
+def prepare_download(selection, options=None):
+    """Check a selection and its options and plan the copy jobs, without running anything.
+
+    Returns a dict with the merged 'selection' and 'options', the 'dest_dir' and 'rclone_config_file' to use,
+    the planned 'jobs', the 'shard' as (i, N) and, when the options use it, the 'manifest_connection'.
+    Raises SelectionError, ConfigurationError, ListingError or ManifestError.
+    """
+    selection = merge_defaults(selection, DEFAULT_SELECTION, 'selection keys')
+    options = merge_defaults(options, DEFAULT_OPTIONS, 'options')
+
+    agency_list = list(selection['agencies'])
+    year_list = list(selection['years'])
+    docket_list = list(selection['dockets'])
+    textonly = selection['textonly']
+    getall = selection['getall']
+    files_from = selection['files_from']
+    shard_by = options['shard_by']
+
+    if not str(options['transfers']).isnumeric():
+        raise SelectionError("Non numeric value for transfers argument. confusion. exiting")
+
+    if options['parallel'] < 1:
+        raise SelectionError("--parallel must be at least 1. confusion. exiting")
+
+    if options['metrics_interval'] < 1:
+        raise ConfigurationError(f"--metrics-interval must be at least 1 second, not {options['metrics_interval']}. confusion. exiting")
+
+    if (options['text_bwlimit'] or options['binary_bwlimit']) and not options['text_first']:
+        raise SelectionError("--text-bwlimit and --binary-bwlimit only apply to --text-first. confusion. exiting")
+
+    if options['text_first'] and textonly:
+        raise SelectionError("--text-first and --textonly do not go together, --textonly never downloads the binaries. confusion. exiting")
+
+    if options['dedup'] and options['pack']:
+        raise SelectionError("--dedup and --pack do not go together, --pack leaves no loose files to dedup. confusion. exiting")
+
+    if options['dedup_link_mode'] not in mirrulations_dedup.LINK_MODES:
+        raise SelectionError(f"--dedup-link-mode must be one of {', '.join(mirrulations_dedup.LINK_MODES)}. confusion. exiting")
+
+    try:
+        mirrulations_pacing.parse_schedule(options['bwlimit_schedule'])
+        for this_rate in [options['total_bwlimit'], options['text_bwlimit'], options['binary_bwlimit']]:
+            mirrulations_pacing.parse_rate(this_rate)
+    except ValueError as error:
+        raise SelectionError(str(error))
+
+    try:
+        attributes = mirrulations_catalog.check_attributes(selection['attributes'])
+        sampling = mirrulations_sampling.check_sampling(selection['sampling'])
+    except ValueError as error:
+        raise SelectionError(str(error))
+
+    shard = None
+    if options['shard']:
+        try:
+            shard = mirrulations_partition.parse_shard_spec(options['shard'])
+        except ValueError as error:
+            raise SelectionError(str(error))
+
+    #rclone cannot change --transfers while it runs, so auto-tuning needs shards to retune between
+    if (options['parallel'] > 1 or options['auto_tune']) and shard_by == 'none':
+        shard_by = 'agency-year'
+
+    #tracks whether there is a limitation argument
+    is_limited = False
+    is_enough = getall
+
+    if len(agency_list) > 0:
+        is_enough = True
+        is_limited = True
+    else:
+        agency_list = [ '*' ]
+
+    if len(year_list) > 0:
+        is_enough = True
+        is_limited = True
+    else:
+        year_list = [ '*' ]
+
+    if len(docket_list) > 0:
+        is_enough = True
+        is_limited = True
+
+    #All 'text only' means is that we are not doing the word documents, pdfs, etc etc.. we just want to the raw text files
+    if not textonly:
+        included_file_types = ['*']
+    else:
+        included_file_types = ['*.txt','*.json','*.htm']
+        is_limited = True
+        is_enough = True
+
+    #An exact list of files is a selection of its own
+    if files_from:
+        if is_limited or getall or attributes or options['use_manifest'] or options['delta']:
+            raise SelectionError("--files-from is a complete selection, it cannot be combined with -a, -y, -d, --textonly, --getall, the attributes, --use-manifest or --delta")
+        is_enough = True
+
+    #we are not just going to download everything without some indication that we should...
+    if not is_enough:
+        raise SelectionError("If you want to download everything.. pass in the --getall paramater and go to lunch!! \nOtherwise add the --help for a full list of options")
+
+    dest_dir = options['dest_dir'] or os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    rclone_config_file = options['rclone_config_file'] or os.getenv('RCLONE_CONFIG_FILE')
+    errors = []
+    if not dest_dir or not os.path.exists(dest_dir):
+        errors.append(f"Error: {dest_dir} does not exist ")
+    if not rclone_config_file or not os.path.isfile(rclone_config_file):
+        errors.append(f"Error: {rclone_config_file} is not found")
+    if errors:
+        raise ConfigurationError("\n".join(errors + ["Crashing due to errors"]))
+
+    if getall and is_limited:
+        raise SelectionError("You have entered --getall and a filter at the same time. I dont know what to do... so I am not going to do anything. Try --help")
+
+    #When sharding a selection that covers every agency, find out which agencies there are, so that each one
+    #becomes its own shard. That keeps the units of work small enough that --resume is worth something on a --getall run
+    if agency_list == [ '*' ] and len(docket_list) == 0 and shard_by != 'none' and not files_from:
+        try:
+            agency_list = mirrulations_planning.list_bucket_agencies(rclone_config_file)
+        except RuntimeError as error:
+            raise ListingError(f"Error: could not list the agencies in the bucket: {error}")
+
+    #Each shard is broken down into the bucket prefixes it covers, and each prefix is copied by its own rclone command
+    #so listing and transfer can overlap between shards
+    shards = mirrulations_planning.build_shards(agency_list, year_list, docket_list, shard_by)
+
+    jobs = []
+    if files_from:
+        if not os.path.isfile(files_from):
+            raise SelectionError(f"Error: {files_from} is not found")
+        with open(files_from) as file_handle:
+            bucket_paths = [this_line.strip() for this_line in file_handle if this_line.strip() and not this_line.startswith('#')]
+        jobs = mirrulations_planning.plan_files_from_jobs(bucket_paths)
+        for this_job in jobs:
+            this_job['name'] = this_job['prefix']
+        shards = []
+
+    for this_shard in shards:
+        for this_job in mirrulations_planning.plan_copy_jobs(this_shard['agency_list'], this_shard['year_list'], this_shard['docket_list'], included_file_types):
+            if len(shards) == 1:
+                this_job['name'] = this_job['prefix']
+            else:
+                this_job['name'] = f"{this_shard['name']}:{this_job['prefix']}"
+            jobs.append(this_job)
+
+    if options['index']:
+        try:
+            mirrulations_index.open_index().close()
+        except RuntimeError as error:
+            raise ConfigurationError(f"Error: {error}")
+
+    #With a manifest we already know exactly which objects the selection covers, so rclone does not need to list anything
+    manifest_connection = None
+    if options['use_manifest'] or options['delta']:
+        manifest_connection = open_checked_manifest()
+
+    #Only this machine's slice of the dockets, when the selection is split between several
+    if shard:
+        try:
+            jobs = mirrulations_partition.partition_jobs(jobs, shard, rclone_config_file, manifest_connection, textonly)
+        except RuntimeError as error:
+            raise ListingError(f"Error: could not list the dockets in the bucket: {error}")
+
+    #Only the dockets whose metadata matches the attributes, which is fetched and looked up in the catalog first
+    if attributes:
+        try:
+            jobs = mirrulations_catalog.select_jobs_by_attributes(jobs, attributes, rclone_config_file, options['transfers'])
+        except RuntimeError as error:
+            raise ListingError(f"Error: could not build the catalog: {error}")
+        if not jobs:
+            raise SelectionError("No dockets in the selection match the attributes. Nothing to download")
+
+    #Text first means every text job runs ahead of every binary job, so downstream processing can start on the whole selection early
+    if options['text_first']:
+        jobs = mirrulations_planning.split_text_first(jobs)
+
+    return {'selection': selection, 'options': options, 'dest_dir': dest_dir, 'rclone_config_file': rclone_config_file, 'jobs': jobs,
+            'manifest_connection': manifest_connection, 'shard': shard, 'sampling': sampling}
+
+
+def run_commands_in_parallel(command_array, parallel=1, on_start=None, on_finish=None, build_command=None):
+    """Run each command as its own subprocess, at most `parallel` at a time.
+
+    on_start(index) and on_finish(index, exit_code, elapsed_seconds) are called, if given, as each command starts and ends.
+    If build_command(index) is given, it is called just before a command starts and its result is run instead,
+    so that later commands can depend on how earlier ones went.
+    Returns a list of (exit_code, elapsed_seconds) in the same order as command_array.
+    """
+    return asyncio.run(run_commands_async(command_array, parallel, on_start, on_finish, build_command))
+
+
+async def run_commands_async(command_array, parallel=1, on_start=None, on_finish=None, build_command=None, executor=None, after_command=None):
+    """run_commands_in_parallel for use inside an event loop, which it never blocks.
+
+    on_finish runs in executor (the loop's default one when not given), since what happens after a shard can take a while.
+    after_command, if given, is awaited with the index and exit code as soon as a command exits, and returns the exit
+    code to record instead, which lets the caller try again the parts of a command that failed.
+    If the task is cancelled, the running commands are terminated and no more are started.
+    """
+    loop = asyncio.get_running_loop()
+    results = [None] * len(command_array)
+    pending = list(enumerate(command_array))
+
+    async def run_pending():
+        while pending:
+            index, this_command = pending.pop(0)
+            if build_command:
+                this_command = build_command(index)
+            print(f"Running:\t{this_command}")
+            if on_start:
+                on_start(index)
+
+            started_at = time.time()
+            process = await asyncio.create_subprocess_shell(this_command)
+            try:
+                exit_code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+
+            if after_command:
+                exit_code = await after_command(index, exit_code)
+            results[index] = (exit_code, round(time.time() - started_at))
+            if on_finish:
+                await loop.run_in_executor(executor, on_finish, index, *results[index])
+
+    #Each runner takes the next command as soon as its last one is done, so commands start in order
+    await asyncio.gather(*[run_pending() for this_runner in range(max(1, min(parallel, len(command_array))))])
+    return results
+
+
+def print_shard_summary(shard_names, results):
+    """Print one line per shard with its exit code and runtime, and return how many shards failed"""
+    failed = 0
+    print("\nShard summary:")
+    for shard_name, (exit_code, elapsed_time) in zip(shard_names, results):
+        if exit_code == mirrulations_planning.RCLONE_DIRECTORY_NOT_FOUND:
+            print(f"\t{shard_name}: not in the bucket, nothing to copy")
+            continue
+        status = "ok" if exit_code == 0 else f"FAILED (exit code {exit_code})"
+        print(f"\t{shard_name}: {status} in {datetime.timedelta(seconds = elapsed_time)}")
+        if exit_code != 0:
+            failed += 1
+    print(f"{len(results) - failed} of {len(results)} shards finished without errors")
+    return failed
+
+
+class DownloadHandle:
+    """A download running in the background. progress() and shards() can be read at any time, wait() gives the result."""
+
+    def __init__(self, run, executor):
+        self.run = run
+        self.selection = run['selection']
+        self.options = run['options']
+        self.jobs = run['jobs']
+        self.executor = executor
+        self.results = None
+        self.result = None
+        self.started_at = time.time()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def done(self):
+        return self.task is not None and self.task.done()
+
+    def cancel(self):
+        """Stop the running rclone processes and start no more. Finished shards stay finished for a later resume."""
+        if self.task:
+            self.task.cancel()
+
+    async def wait(self):
+        """Wait for the download to end and return its result.
+
+        Raises ShardsFailedError when some shards failed, and DownloadCancelled when it was declined or cancelled.
+        """
+        try:
+            await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if not self.task.cancelled():
+                raise
+            raise DownloadCancelled("The download was cancelled")
+        if self.result['failed_shards']:
+            raise ShardsFailedError(self.result)
+        return self.result
+
+    def shards(self):
+        """The status of each shard: pending, running, finished (nothing left to copy counts too) or failed"""
+        statuses = []
+        for this_job in self.jobs:
+            status = {'name': this_job['name'], 'prefix': this_job['prefix'], 'status': 'pending'}
+            if 'exit_code' in this_job:
+                status['exit_code'] = this_job['exit_code']
+                status['elapsed'] = this_job['elapsed']
+                status['status'] = 'finished' if this_job['exit_code'] in mirrulations_journal.FINISHED_EXIT_CODES else 'failed'
+            elif 'started_at' in this_job:
+                status['status'] = 'running'
+            stats = mirrulations_metrics.job_stats(this_job) if 'log_file' in this_job else None
+            if stats:
+                status['stats'] = stats
+            statuses.append(status)
+        return statuses
+
+    def progress(self):
+        """Totals of the rclone stats of every shard so far (bytes, files, checks, errors, current rates) and shard counts"""
+        totals = {'bytes': 0, 'files': 0, 'checks': 0, 'errors': 0, 'bytes_per_second': 0, 'files_per_second': 0,
+                  'running': 0, 'finished': 0, 'shards': len(self.jobs)}
+        for group in mirrulations_metrics.collect_metrics([this_job for this_job in self.jobs if 'log_file' in this_job]).values():
+            for this_key in totals:
+                if this_key != 'shards':
+                    totals[this_key] += group[this_key]
+        return totals
+
+    async def _in_thread(self, function, *arguments):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *arguments)
+
+    async def _run(self):
+        try:
+            await self._download()
+            #Jobs that did not run because resolving or resuming found nothing left for them count as finished
+            if self.run['shard']:
+                exit_codes = {this_job['name']: this_job['exit_code'] for this_job in self.jobs if 'exit_code' in this_job}
+                self.result['shard_report'] = mirrulations_partition.write_shard_report(self.selection, self.run['shard'], self.run['jobs'], exit_codes)
+                print(f"Wrote the report for shard {self.run['shard'][0]}/{self.run['shard'][1]} to {self.result['shard_report']}")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def _download(self):
+        options = self.options
+        textonly = self.selection['textonly']
+        dest_dir = self.run['dest_dir']
+        rclone_config_file = self.run['rclone_config_file']
+        use_manifest = options['use_manifest'] or options['delta']
+        self.result = {'shards': [], 'failed_shards': 0, 'elapsed': 0}
+
+        manifest_connection = self.run['manifest_connection']
+        if use_manifest:
+            self.jobs = await self._in_thread(mirrulations_planning.resolve_jobs_with_manifest, manifest_connection, self.jobs, textonly, options['delta'])
+
+        #Only a sample of each docket's comments, and no binaries over the size caps
+        sampling_summary = None
+        if mirrulations_sampling.is_sampling(self.run['sampling']):
+            try:
+                self.jobs, sampling_summary = await self._in_thread(mirrulations_sampling.sample_jobs, self.jobs, self.run['sampling'], textonly,
+                                                                    manifest_connection if use_manifest else None, rclone_config_file)
+            except RuntimeError as error:
+                raise ListingError(f"Error: could not list the selection to sample it: {error}")
+            skipped_file = mirrulations_sampling.write_skipped(sampling_summary['skipped']) if sampling_summary['skipped'] else None
+            mirrulations_sampling.print_sampling_summary(sampling_summary, skipped_file)
+            sampling_summary = dict(sampling_summary, skipped_file=skipped_file)
+
+        if not self.jobs:
+            print("Nothing to copy. Goodbye.")
+            return
+
+        #Every run keeps a journal of its jobs, so that an interrupted run can be picked up again with resume
+        journal_path, finished_units = mirrulations_journal.start_journal([this_job['name'] for this_job in self.jobs], options['resume'], journal_run_key(self.run))
+        if finished_units:
+            print(f"Resuming from {journal_path}: skipping {len(finished_units)} shards that already finished")
+            self.jobs = [this_job for this_job in self.jobs if this_job['name'] not in finished_units]
+            if not self.jobs:
+                print("Every shard already finished. Goodbye.")
+                return
+        jobs = self.jobs
+
+        log_dir = options['log_dir']
+        if log_dir is None:
+            #Downloads running side by side each need their own log files
+            log_dir = os.path.join(get_state_dir(), 'logs')
+            os.makedirs(log_dir, exist_ok=True)
+            log_dir = tempfile.mkdtemp(prefix='run-', dir=log_dir)
+
+        #The stats go into the log as JSON, so we can read back what each shard achieved
+        #Several rclone progress bars on one terminal are unreadable, so when we run in parallel each shard gets its own log file instead
+        publish_events = bool(options['events_file'] or options['events_socket'] or options['on_event'])
+        for this_job in jobs:
+            if options['parallel'] == 1:
+                this_job['log_file'] = os.path.join(log_dir, 'rclone.log')
+                this_job['log_flags'] = f" --log-file '{this_job['log_file']}' " + ("-P " if options['progress'] else "")
+            else:
+                log_name = this_job['name'].strip('/').replace('/', '_').replace(':', '_')
+                this_job['log_file'] = os.path.join(log_dir, f"rclone-{log_name}.log")
+                this_job['log_flags'] = f" --log-file '{this_job['log_file']}' "
+            this_job['log_flags'] += mirrulations_tuning.RCLONE_STATS_FLAGS
+            if publish_events:
+                #rclone only logs the files it copies at INFO
+                this_job['log_flags'] += mirrulations_events.RCLONE_EVENT_FLAGS
+            if options['staging']:
+                this_job['staging_dir'] = mirrulations_events.get_staging_dir(dest_dir, this_job)
+            this_job['profile'] = mirrulations_tuning.job_profile(this_job, textonly)
+            this_job['transfers'] = int(options['transfers'])
+            this_job['bwlimit'] = {'text': options['text_bwlimit'], 'binary': options['binary_bwlimit']}.get(this_job.get('section'), '')
+            this_job['bwlimit_ceiling'] = mirrulations_pacing.parse_rate(this_job['bwlimit'])
+        shard_names = [this_job['name'] for this_job in jobs]
+
+        #With auto-tune this is only where we start, each shard after that gets its own value
+        tuner = mirrulations_tuning.ConcurrencyTuner(int(options['transfers']))
+
+        #A docket is text-complete once every text job that covers it has finished
+        text_groups = {}
+        for index, this_job in enumerate(jobs):
+            if this_job.get('section') == 'text':
+                text_groups.setdefault(mirrulations_planning.text_group_key(this_job), []).append(index)
+
+        def job_command(this_job):
+            #rclone's default is 8 checkers, but we have always run twice as many checkers as transfers
+            always_flags = f"  --checkers {this_job['transfers'] * 2} --transfers {this_job['transfers']} "
+            if pacer:
+                #The pacer sets the rate through rclone's remote control from here on
+                always_flags += this_job.get('pacing_flags', f" --bwlimit {this_job['bwlimit'] or 'off'} ")
+            elif this_job['bwlimit']:
+                always_flags += f" --bwlimit {this_job['bwlimit']} "
+            if options['retry_failed']:
+                always_flags += mirrulations_retry.RCLONE_RETRY_FLAGS
+            return mirrulations_planning.build_rclone_command(this_job, dest_dir, rclone_config_file, always_flags + this_job['log_flags'], textonly)
+
+        #A cap on the combined rate of every rclone process, or one that changes with the time of day, is kept by the pacer
+        pacer = None
+        if options['bwlimit_schedule'] or options['total_bwlimit']:
+            pacer = mirrulations_pacing.BandwidthPacer(jobs, mirrulations_pacing.parse_schedule(options['bwlimit_schedule']),
+                                                       mirrulations_pacing.parse_rate(options['total_bwlimit']))
+
+        command_array = [job_command(this_job) for this_job in jobs]
+        if options['confirm'] and not options['confirm'](command_array):
+            raise DownloadCancelled("Not running. Goodbye.")
+
+        def started_job_command(index):
+            if options['auto_tune']:
+                jobs[index]['transfers'] = tuner.next_transfers(jobs[index]['profile'])
+            if pacer:
+                jobs[index]['pacing_flags'] = pacer.start_job(jobs[index])
+            return job_command(jobs[index])
+
+        async def run_job_command(this_job):
+            process = await asyncio.create_subprocess_shell(job_command(this_job))
+            try:
+                return await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+
+        async def restart_on_taken_port(index, exit_code):
+            #The remote control port can be taken between picking it and rclone starting, and then rclone stops straight away
+            this_job = jobs[index]
+            for this_attempt in range(mirrulations_pacing.RC_PORT_ATTEMPTS):
+                if exit_code == 0 or not mirrulations_pacing.rc_start_failed(this_job['log_file'], this_job['log_offset']):
+                    break
+                print(f"The remote control port of {this_job['name']} was taken, starting it again on another one")
+                this_job['pacing_flags'] = pacer.start_job(this_job)
+                this_job['log_offset'] = os.path.getsize(this_job['log_file'])
+                exit_code = await run_job_command(this_job)
+            return exit_code
+
+        async def after_job_command(index, exit_code):
+            if pacer:
+                exit_code = await restart_on_taken_port(index, exit_code)
+            if options['retry_failed']:
+                exit_code = await retry_failed_files(index, exit_code)
+            return exit_code
+
+        async def retry_failed_files(index, exit_code):
+            #Only the files that failed are copied again, as a --files-from job of their own, as their error's policy allows
+            this_job = jobs[index]
+            if exit_code in mirrulations_journal.FINISHED_EXIT_CODES:
+                return exit_code
+            failures, other_errors = mirrulations_retry.read_failed_transfers(this_job['log_file'], this_job['log_offset'])
+            if not failures or other_errors:
+                return exit_code
+
+            #The throughput history and the tuner learn from the run itself, not from the small retries after it
+            this_job['main_stats'] = mirrulations_tuning.read_latest_rclone_stats(this_job['log_file'], this_job['log_offset'])
+            queue = mirrulations_retry.RetryQueue()
+            queue.record(failures)
+            while queue.next_due() is not None:
+                #Nothing is copied while we wait, so the pacer hands this job's share to the others
+                this_job['retry_waiting'] = True
+                await asyncio.sleep(max(0, queue.next_due() - time.time()))
+                del this_job['retry_waiting']
+                if pacer:
+                    this_job['pacing_flags'] = pacer.start_job(this_job)
+                retrying = queue.take_due()
+                print(f"Retrying {len(retrying)} files that {this_job['name']} failed to copy")
+                retry_job = dict(this_job, files=retrying)
+                log_offset = os.path.getsize(this_job['log_file']) if os.path.isfile(this_job['log_file']) else 0
+                retry_exit_code = await run_job_command(retry_job)
+                failures, other_errors = mirrulations_retry.read_failed_transfers(this_job['log_file'], log_offset)
+                queue.record(failures, retrying)
+                if other_errors or (retry_exit_code != 0 and not failures):
+                    queue.give_up(other_errors[0] if other_errors else f"rclone exited with {retry_exit_code}")
+
+            this_job['retry'] = queue.summary()
+            return exit_code if this_job['retry']['still_failing'] else 0
+
+        def job_started(index):
+            mirrulations_journal.append_journal_event(journal_path, 'started', unit=shard_names[index])
+
+            #Remember where this job's part of the log starts, in case it shares the log file with the jobs before it
+            this_job = jobs[index]
+            this_job['log_offset'] = os.path.getsize(this_job['log_file']) if os.path.isfile(this_job['log_file']) else 0
+            this_job['started_at'] = time.time()
+
+        def job_finished(index, exit_code, elapsed_time):
+            mirrulations_journal.append_journal_event(journal_path, 'finished', unit=shard_names[index], exit_code=exit_code, elapsed=elapsed_time)
+
+            this_job = jobs[index]
+            stats = this_job.get('main_stats') or mirrulations_tuning.read_latest_rclone_stats(this_job['log_file'], this_job['log_offset'])
+            this_job['final_stats'] = stats or {}
+            if stats:
+                mirrulations_tuning.record_throughput_history(this_job['name'], this_job['profile'], this_job['transfers'], stats)
+                if options['auto_tune']:
+                    tuner.record(this_job['profile'], this_job['transfers'], stats)
+
+            #Remember what the job copied straight away, so the next delta run skips it even if this run never gets to its end
+            if use_manifest and exit_code == 0:
+                mirrulations_manifest.record_synced_paths(manifest_connection, this_job['prefix'], this_job['files'])
+
+            #Whatever rclone logged since the tailer last looked. The tailer completed the dockets whose listed files all
+            #arrived while the job ran, the rest are complete now
+            if publisher:
+                log_tailer.drain(this_job)
+                if exit_code == 0:
+                    log_tailer.finish_job(this_job)
+            elif options['staging'] and exit_code == 0:
+                mirrulations_events.promote_staged_job(dest_dir, this_job)
+
+            if this_job.get('section') == 'text':
+                this_job['text_finished'] = exit_code in mirrulations_journal.FINISHED_EXIT_CODES
+                this_job['text_dockets'] = mirrulations_planning.list_job_dockets(dest_dir, this_job)
+                group = [jobs[this_index] for this_index in text_groups[mirrulations_planning.text_group_key(this_job)]]
+                if all(this_peer.get('text_finished') for this_peer in group):
+                    group_dockets = set().union(*[this_peer['text_dockets'] for this_peer in group])
+                    mirrulations_planning.mark_text_complete(dest_dir, group_dockets)
+                    print(f"Text complete for {len(group_dockets)} dockets under {mirrulations_planning.text_group_key(this_job)[0] or 'every agency'}")
+                    if publisher:
+                        for agency, docket_id in sorted(group_dockets):
+                            publisher.publish('docket_text_complete', agency=agency, docket=docket_id)
+
+            #Before packing, which takes the loose files away. Only this thread ever uses the index connection
+            if options['index'] and exit_code == 0:
+                if not index_connection:
+                    index_connection.append(mirrulations_index.open_index())
+                agency_list, docket_list = mirrulations_index.prefix_selection(this_job['prefix'])
+                counts = mirrulations_index.index_tree(index_connection[0], dest_dir, agency_list, docket_list)
+                print(f"Indexed {counts['indexed']} files under {this_job['prefix']}")
+
+            #The loose files are only a staging area with pack, so move this job's dockets into their archives as soon as
+            #no other running job (another year of the agency, say) is still copying into them
+            if options['pack']:
+                if exit_code == 0:
+                    data_directory = this_job['prefix'].split('/')[0]
+                    pending_pack.update((data_directory, agency, docket_id) for agency, docket_id in mirrulations_planning.list_job_dockets(dest_dir, this_job))
+                running_jobs = [this_peer for this_peer in jobs if 'started_at' in this_peer and 'exit_code' not in this_peer and this_peer is not this_job]
+                ready = sorted(this_docket for this_docket in pending_pack
+                               if not any(mirrulations_planning.job_writes_docket(this_peer, *this_docket) for this_peer in running_jobs))
+                pending_pack.difference_update(ready)
+                if ready:
+                    totals = mirrulations_archive.pack_dockets(dest_dir, mirrulations_archive.get_archive_dir(dest_dir),
+                                                               [(agency, docket_id, os.path.join(dest_dir, data_directory, agency, docket_id)) for data_directory, agency, docket_id in ready])
+                    print(f"Packed {totals['packed']} files from {totals['dockets']} dockets after {this_job['name']}")
+
+            #Last, so a shard only shows as finished once everything after it is done too
+            this_job['exit_code'] = exit_code
+            this_job['elapsed'] = elapsed_time
+
+        index_connection = []
+        pending_pack = set()
+
+        metrics_exporter = None
+        if options['metrics_dir']:
+            metrics_exporter = mirrulations_metrics.MetricsExporter(jobs, options['metrics_dir'], options['metrics_interval'])
+            metrics_exporter.start()
+
+        if pacer:
+            pacer.start()
+
+        publisher = None
+        if publish_events:
+            publisher = mirrulations_events.EventPublisher(options['events_file'], options['events_socket'], [options['on_event']] if options['on_event'] else [])
+            log_tailer = mirrulations_events.LogTailer(jobs, publisher, dest_dir)
+            log_tailer.start()
+
+        try:
+            self.results = await run_commands_async(command_array, options['parallel'], job_started, job_finished,
+                                                    started_job_command if options['auto_tune'] or pacer else None, self.executor,
+                                                    after_job_command if options['retry_failed'] or pacer else None)
+        finally:
+            if metrics_exporter:
+                metrics_exporter.stop()
+            if pacer:
+                pacer.stop()
+            if publisher:
+                log_tailer.stop()
+                if self.results is None:
+                    publisher.close()
+        if index_connection:
+            await self._in_thread(index_connection[0].close)
+        failed_shards = print_shard_summary(shard_names, self.results)
+        if pacer:
+            mirrulations_pacing.print_pacing_summary(pacer.summary())
+
+        #Whatever is still failing after its retries, as bucket paths ready for --files-from
+        retried_jobs = [this_job for this_job in jobs if 'retry' in this_job]
+        still_failing = {this_job['prefix'] + this_path: details for this_job in retried_jobs for this_path, details in this_job['retry']['still_failing'].items()}
+        if retried_jobs:
+            still_failing_file = mirrulations_retry.write_still_failing(still_failing) if still_failing else None
+            mirrulations_retry.print_retry_summary(sum(this_job['retry']['failed'] for this_job in retried_jobs),
+                                                   sum(this_job['retry']['recovered'] for this_job in retried_jobs), still_failing, still_failing_file)
+
+        #Mass comment campaigns leave many identical attachments, so only keep one copy of each on disk
+        if options['dedup']:
+            finished_prefixes = [this_job['prefix'] for this_job, (exit_code, elapsed_time) in zip(jobs, self.results) if exit_code == 0]
+            if finished_prefixes:
+                mirrulations_dedup.print_dedup_summary(await self._in_thread(mirrulations_dedup.dedup_tree, dest_dir, finished_prefixes,
+                                                                                    options['dedup_link_mode']))
+
+        self.result = {'shards': self.shards(), 'failed_shards': failed_shards, 'elapsed': round(time.time() - self.started_at)}
+        if pacer:
+            self.result['bandwidth'] = pacer.summary()
+        if retried_jobs:
+            self.result['still_failing'] = still_failing
+        if sampling_summary:
+            self.result['sampling'] = sampling_summary
+        if publisher:
+            publisher.publish('run_finished', shards=len(self.results), failed_shards=failed_shards, elapsed=self.result['elapsed'])
+            publisher.close()
+
+
+async def download(selection, options=None):
+    """Plan a download and start it in the background, returning its DownloadHandle.
+
+    selection and options are dicts with the keys of DEFAULT_SELECTION and DEFAULT_OPTIONS. Planning problems raise
+    SelectionError, ConfigurationError, ListingError or ManifestError here, before anything is downloaded.
+    """
+    #One thread per download for everything that would block, which also keeps each manifest connection on one thread
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        run = await asyncio.get_running_loop().run_in_executor(executor, prepare_download, selection, options)
+    except BaseException:
+        executor.shutdown(wait=False)
+        raise
+    return DownloadHandle(run, executor).start()
@@ -0,0 +1,224 @@
+import os
+import io
+import time
+import zlib
+import sqlite3
+import datetime
+import click
+
+from mirrulations_config import DATA_DIRECTORIES
+
+#Packed storage for downloaded dockets. A full mirror is tens of millions of small files, which is hard on inodes,
+#backups and rsync, so this packs each docket into a single SQLite file:
+#    {archive_dir}/{agency}/{docketID}.sqlite
+#Every member is stored under its path relative to the bucket root (raw-data/CMS/CMS-2025-0050/...), compressed on
+#its own with zlib, so any member can be read without unpacking the rest of the archive.
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    modtime REAL,
+    compressed INTEGER,
+    data BLOB
+);
+"""
+
+ARCHIVE_EXTENSION = '.sqlite'
+
+#rclone copies each file under this suffix and only renames it once it is complete, so these are never packed
+PARTIAL_SUFFIX = '.partial'
+
+#Files that do not shrink by at least this much (PDFs, images, ...) are stored as they are
+MINIMUM_COMPRESSION_SAVING = 0.95
+
+
+def get_archive_dir(dest_dir):
+    """Where packed dockets live: MIRRULATIONS_ARCHIVE_PATH, or a 'packed' directory in the destination"""
+    return os.getenv('MIRRULATIONS_ARCHIVE_PATH') or os.path.join(dest_dir, 'packed')
+
+
+def archive_path(archive_dir, agency, docket_id):
+    return os.path.join(archive_dir, agency, docket_id + ARCHIVE_EXTENSION)
+
+
+class DocketArchive:
+    """Read (and write) the members of one packed docket.
+
+        with DocketArchive(path) as archive:
+            for this_path in archive.namelist():
+                data = archive.read(this_path)
+    """
+
+    def __init__(self, path, create=False):
+        if not create and not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        if create:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        if create:
+            self.connection.executescript(ARCHIVE_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def namelist(self):
+        return [row[0] for row in self.connection.execute("SELECT path FROM members ORDER BY path")]
+
+    def __contains__(self, member_path):
+        return self.connection.execute("SELECT 1 FROM members WHERE path = ?", (member_path,)).fetchone() is not None
+
+    def info(self, member_path):
+        """(size, modtime) of a member, or None if it is not in the archive"""
+        return self.connection.execute("SELECT size, modtime FROM members WHERE path = ?", (member_path,)).fetchone()
+
+    def read(self, member_path):
+        row = self.connection.execute("SELECT compressed, data FROM members WHERE path = ?", (member_path,)).fetchone()
+        if row is None:
+            raise KeyError(member_path)
+        compressed, data = row
+        return zlib.decompress(data) if compressed else bytes(data)
+
+    def open(self, member_path):
+        """A seekable, read-only file object for a member"""
+        return io.BytesIO(self.read(member_path))
+
+    def write(self, member_path, data, modtime):
+        packed_data = zlib.compress(data, 6)
+        compressed = len(packed_data) < len(data) * MINIMUM_COMPRESSION_SAVING
+        self.connection.execute("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)",
+                                (member_path, len(data), modtime, int(compressed), packed_data if compressed else data))
+
+    def commit(self):
+        self.connection.commit()
+
+
+def open_member(archive_dir, member_path):
+    """Open a member by its bucket path (raw-data/{agency}/{docketID}/...) without knowing which archive holds it"""
+    parts = member_path.split('/')
+    if len(parts) < 4 or parts[0] not in DATA_DIRECTORIES:
+        raise KeyError(member_path)
+    with DocketArchive(archive_path(archive_dir, parts[1], parts[2])) as archive:
+        return archive.open(member_path)
+
+
+def iter_prefix_dockets(dest_dir, prefix):
+    """Yield (agency, docket id, directory) for every docket directory below a bucket prefix in the destination.
+
+    The prefix can be a data directory (raw-data/), an agency (raw-data/CMS/) or a docket (raw-data/CMS/CMS-2025-0050/).
+    """
+    parts = prefix.strip('/').split('/')
+    base_dir = os.path.join(dest_dir, *parts)
+    if not os.path.isdir(base_dir):
+        return
+
+    if len(parts) >= 3:
+        yield parts[1], parts[2], base_dir
+        return
+
+    agency_dirs = [(parts[1], base_dir)] if len(parts) == 2 else [(this_entry.name, this_entry.path) for this_entry in os.scandir(base_dir) if this_entry.is_dir()]
+    for agency, agency_dir in sorted(agency_dirs):
+        for docket_entry in sorted(os.scandir(agency_dir), key=lambda entry: entry.name):
+            if docket_entry.is_dir():
+                yield agency, docket_entry.name, docket_entry.path
+
+
+def remove_empty_directories(directory, stop_dir):
+    """Remove directory and its parents, up to but not including stop_dir, for as long as they are empty"""
+    #Another shard's rclone may be creating directories next to ours, so a directory that has stopped being empty is left alone
+    for this_root, this_dirs, this_files in os.walk(directory, topdown=False):
+        try:
+            os.rmdir(this_root)
+        except OSError:
+            pass
+    parent = os.path.dirname(directory)
+    while os.path.abspath(parent) != os.path.abspath(stop_dir):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def pack_docket(dest_dir, archive_dir, agency, docket_id, docket_dir, remove_files=True):
+    """Move a downloaded docket directory into its archive, returning how many files were packed and how many were unchanged"""
+    counts = {'packed': 0, 'unchanged': 0}
+    packed_files = []
+
+    with DocketArchive(archive_path(archive_dir, agency, docket_id), create=True) as archive:
+        for this_root, this_dirs, this_files in os.walk(docket_dir):
+            for this_file in this_files:
+                if this_file.endswith(PARTIAL_SUFFIX):
+                    continue
+                file_path = os.path.join(this_root, this_file)
+                member_path = os.path.relpath(file_path, dest_dir).replace(os.sep, '/')
+                stat = os.stat(file_path)
+                if archive.info(member_path) == (stat.st_size, stat.st_mtime):
+                    counts['unchanged'] += 1
+                else:
+                    with open(file_path, 'rb') as file_handle:
+                        archive.write(member_path, file_handle.read(), stat.st_mtime)
+                    counts['packed'] += 1
+                packed_files.append(file_path)
+        #Only remove the loose files once the archive has them safely on disk
+        archive.commit()
+
+    if remove_files:
+        for file_path in packed_files:
+            os.remove(file_path)
+        remove_empty_directories(docket_dir, dest_dir)
+
+    return counts
+
+
+def pack_prefix(dest_dir, archive_dir, prefix, remove_files=True):
+    """Pack every downloaded docket below a bucket prefix"""
+    return pack_dockets(dest_dir, archive_dir, list(iter_prefix_dockets(dest_dir, prefix)), remove_files)
+
+
+def pack_dockets(dest_dir, archive_dir, dockets, remove_files=True):
+    """Pack the (agency, docket id, directory) of downloaded dockets"""
+    totals = {'dockets': 0, 'packed': 0, 'unchanged': 0}
+    for agency, docket_id, docket_dir in dockets:
+        if not os.path.isdir(docket_dir):
+            continue
+        counts = pack_docket(dest_dir, archive_dir, agency, docket_id, docket_dir, remove_files)
+        totals['dockets'] += 1
+        totals['packed'] += counts['packed']
+        totals['unchanged'] += counts['unchanged']
+    return totals
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Only pack these agencies (separated by commas).")
+@click.option('--keep-files', is_flag=True, help="Leave the loose files in place after packing them")
+def main(agency, keep_files):
+    """Pack the dockets already downloaded to MIRRULATIONS_DESTINATION_PATH into one archive per docket"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    if not dest_dir or not os.path.exists(dest_dir):
+        print(f"Error: {dest_dir} does not exist ")
+        exit()
+
+    archive_dir = get_archive_dir(dest_dir)
+    start_time = time.time()
+    for this_data_directory in DATA_DIRECTORIES:
+        prefixes = [f"{this_data_directory}/{this_agency}/" for this_agency in agency_list] or [f"{this_data_directory}/"]
+        for this_prefix in prefixes:
+            totals = pack_prefix(dest_dir, archive_dir, this_prefix, not keep_files)
+            if totals['dockets']:
+                print(f"{this_prefix}: packed {totals['packed']} files from {totals['dockets']} dockets, {totals['unchanged']} unchanged")
+    elapsed_time = round(time.time() - start_time)
+    print(f"Archives are in {archive_dir} ( took {datetime.timedelta(seconds = elapsed_time)} )")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,82 +1,23 @@
-import os
-from dotenv import load_dotenv
-import click
 import time
 import datetime
+import asyncio
+import click
 
-load_dotenv() #So we can get our passwords from the .env file
-
-
-def parse_years(year_str):
-    years = []
-    for item in year_str.split(','):
-        if '-' in item:
-            start, end = map(int, item.split('-'))
-            years.extend(range(start, end + 1))
-        else:
-            years.append(int(item))
-    return years
-
+import mirrulations_api
+import mirrulations_planning
 
-def print_and_run_command_array(command_array, noconfirm=False):
 
+def confirm_commands(command_array, noconfirm=False):
+    """Show the commands we are about to run and, unless noconfirm, ask whether to go ahead"""
     print("Preparing to run:")
     for this_command in command_array:
         print(f"\t{this_command}")
 
-    if noconfirm or click.confirm('Do you want to run these commands?', default=False):
-        for this_command in command_array:
-            print(f"Running:\t{this_command}")
-            os.system(this_command)
-    else:
-        print("Not running. Goodbye.")
-        exit()
+    return noconfirm or click.confirm('Do you want to run these commands?', default=False)
 
 
-def generate_include_patterns(agency_list, year_list, docket_list, included_file_types):
-    """Generate include patterns for the new folder structure with derived-data and raw-data"""
-    include_patterns = []
-    
-    # Handle specific dockets
-    if len(docket_list) > 0:
-        for this_docket in docket_list:
-            # Extract agency from docket ID (format: AGENCY-YEAR-ID)
-            docket_parts = this_docket.split('-')
-            if len(docket_parts) >= 3:
-                agency = docket_parts[0]
-                
-                for this_file_type in included_file_types:
-                    # Add patterns for both derived-data and raw-data
-                    include_patterns.append(f"/derived-data/{agency}/{this_docket}/**/{this_file_type}")
-                    include_patterns.append(f"/raw-data/{agency}/{this_docket}/**/{this_file_type}")
-        return include_patterns
-    
-    # Handle agency/year combinations
-    for this_agency in agency_list:
-        for this_year in year_list:
-            for this_file_type in included_file_types:
-                if this_year == '*':
-                    # No year filter - match all dockets for this agency
-                    if this_agency == '*':
-                        # Match everything
-                        include_patterns.append(f"/derived-data/**/{this_file_type}")
-                        include_patterns.append(f"/raw-data/**/{this_file_type}")
-                    else:
-                        # Match all dockets for specific agency
-                        include_patterns.append(f"/derived-data/{this_agency}/**/{this_file_type}")
-                        include_patterns.append(f"/raw-data/{this_agency}/**/{this_file_type}")
-                else:
-                    # Year filter - match dockets with specific year in docketID
-                    if this_agency == '*':
-                        # Match all agencies for specific year
-                        include_patterns.append(f"/derived-data/*/*-{this_year}-*/**/{this_file_type}")
-                        include_patterns.append(f"/raw-data/*/*-{this_year}-*/**/{this_file_type}")
-                    else:
-                        # Match specific agency and year
-                        include_patterns.append(f"/derived-data/{this_agency}/*-{this_year}-*/**/{this_file_type}")
-                        include_patterns.append(f"/raw-data/{this_agency}/*-{this_year}-*/**/{this_file_type}")
-    
-    return include_patterns
+def split_list(text):
+    return [this_item.strip() for this_item in text.split(',') if this_item.strip()]
 
 
 @click.command()
@@ -86,121 +27,84 @@ def generate_include_patterns(agency_list, year_list, docket_list, included_file
 @click.option('--getall', is_flag=True, help="Download all agencies, all years. (WARNING: this could cost a few hundred dollars...)")
 @click.option('--transfers', default='', help="How many rclone connections to run at the same time (default is 50)")
 @click.option('--docket','-d', default='', help="Download a specific docket id")
+@click.option('--posted-after', default='', help="Only dockets with a comment posted on or after this date (e.g. 2024-01-01). Fetches the metadata first, see mirrulations_catalog.py")
+@click.option('--posted-before', default='', help="Only dockets with a comment posted on or before this date. Fetches the metadata first")
+@click.option('--document-type', default='', help="Only dockets with a document of these types, separated by commas (e.g. 'Proposed Rule,Rule'). Fetches the metadata first")
+@click.option('--docket-type', default='', help="Only dockets of these types, separated by commas (Rulemaking, Nonrulemaking). Fetches the metadata first")
+@click.option('--min-comments', default=0, type=int, help="Only dockets with at least this many comments. Fetches the metadata first")
+@click.option('--with-derived', default='', help="Only dockets with derived-data directories of these names, separated by commas (e.g. ai_summary,entities)")
+@click.option('--sample', default='', help="Only a sample of each docket's comments: a fraction (5% or 0.05) or a number of comments per docket (200), with their derived text")
+@click.option('--sample-seed', default=0, type=int, help="Which comments --sample picks. The same seed always picks the same ones (default is 0)")
+@click.option('--sample-attachments', is_flag=True, help="With --sample, also download the attachments of the sampled comments")
+@click.option('--max-file-size', default='', help="Skip binaries larger than this (e.g. 20M), and list what was skipped")
+@click.option('--max-docket-size', default='', help="Stop adding a docket's binaries, smallest first, once it reaches this size (e.g. 1G), and list what was skipped")
 @click.option('--noconfirm', is_flag=True, help="Skip confirmation prompt and run commands automatically")
-
-def main(agency, year, docket, textonly, getall, transfers, noconfirm):
-    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
-    docket_list =  [docket.strip() for docket in docket.split(',') if docket.strip()]
-    
-    if year:
-        year_list = parse_years(year)
-    else:
-        year_list = []
-
-    run_command(agency_list, year_list, docket_list, textonly, getall, transfers, noconfirm)
-
-def run_command(agency_list, year_list, docket_list, textonly, getall, transfers, noconfirm):
+@click.option('--parallel', default=1, type=int, help="How many rclone processes to run at the same time, each with its own --transfers (default is 1)")
+@click.option('--shard-by', default='none', type=click.Choice(['none', 'agency', 'agency-year', 'docket']), help="How to split the selection into separate rclone processes (default is none, or agency-year with --auto-tune or when --parallel is more than 1)")
+@click.option('--use-manifest', is_flag=True, help="Resolve the selection against the local manifest (see mirrulations_manifest.py) and pass rclone an exact list of files")
+@click.option('--delta', is_flag=True, help="Only copy objects that are new or changed since the last successful run (uses the manifest)")
+@click.option('--resume', is_flag=True, help="Pick up an interrupted run with the same options, skipping the shards it already finished")
+@click.option('--auto-tune', is_flag=True, help="Adjust --transfers from shard to shard based on the throughput and errors of the shards before it")
+@click.option('--metrics-dir', default='', help="Write live transfer metrics (a Prometheus textfile and a JSON-lines stream) into this directory")
+@click.option('--metrics-interval', default=15, type=int, help="How often to write the metrics, in seconds (default is 15)")
+@click.option('--plan', is_flag=True, help="Do not download anything, just report how many objects and bytes the selection covers and estimate how long it would take (uses the manifest)")
+@click.option('--text-first', is_flag=True, help="Download the text and metadata of the whole selection first, marking each docket in text-complete/ as its text arrives, and only then the binary attachments")
+@click.option('--text-bwlimit', default='', help="rclone --bwlimit for each rclone process of the text phase of --text-first (e.g. 20M)")
+@click.option('--binary-bwlimit', default='', help="rclone --bwlimit for each rclone process of the binary phase of --text-first (e.g. 50M)")
+@click.option('--bwlimit-schedule', default='', help="Cap the combined rate of all rclone processes by time of day, in rclone's timetable format (e.g. \"08:00,5M 18:00,off Sat-00:00,off\")")
+@click.option('--total-bwlimit', default='', help="Cap the combined rate of all rclone processes together (e.g. 100M), shared out between the running shards by what they can use")
+@click.option('--files-from', default='', help="Download exactly the bucket paths listed in this file, one per line (for example the repair list from mirrulations_verify.py)")
+@click.option('--dedup', is_flag=True, help="After the download, replace duplicate files with reflinks to a single stored copy, where the filesystem supports them (see mirrulations_dedup.py)")
+@click.option('--dedup-link-mode', default='reflink', type=click.Choice(['reflink', 'hardlink']), help="How --dedup replaces duplicates (default is reflink). Hardlinks work on every filesystem but share their mtime, which makes later downloads without --delta check and touch every duplicate")
+@click.option('--retry-failed', is_flag=True, help="When files fail to copy, retry just those files with a backoff that depends on the error (see mirrulations_retry.py) instead of rerunning the whole shard")
+@click.option('--index', is_flag=True, help="Update the comment index and its full-text search (see mirrulations_index.py and mirrulations_search.py) as each shard finishes")
+@click.option('--pack', is_flag=True, help="Pack each docket into one archive file as its shard finishes, instead of leaving millions of loose files (best used with --delta)")
+@click.option('--events-file', default='', help="Append an event to this JSON-lines file as each file, docket and the whole run completes (see mirrulations_events.py)")
+@click.option('--events-socket', default='', help="Also send the events to every client connected to a Unix socket at this path")
+@click.option('--shard', default='', help="Only download this machine's slice i/N of the selection (e.g. 2/4), split by a hash of the docket ids. Check the slices with mirrulations_partition.py")
+@click.option('--staging', is_flag=True, help="Download into a staging area and move each docket into place once its shard finishes, so nothing ever sees a half-written docket")
+
+def main(**arguments):
     """A command to generate and run the rclone commands needed to download regulations data from the mirrulations project!"""
-
+    selection = {'agencies': split_list(arguments['agency']),
+                 'years': mirrulations_planning.parse_years(arguments['year']) if arguments['year'] else [],
+                 'dockets': split_list(arguments['docket']),
+                 'textonly': arguments['textonly'], 'getall': arguments['getall'], 'files_from': arguments['files_from'],
+                 'attributes': {'posted_after': arguments['posted_after'], 'posted_before': arguments['posted_before'],
+                                'min_comments': arguments['min_comments'], 'document_types': split_list(arguments['document_type']),
+                                'docket_types': split_list(arguments['docket_type']), 'derived': split_list(arguments['with_derived'])},
+                 'sampling': {'sample': arguments['sample'], 'seed': arguments['sample_seed'], 'attachments': arguments['sample_attachments'],
+                              'max_file_size': arguments['max_file_size'], 'max_docket_size': arguments['max_docket_size']}}
+
+    #Every other option has the same name in the API
+    options = {this_key: arguments[this_key] for this_key in mirrulations_api.DEFAULT_OPTIONS if this_key in arguments}
+    options['transfers'] = arguments['transfers'] or 50
+    #The logs stay in the working directory, and a single rclone process shows its progress bar, as they always have
+    options.update({'log_dir': '', 'progress': True, 'confirm': lambda command_array: confirm_commands(command_array, arguments['noconfirm'])})
+
+    run_command(selection, options, arguments['plan'])
+
+
+def run_command(selection, options, plan=False):
+    """Run a download with mirrulations_api.download() (or only report its plan), print the errors the API raises and exit"""
     start_time = time.time()
 
-    #How many rclone transfers should we use? We need to figure it out before we build the arguments to rclone that we 
-    #Will use on any future command
-    transfers_to_use = 50
-    if transfers:
-        if(transfers.isnumeric()):
-            transfers_to_use = transfers
-        else:
-            print("Non numeric value for transfers argument. confusion. exiting")
-            exit()
-    checkers_to_use = int(transfers_to_use) * 2
-
-    #these are the rclone commands that we always use (removed --s3-requester-pays)
-    always_flags = f"  --checkers {checkers_to_use} --transfers {transfers_to_use} --log-file 'rclone.log' -P "
-
-    #tracks whether there is a limitation argument
-    is_limited = False
-
-    if getall:
-        is_enough = True
-    else:
-        is_enough = False
-
-    if len(agency_list) > 0:
-        is_enough = True
-        is_limited = True
-    else:
-        agency_list = [ '*' ]
-
-    if len(year_list) > 0:
-        is_enough = True
-        is_limited = True
-    else:
-        year_list = [ '*' ]
-
-    if len(docket_list) > 0:
-        is_enough = True
-        is_limited = True
-    else:
-        docket_list = []
-
-    #All 'text only' means is that we are not doing the word documents, pdfs, etc etc.. we just want to the raw text files
-    #these come in three flavors... 
-    if not textonly:
-        included_file_types = ['*']
-    else:
-        included_file_types = ['*.txt','*.json','*.htm']
-        is_limited = True
-        is_enough = True
-
-    #we either need --getall or we need some other limitation
-    #we are not just going to download everything without some indication that we should...
-    if not is_enough:
-        print("If you want to download everything.. pass in the --getall paramater and go to lunch!! \nOtherwise add the --help for a full list of options")
+    try:
+        if plan:
+            run = mirrulations_api.prepare_download(selection, options)
+            mirrulations_planning.print_plan(run['manifest_connection'] or mirrulations_api.open_checked_manifest(), run['jobs'],
+                                             run['selection']['textonly'], run['options']['parallel'])
+            return
+        result = asyncio.run(download_and_wait(selection, options))
+    except mirrulations_api.ShardsFailedError as error:
+        result = error.result
+    except mirrulations_api.DownloadError as error:
+        print(error)
         exit()
-    
-    #A substantial part of our configuration is contained in rclone configuration file 
-    #We need to make sure these exist! 
-    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
-    rclone_config_file = os.getenv('RCLONE_CONFIG_FILE')
-
-    has_error = False
-
-    if not os.path.exists(dest_dir):
-        print(f"Error: {dest_dir} does not exist ")
-        has_error = True
 
-    if not os.path.isfile(rclone_config_file):
-        print(f"Error: {rclone_config_file} is not found")
-        has_error = True
-
-    if has_error:
-        print("Crashing due to errors")
-        exit()
-
-    #If we get here then we have the files we need to proceed.
-    #Updated base path to work with new structure
-    base_rclone_command = f"rclone copy myconfig:mirrulations/ {dest_dir} --config {rclone_config_file} {always_flags}"
-
-    if getall:
-        if is_limited:
-            print(f"You have entered --getall and a filter at the same time. I dont know what to do... so I am not going to do anything. Try --help")
-            exit()
-        else:
-            #If we get here, then should simply download everything.
-            #we just run the command with no modification with --include statements
-            commands_to_run = [ base_rclone_command ]
-            print_and_run_command_array(commands_to_run, noconfirm)
-    else:
-        #Here we are downloading some subset of the data.. which we will express with one or more --include statements to the rclone command
-        include_patterns = generate_include_patterns(agency_list, year_list, docket_list, included_file_types)
-
-        this_command = base_rclone_command
-        for include_pattern in include_patterns:
-            this_command += f" --include \"{include_pattern}\" "
-
-        command_array = [ this_command ]
-        print_and_run_command_array(command_array, noconfirm)
+    #Nothing was left to copy
+    if not result['shards']:
+        return
 
     #No matter if we are downloading a portion or everything..
     #We print out how long it took to run.
@@ -215,6 +119,14 @@ Process finished!
 
             """)
 
+    if result['failed_shards'] > 0:
+        exit(1)
+
+
+async def download_and_wait(selection, options):
+    handle = await mirrulations_api.download(selection, options)
+    return await handle.wait()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,299 @@
+import os
+import shutil
+import datetime
+import subprocess
+import click
+
+from mirrulations_config import docket_year, get_remote, get_state_dir, is_local_remote
+import mirrulations_index
+import mirrulations_manifest
+import mirrulations_planning
+
+#Selects dockets by what is in their metadata instead of by agency, year and docket id alone. Before anything is
+#downloaded in full, only the small JSON files of the selection are fetched:
+#    raw-data/{agency}/{docketID}/text-{docketID}/docket/*.json       always
+#    raw-data/{agency}/{docketID}/text-{docketID}/documents/*.json    always
+#    raw-data/{agency}/{docketID}/text-{docketID}/comments/*.json     only for the comment attributes
+#into {MIRRULATIONS_STATE_PATH}/catalog/data, where mirrulations_index.py reads them into catalog.sqlite next to it.
+#The derived-data of the selection is only listed, down to a few directory levels, to see which dockets have what.
+#Both are kept between runs, so a second selection over the same agencies only fetches what changed.
+#The dockets that match every attribute given are then downloaded in full, like a --shard slice.
+
+#The attributes a selection can have, all of which a docket has to match
+ATTRIBUTES = ['posted_after', 'posted_before', 'document_types', 'docket_types', 'min_comments', 'derived']
+
+#The attributes that need the comments' JSON
+COMMENT_ATTRIBUTES = ['posted_after', 'posted_before', 'min_comments']
+
+#How many directory levels below a docket in derived-data are listed for the 'derived' attribute
+DERIVED_DEPTH = 4
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS derived_dirs (
+    agency TEXT,
+    docket_id TEXT,
+    name TEXT,
+    PRIMARY KEY (docket_id, name)
+);
+"""
+
+
+def get_catalog_dir():
+    catalog_dir = os.path.join(get_state_dir(), 'catalog')
+    os.makedirs(catalog_dir, exist_ok=True)
+    return catalog_dir
+
+
+def check_attributes(attributes):
+    """Check a selection's attributes, returning them without the ones left empty. Raises ValueError"""
+    unknown = sorted(set(attributes) - set(ATTRIBUTES))
+    if unknown:
+        raise ValueError(f"Unknown attributes: {', '.join(unknown)}")
+    attributes = {this_key: this_value for this_key, this_value in attributes.items() if this_value}
+
+    for this_key in ['posted_after', 'posted_before']:
+        if this_key in attributes:
+            try:
+                datetime.date.fromisoformat(attributes[this_key])
+            except ValueError:
+                raise ValueError(f"--{this_key.replace('_', '-')} must be a date like 2024-01-31, not {attributes[this_key]}")
+    if 'min_comments' in attributes and (not str(attributes['min_comments']).isnumeric()):
+        raise ValueError(f"--min-comments must be a whole number, not {attributes['min_comments']}")
+    for this_key in ['document_types', 'docket_types', 'derived']:
+        if this_key in attributes and isinstance(attributes[this_key], str):
+            attributes[this_key] = [attributes[this_key]]
+    return attributes
+
+
+def metadata_kinds(attributes):
+    """The directories below text-{docketID} that the attributes need"""
+    if any(this_key in attributes for this_key in COMMENT_ATTRIBUTES):
+        return ['docket', 'documents', 'comments']
+    return ['docket', 'documents']
+
+
+def job_covers_docket(job, agency, docket_id):
+    """True when a docket is below a job's prefix and in its years (a job's 'dockets' are left to the caller)"""
+    parts = job['prefix'].strip('/').split('/')
+    if len(parts) > 1 and parts[1] != agency:
+        return False
+    if len(parts) > 2 and parts[2] != docket_id:
+        return False
+    return not job['years'] or docket_year(docket_id) in job['years']
+
+
+def metadata_filter_rules(job, kinds):
+    """rclone filter rules that keep only the metadata JSON of a raw-data job's dockets"""
+    docket_glob = mirrulations_planning.job_docket_glob(job)
+    rules = [f"- {'/*' * job['docket_depth']}/binary-*/**"]
+    rules += [f"+ {docket_glob}/text-*/{this_kind}/*.json" for this_kind in kinds]
+    rules.append("- **")
+    return rules
+
+
+def is_metadata_path(bucket_path, kinds):
+    """True for raw-data/{agency}/{docketID}/text-{docketID}/{kind}/*.json, with kind one of kinds"""
+    parts = bucket_path.split('/')
+    return len(parts) == 6 and parts[0] == 'raw-data' and parts[3].startswith('text-') and parts[4] in kinds and parts[5].endswith('.json')
+
+
+def fetch_metadata(job, rclone_config_file, kinds, transfers=50):
+    """Copy the metadata JSON below a raw-data job's prefix into the catalog's data directory. Raises RuntimeError"""
+    remote = get_remote()
+    data_dir = os.path.join(get_catalog_dir(), 'data')
+
+    if is_local_remote(remote):
+        #A local directory laid out like the bucket, copied the way rclone would: only what changed, renamed into place
+        for this_path, size, mtime in mirrulations_manifest.iter_remote_listing(remote, None, job['prefix']):
+            parts = this_path.split('/')
+            if not is_metadata_path(this_path, kinds) or not job_covers_docket(job, parts[1], parts[2]):
+                continue
+            local_path = os.path.join(data_dir, this_path)
+            if os.path.isfile(local_path) and os.path.getsize(local_path) == size and os.path.getmtime(local_path) == mtime:
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            shutil.copy2(os.path.join(remote, this_path), local_path + '.partial')
+            os.replace(local_path + '.partial', local_path)
+        return
+
+    rclone_command = ['rclone', 'copy', f"{remote}{job['prefix']}", os.path.join(data_dir, job['prefix']),
+                      '--filter-from', mirrulations_planning.write_filter_file(metadata_filter_rules(job, kinds)),
+                      '--transfers', str(transfers), '--checkers', str(int(transfers) * 2)]
+    if rclone_config_file:
+        rclone_command += ['--config', rclone_config_file]
+
+    result = subprocess.run(rclone_command, capture_output=True, text=True)
+    if result.returncode not in [0, mirrulations_planning.RCLONE_DIRECTORY_NOT_FOUND]:
+        raise RuntimeError(f"rclone copy failed for the metadata of {job['prefix']}: {result.stderr.strip()}")
+
+
+def list_derived_directories(job, rclone_config_file):
+    """The directories below each docket of a derived-data job, down to DERIVED_DEPTH levels.
+
+    Returns a dict of (agency, docket id) -> the set of directory names found anywhere below it.
+    """
+    remote = get_remote()
+    depth = job['docket_depth'] + DERIVED_DEPTH
+    if is_local_remote(remote):
+        top = os.path.join(remote, job['prefix'])
+        relative_dirs = []
+        for this_dir, dir_names, file_names in os.walk(top):
+            relative_dir = os.path.relpath(this_dir, top).replace(os.sep, '/')
+            if relative_dir != '.':
+                relative_dirs.append(relative_dir)
+            if relative_dir.count('/') + 1 >= depth and relative_dir != '.':
+                dir_names.clear()
+    else:
+        rclone_command = ['rclone', 'lsf', '-R', '--dirs-only', '--max-depth', str(depth), f"{remote}{job['prefix']}"]
+        if rclone_config_file:
+            rclone_command += ['--config', rclone_config_file]
+        result = subprocess.run(rclone_command, capture_output=True, text=True)
+        if result.returncode == mirrulations_planning.RCLONE_DIRECTORY_NOT_FOUND:
+            return {}
+        if result.returncode != 0:
+            raise RuntimeError(f"rclone lsf failed for {job['prefix']}: {result.stderr.strip()}")
+        relative_dirs = [this_line.strip().rstrip('/') for this_line in result.stdout.splitlines() if this_line.strip()]
+
+    derived = {}
+    for this_dir in relative_dirs:
+        parts = (job['prefix'] + this_dir).split('/')
+        if len(parts) < 3 or not job_covers_docket(job, parts[1], parts[2]):
+            continue
+        derived.setdefault((parts[1], parts[2]), set()).update(parts[3:])
+    return derived
+
+
+def open_catalog(catalog_path=None):
+    """Open (creating if needed) the catalog, an index database with a table of the derived-data directories.
+
+    Selecting by attributes never searches text, so the catalog is opened without full-text search and works with a
+    SQLite that has no FTS5.
+    """
+    connection = mirrulations_index.open_index(catalog_path or os.path.join(get_catalog_dir(), 'catalog.sqlite'), full_text=False)
+    connection.executescript(CATALOG_SCHEMA)
+    return connection
+
+
+def build_catalog(connection, jobs, attributes, rclone_config_file, transfers=50):
+    """Fetch the metadata the attributes need for the jobs' dockets and bring the catalog up to date with it. Raises RuntimeError"""
+    kinds = metadata_kinds(attributes)
+    for this_job in jobs:
+        if this_job['prefix'].startswith('raw-data/'):
+            fetch_metadata(this_job, rclone_config_file, kinds, transfers)
+        elif 'derived' in attributes:
+            derived = list_derived_directories(this_job, rclone_config_file)
+            #Forget what we knew about the job's dockets, some of their directories may be gone
+            agency = this_job['prefix'].strip('/').split('/')[1:2]
+            known = connection.execute("SELECT DISTINCT agency, docket_id FROM derived_dirs" + (" WHERE agency = ?" if agency else ""), agency).fetchall()
+            connection.executemany("DELETE FROM derived_dirs WHERE docket_id = ?",
+                                   [(docket_id,) for this_agency, docket_id in known if job_covers_docket(this_job, this_agency, docket_id)])
+            connection.executemany("INSERT OR REPLACE INTO derived_dirs VALUES (?, ?, ?)",
+                                   [(this_agency, docket_id, this_name) for (this_agency, docket_id), names in derived.items() for this_name in names])
+            connection.commit()
+
+    return mirrulations_index.index_tree(connection, os.path.join(get_catalog_dir(), 'data'))
+
+
+def select_dockets(connection, attributes):
+    """The dockets in the catalog that match every attribute, as (agency, docket id) pairs sorted by docket id.
+
+    Dates compare with the day a comment was posted, both ends included, and types compare without case.
+    """
+    sql = "SELECT docket_id, path FROM dockets WHERE 1"
+    parameters = []
+    if 'docket_types' in attributes:
+        sql += f" AND lower(docket_type) IN ({', '.join('?' * len(attributes['docket_types']))})"
+        parameters += [this_type.lower() for this_type in attributes['docket_types']]
+    if 'document_types' in attributes:
+        sql += f" AND docket_id IN (SELECT docket_id FROM documents WHERE lower(document_type) IN ({', '.join('?' * len(attributes['document_types']))}))"
+        parameters += [this_type.lower() for this_type in attributes['document_types']]
+    if 'posted_after' in attributes or 'posted_before' in attributes:
+        sql += " AND docket_id IN (SELECT docket_id FROM comments WHERE substr(posted_date, 1, 10) BETWEEN ? AND ?)"
+        parameters += [attributes.get('posted_after', '0000-00-00'), attributes.get('posted_before', '9999-99-99')]
+    if 'min_comments' in attributes:
+        sql += " AND (SELECT COUNT(*) FROM comments WHERE comments.docket_id = dockets.docket_id) >= ?"
+        parameters.append(int(attributes['min_comments']))
+    for this_name in attributes.get('derived', []):
+        sql += " AND docket_id IN (SELECT docket_id FROM derived_dirs WHERE name = ?)"
+        parameters.append(this_name)
+
+    selected = []
+    for docket_id, path in connection.execute(sql + " ORDER BY docket_id", parameters):
+        selected.append((path.split(os.sep)[1], docket_id))
+    return selected
+
+
+def narrow_jobs(jobs, selected):
+    """Cut every job down to the selected dockets below its prefix, dropping the jobs that have none"""
+    narrowed = []
+    for this_job in jobs:
+        dockets = [docket_id for agency, docket_id in selected if job_covers_docket(this_job, agency, docket_id)]
+        if 'dockets' in this_job:
+            #Already this machine's slice (--shard)
+            keep = set(this_job['dockets'])
+            dockets = [this_docket for this_docket in dockets if this_docket in keep]
+        if not dockets:
+            continue
+        if this_job['docket_depth'] > 0:
+            this_job['dockets'] = dockets
+        narrowed.append(this_job)
+    return narrowed
+
+
+def select_jobs_by_attributes(jobs, attributes, rclone_config_file, transfers=50):
+    """Keep only the dockets of the jobs whose metadata matches the attributes. Raises RuntimeError"""
+    connection = open_catalog()
+    try:
+        build_catalog(connection, jobs, attributes, rclone_config_file, transfers)
+        selected = select_dockets(connection, attributes)
+    finally:
+        connection.close()
+
+    narrowed = narrow_jobs(jobs, selected)
+    dockets = set().union(*[set(this_job.get('dockets') or [this_job['prefix'].strip('/').split('/')[2]]) for this_job in narrowed])
+    print(f"{len(dockets)} dockets match the attributes")
+    return narrowed
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Agency acronyms(s) separated by commas.")
+@click.option('--year', '-y', default='', help="Year(s) or range(s) of years separated by commas or dash (e.g., 2010-2015).")
+@click.option('--posted-after', default='', help="Only dockets with a comment posted on or after this date (e.g. 2024-01-01)")
+@click.option('--posted-before', default='', help="Only dockets with a comment posted on or before this date")
+@click.option('--document-type', default='', help="Only dockets with a document of these types, separated by commas (e.g. 'Proposed Rule,Rule')")
+@click.option('--docket-type', default='', help="Only dockets of these types, separated by commas (Rulemaking, Nonrulemaking)")
+@click.option('--min-comments', default=0, type=int, help="Only dockets with at least this many comments")
+@click.option('--with-derived', default='', help="Only dockets with derived-data directories of these names, separated by commas (e.g. ai_summary)")
+def main(agency, year, posted_after, posted_before, document_type, docket_type, min_comments, with_derived):
+    """Fetch the metadata of a selection into the catalog and list the dockets that match the attributes.
+    The same options on mirrulations_bulk_downloader.py download them."""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()] or ['*']
+    year_list = mirrulations_planning.parse_years(year) if year else ['*']
+    try:
+        attributes = check_attributes({'posted_after': posted_after, 'posted_before': posted_before, 'min_comments': min_comments,
+                                       'document_types': [this_type.strip() for this_type in document_type.split(',') if this_type.strip()],
+                                       'docket_types': [this_type.strip() for this_type in docket_type.split(',') if this_type.strip()],
+                                       'derived': [this_name.strip() for this_name in with_derived.split(',') if this_name.strip()]})
+    except ValueError as error:
+        print(f"Error: {error}")
+        exit()
+
+    jobs = mirrulations_planning.plan_copy_jobs(agency_list, year_list, [], ['*'])
+    try:
+        connection = open_catalog()
+        counts = build_catalog(connection, jobs, attributes, os.getenv('RCLONE_CONFIG_FILE'))
+    except RuntimeError as error:
+        print(f"Error: {error}")
+        exit()
+
+    selected = [(this_agency, docket_id) for this_agency, docket_id in select_dockets(connection, attributes)
+                if any(job_covers_docket(this_job, this_agency, docket_id) for this_job in jobs)]
+    for this_agency, docket_id in selected:
+        title, this_docket_type = connection.execute("SELECT title, docket_type FROM dockets WHERE docket_id = ?", (docket_id,)).fetchone()
+        print(f"{docket_id}\t{this_docket_type}\t{title}")
+    print(f"Read {counts['indexed']} new or changed metadata files into the catalog")
+    print(f"{len(selected)} dockets match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import hashlib
+from dotenv import load_dotenv
+
+load_dotenv() #So we can get our passwords from the .env file
+
+#The two top level directories of the mirrulations bucket. Everything below them is laid out as {agency}/{docketID}/...
+DATA_DIRECTORIES = ['derived-data', 'raw-data']
+
+
+def get_remote():
+    """The rclone remote (or a local directory laid out like the bucket) that we download from"""
+    remote = os.getenv('MIRRULATIONS_REMOTE', 'myconfig:mirrulations/')
+    #Bucket prefixes are appended straight onto the remote, so it has to end with a slash
+    if not remote.endswith('/'):
+        remote += '/'
+    return remote
+
+
+def is_local_remote(remote):
+    """True when the remote is a plain local directory rather than an rclone remote"""
+    return os.path.isdir(remote)
+
+
+def get_state_dir():
+    """The directory where we keep filter files, journals and other bookkeeping between runs"""
+    state_dir = os.getenv('MIRRULATIONS_STATE_PATH', './mirrulations_state')
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def docket_year(docket_id):
+    """Pull the year out of a docket id. Most look like CMS-2025-0050, but some have extra parts (EPA-HQ-OAR-2021-0317)"""
+    for this_part in docket_id.split('-')[1:]:
+        if len(this_part) == 4 and this_part.isdigit():
+            return int(this_part)
+    return None
+
+
+def docket_shard(docket_id, shard_count):
+    """Which of shard_count machines (numbered from 1) a docket belongs to. A stable hash, so every machine agrees"""
+    return int(hashlib.sha1(docket_id.encode('utf-8')).hexdigest()[:8], 16) % shard_count + 1
+
+
+def parse_bucket_path(path):
+    """Split a path relative to the bucket root into its data directory, agency, docket, year and section.
+
+    The section is 'text' or 'binary' for raw-data (from the text-{docketID} / binary-{docketID} directories)
+    and 'derived' for derived-data. Paths that do not follow the layout get None for the parts they are missing.
+    """
+    parts = path.split('/')
+    parsed = {'data_directory': parts[0], 'agency': None, 'docket': None, 'year': None, 'section': None}
+
+    if len(parts) > 1:
+        parsed['agency'] = parts[1]
+    if len(parts) > 2:
+        parsed['docket'] = parts[2]
+        parsed['year'] = docket_year(parts[2])
+    if parts[0] == 'derived-data':
+        parsed['section'] = 'derived'
+    elif len(parts) > 3:
+        if parts[3].startswith('binary-'):
+            parsed['section'] = 'binary'
+        elif parts[3].startswith('text-'):
+            parsed['section'] = 'text'
+
+    return parsed
+
+
+def iter_batches(items, batch_size):
+    """Yield lists of up to batch_size items from any iterable, so a stream can be handled a batch at a time"""
+    batch = []
+    for this_item in items:
+        batch.append(this_item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
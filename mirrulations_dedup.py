@@ -0,0 +1,186 @@
+import os
+import time
+import errno
+import fcntl
+import datetime
+import click
+
+from mirrulations_config import DATA_DIRECTORIES
+from mirrulations_hashes import HashCache
+
+#Mass comment campaigns mean many attachments and extracted texts are byte for byte identical across comments and
+#dockets. This replaces every duplicate with a link to a single copy in a content addressed store:
+#    {MIRRULATIONS_DESTINATION_PATH}/.content/{sha256[:2]}/{sha256}
+#The store has to be on the same filesystem as the files for hardlinks and reflinks to work, so it lives in the destination.
+#
+#Reflinks (on filesystems that support them, like btrfs and XFS) share only the data blocks and keep everything else
+#separate, so they are the default. Where the filesystem cannot reflink, each duplicate stays a copy of its own.
+#
+#Hardlinks work everywhere but have to be asked for. Hardlinked duplicates share one inode, so they also share
+#permissions and mtime: the mtime of the stored copy, which matches at most one of the bucket objects. Every later
+#download that does not use --delta then finds the others with the wrong mtime, checks their md5 against the bucket
+#and sets the mtime back, on the inode every duplicate shares. That moves the mtime of all of them, so their rows in
+#the hash cache no longer match and the next dedup pass hashes them all again.
+
+CONTENT_STORE_DIR_NAME = '.content'
+
+#Files smaller than this take a block whatever we do, so linking them saves next to nothing
+DEFAULT_MINIMUM_SIZE = 4096
+
+#The Linux FICLONE ioctl, which makes dest share the data blocks of src
+FICLONE = 0x40049409
+
+LINK_MODES = ['reflink', 'hardlink']
+
+#What FICLONE fails with when the filesystem (or the OS) cannot reflink
+REFLINK_UNSUPPORTED = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS}
+
+
+def get_content_store_dir(dest_dir):
+    return os.path.join(dest_dir, CONTENT_STORE_DIR_NAME)
+
+
+def store_path(store_dir, digest):
+    return os.path.join(store_dir, digest[:2], digest)
+
+
+def reflink(source_path, target_path):
+    with open(source_path, 'rb') as source_handle, open(target_path, 'wb') as target_handle:
+        fcntl.ioctl(target_handle.fileno(), FICLONE, source_handle.fileno())
+
+
+def replace_with_link(source_path, target_path, link_mode):
+    """Atomically replace target_path with a hardlink or reflink to source_path.
+
+    Returns False, leaving target_path as its own copy, when the filesystem cannot reflink.
+    """
+    temporary_path = f"{target_path}.dedup-{os.getpid()}"
+    if link_mode == 'reflink':
+        try:
+            reflink(source_path, temporary_path)
+        except OSError as error:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            if error.errno not in REFLINK_UNSUPPORTED:
+                raise
+            return False
+        stat = os.stat(target_path)
+        os.utime(temporary_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    else:
+        os.link(source_path, temporary_path)
+    os.replace(temporary_path, target_path)
+    return True
+
+
+def iter_files(dest_dir, prefixes, minimum_size):
+    """Every file of at least minimum_size below the given bucket prefixes in the destination"""
+    for this_prefix in prefixes:
+        for this_root, this_dirs, this_files in os.walk(os.path.join(dest_dir, this_prefix)):
+            for this_file in this_files:
+                file_path = os.path.join(this_root, this_file)
+                try:
+                    if os.path.getsize(file_path) >= minimum_size:
+                        yield file_path
+                except OSError:
+                    continue
+
+
+def prune_store(store_dir):
+    """Remove store objects that no file links to any more (a hardlink count of 1 means only the store has it)"""
+    removed = 0
+    if not os.path.isdir(store_dir):
+        return removed
+    for this_root, this_dirs, this_files in os.walk(store_dir):
+        for this_file in this_files:
+            object_path = os.path.join(this_root, this_file)
+            if os.stat(object_path).st_nlink == 1:
+                os.remove(object_path)
+                removed += 1
+    return removed
+
+
+def dedup_tree(dest_dir, prefixes=None, link_mode='reflink', minimum_size=DEFAULT_MINIMUM_SIZE, workers=8, cache_path=None, log=print):
+    """Replace duplicate files below the given bucket prefixes with links into the content store.
+
+    Returns a dict with how many files were scanned, how many duplicates were linked, how many bytes that saved, and
+    how many duplicates stayed copies because the filesystem cannot reflink.
+    """
+    store_dir = get_content_store_dir(dest_dir)
+    counts = {'scanned': 0, 'linked': 0, 'already_linked': 0, 'bytes_saved': 0, 'copied': 0, 'failed': 0}
+    hash_cache = HashCache(cache_path, workers)
+
+    try:
+        for file_path, stat, digest in hash_cache.hash_files(iter_files(dest_dir, prefixes or DATA_DIRECTORIES, minimum_size)):
+            counts['scanned'] += 1
+            if digest is None:
+                counts['failed'] += 1
+                continue
+
+            object_path = store_path(store_dir, digest)
+            if not os.path.exists(object_path):
+                #The first copy we see becomes the stored one
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.link(file_path, object_path)
+                continue
+
+            object_stat = os.stat(object_path)
+            if os.path.samestat(stat, object_stat):
+                counts['already_linked'] += 1
+                continue
+            if object_stat.st_size != stat.st_size:
+                log(f"Skipping {file_path}: it has the same hash as {object_path} but a different size")
+                counts['failed'] += 1
+                continue
+
+            try:
+                linked = replace_with_link(object_path, file_path, link_mode)
+            except OSError as error:
+                log(f"Could not link {file_path}: {error}")
+                counts['failed'] += 1
+                continue
+            if not linked:
+                if not counts['copied']:
+                    log(f"{dest_dir} does not support reflinks, so duplicates stay separate copies (hardlinks work everywhere, but see mirrulations_dedup.py)")
+                counts['copied'] += 1
+                continue
+
+            #A hardlinked file now has the stored copy's mtime, so remember its hash under the new one
+            hash_cache.store(file_path, os.stat(file_path), 'sha256', digest)
+            counts['linked'] += 1
+            counts['bytes_saved'] += stat.st_size
+    finally:
+        hash_cache.close()
+
+    #Pruning walks the whole store, so it is only worth doing on a pass over the whole destination
+    counts['pruned'] = prune_store(store_dir) if not prefixes else 0
+    return counts
+
+
+def print_dedup_summary(counts):
+    print(f"Dedup: scanned {counts['scanned']} files, linked {counts['linked']} duplicates ({counts['already_linked']} files were already in the store), "
+          f"saved {counts['bytes_saved'] / 1024 ** 3:.2f} GiB, {counts['copied']} left as copies, {counts['failed']} failed")
+
+
+@click.command()
+@click.option('--prefix', '-p', default='', help="Only dedup below these bucket prefixes, e.g. raw-data/CMS/ (separated by commas, default is everything)")
+@click.option('--link-mode', default='reflink', type=click.Choice(LINK_MODES), help="How duplicates are replaced (default is reflink, which leaves them as copies where the filesystem cannot reflink). Hardlinks share their mtime, which makes later downloads without --delta check and touch every duplicate")
+@click.option('--min-size', default=DEFAULT_MINIMUM_SIZE, type=int, help=f"Ignore files smaller than this many bytes (default is {DEFAULT_MINIMUM_SIZE})")
+@click.option('--workers', default=8, type=int, help="How many files to hash at the same time (default is 8)")
+def main(prefix, link_mode, min_size, workers):
+    """Replace duplicate files in MIRRULATIONS_DESTINATION_PATH with links to a single stored copy"""
+    prefixes = [prefix.strip() for prefix in prefix.split(',') if prefix.strip()]
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    if not dest_dir or not os.path.exists(dest_dir):
+        print(f"Error: {dest_dir} does not exist ")
+        exit()
+
+    start_time = time.time()
+    counts = dedup_tree(dest_dir, prefixes, link_mode, min_size, workers)
+    elapsed_time = round(time.time() - start_time)
+    print_dedup_summary(counts)
+    print(f"Took {datetime.timedelta(seconds = elapsed_time)}")
+
+
+if __name__ == "__main__":
+    main()
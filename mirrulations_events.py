@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import errno
+import ctypes
+import socket
+import shutil
+import threading
+
+from mirrulations_config import parse_bucket_path
+from mirrulations_archive import iter_prefix_dockets
+
+#Publishes what the downloader finishes while it runs, so indexing and extraction can work alongside a long transfer:
+#    file_completed        rclone has written a file (read from rclone's JSON log as it is written)
+#    docket_completed      a job has copied every file it lists for a docket, or has finished having copied files into
+#                          it (with staging, the docket is in place by then)
+#    docket_text_complete  with --text-first, all of a docket's text has arrived
+#    run_finished          the whole run is over
+#Each event is a dict with at least 'event' and 'time', and goes to any mix of a JSON-lines file, a Unix socket that
+#consumers connect to, and Python callbacks.
+
+#rclone logs one of these for every file it copies, when the log level is INFO
+RCLONE_COPIED_MESSAGE = 'Copied'
+RCLONE_EVENT_FLAGS = " --log-level INFO "
+
+#With staging, rclone copies into {MIRRULATIONS_DESTINATION_PATH}/.staging/{job}/ instead, comparing against the
+#destination with --compare-dest so only new and changed files are staged. Each docket is moved into place when its job
+#has finished. A job that fails leaves its staging directory behind, and the next run carries on from it.
+STAGING_DIR_NAME = '.staging'
+
+#renameat2() (Linux) and renamex_np() (macOS) swap two paths in one step
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+RENAME_SWAP = 2
+
+
+class EventPublisher:
+    """Sends events to a JSON-lines file, the clients of a Unix socket, and callbacks"""
+
+    def __init__(self, events_file='', events_socket='', callbacks=None):
+        self.lock = threading.Lock()
+        self.callbacks = list(callbacks or [])
+        self.file_handle = open(events_file, 'a') if events_file else None
+        self.server = None
+        self.clients = []
+        if events_socket:
+            if os.path.exists(events_socket):
+                os.remove(events_socket)
+            self.events_socket = events_socket
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(events_socket)
+            self.server.listen()
+            threading.Thread(target=self._accept_clients, daemon=True).start()
+
+    def _accept_clients(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.clients.append(client)
+
+    def publish(self, event, **details):
+        record = {'event': event, 'time': time.time(), **details}
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        with self.lock:
+            if self.file_handle:
+                self.file_handle.write(line.decode('utf-8'))
+                self.file_handle.flush()
+            for this_client in list(self.clients):
+                try:
+                    this_client.sendall(line)
+                except OSError:
+                    #The consumer went away, the run carries on without it
+                    self.clients.remove(this_client)
+                    this_client.close()
+        #Outside the lock, so a slow callback only holds up the thread that published
+        for this_callback in self.callbacks:
+            this_callback(record)
+
+    def close(self):
+        with self.lock:
+            if self.file_handle:
+                self.file_handle.close()
+            for this_client in self.clients:
+                this_client.close()
+            self.clients = []
+        if self.server:
+            self.server.close()
+            os.remove(self.events_socket)
+
+
+def parse_copied_line(line):
+    """The object path of an rclone JSON log line about a copied file, or None for any other line"""
+    if RCLONE_COPIED_MESSAGE not in line:
+        return None
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if not str(entry.get('msg', '')).startswith(RCLONE_COPIED_MESSAGE) or not entry.get('object'):
+        return None
+    return entry['object']
+
+
+class LogTailer:
+    """Follows the rclone logs of the running jobs on a background thread and publishes a file_completed event for
+    every file they copy. drain() reads whatever is left of a job's log once it has finished.
+
+    A job with a list of files (--use-manifest, --delta, --files-from, sampling) publishes docket_completed for a
+    docket as soon as every file it lists there has been copied, promoting the docket first when the job is staged.
+    finish_job() does the same for the rest of the dockets a job copied into, once the job has succeeded.
+    """
+
+    def __init__(self, jobs, publisher, dest_dir, interval=1):
+        self.jobs = jobs
+        self.publisher = publisher
+        self.dest_dir = dest_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            for this_job in self.jobs:
+                if 'started_at' in this_job and 'final_stats' not in this_job:
+                    self.drain(this_job)
+
+    def drain(self, job):
+        """Publish the files a job's log reports since the last time we looked, and return the bucket paths"""
+        events = []
+        with self.lock:
+            offset = job.get('tail_offset', job.get('log_offset', 0))
+            if not os.path.isfile(job['log_file']):
+                return []
+            with open(job['log_file'], 'rb') as file_handle:
+                file_handle.seek(offset)
+                data = file_handle.read()
+            #Only whole lines, rclone may be half way through writing the last one
+            data = data[:data.rfind(b"\n") + 1]
+            job['tail_offset'] = offset + len(data)
+
+            if 'files' in job and 'docket_files' not in job:
+                job['docket_files'] = {}
+                for this_path in job['files']:
+                    parsed = parse_bucket_path(job['prefix'] + this_path)
+                    if parsed['docket']:
+                        job['docket_files'].setdefault((parsed['agency'], parsed['docket']), set()).add(job['prefix'] + this_path)
+
+            paths = []
+            for this_line in data.decode('utf-8', errors='replace').splitlines():
+                object_path = parse_copied_line(this_line)
+                if object_path is None:
+                    continue
+                bucket_path = job['prefix'] + object_path
+                parsed = parse_bucket_path(bucket_path)
+                paths.append(bucket_path)
+                events.append(('file_completed', {'path': bucket_path, 'agency': parsed['agency'], 'docket': parsed['docket'], 'job': job['name']}))
+                if not parsed['docket']:
+                    continue
+                this_docket = (parsed['agency'], parsed['docket'])
+                job.setdefault('copied_dockets', set()).add(this_docket)
+                remaining = job.get('docket_files', {}).get(this_docket)
+                if remaining is not None:
+                    remaining.discard(bucket_path)
+                    if not remaining:
+                        events.append(self._complete_docket(job, *this_docket))
+
+        for event, details in events:
+            self.publisher.publish(event, **details)
+        return paths
+
+    def finish_job(self, job):
+        """Publish docket_completed for every docket a successful job copied into that was not completed yet"""
+        with self.lock:
+            events = [self._complete_docket(job, agency, docket_id) for agency, docket_id in sorted(job.get('copied_dockets', set()))
+                      if (agency, docket_id) not in job.get('completed_dockets', set())]
+            if 'staging_dir' in job:
+                #Dockets that only had unchanged files copied are in staging too
+                promote_staged_job(self.dest_dir, job)
+        for event, details in events:
+            self.publisher.publish(event, **details)
+
+    def _complete_docket(self, job, agency, docket_id):
+        job.setdefault('completed_dockets', set()).add((agency, docket_id))
+        if 'staging_dir' in job:
+            directory = promote_staged_docket(self.dest_dir, job, agency, docket_id)
+        else:
+            directory = os.path.join(self.dest_dir, job['prefix'].split('/')[0], agency, docket_id)
+        return 'docket_completed', {'agency': agency, 'docket': docket_id, 'directory': directory, 'job': job['name'], 'section': job.get('section', 'all')}
+
+
+def get_staging_dir(dest_dir, job):
+    """Each job stages into its own directory, so jobs that share a prefix (like the halves of --text-first) never collide"""
+    staging_name = job['name'].strip('/').replace('/', '_').replace(':', '_')
+    return os.path.join(dest_dir, STAGING_DIR_NAME, staging_name)
+
+
+def exchange_paths(first_path, second_path):
+    """Swap two directories in one atomic step. Returns False, having changed nothing, where the system cannot"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    if hasattr(libc, 'renameat2'):
+        result = libc.renameat2(AT_FDCWD, os.fsencode(first_path), AT_FDCWD, os.fsencode(second_path), RENAME_EXCHANGE)
+    elif hasattr(libc, 'renamex_np'):
+        result = libc.renamex_np(os.fsencode(first_path), os.fsencode(second_path), RENAME_SWAP)
+    else:
+        return False
+    if result != 0:
+        error = ctypes.get_errno()
+        #An old kernel or a filesystem that cannot swap
+        if error in [errno.EINVAL, errno.ENOSYS, errno.ENOTSUP]:
+            return False
+        raise OSError(error, os.strerror(error), first_path)
+    return True
+
+
+def promote_docket(staged_dir, final_dir):
+    """Move a staged docket into place so that readers see either the old docket or the new one, never half of it.
+
+    A new docket is a single rename. For a docket that is already there, the old one is cloned with hardlinks, the
+    staged files are laid over the clone, and the clone and the docket swap places in one atomic rename. Only where
+    the system cannot swap is it two renames, with the docket missing for a moment in between.
+    """
+    if not os.path.exists(final_dir):
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        os.rename(staged_dir, final_dir)
+        return
+
+    work_dir = final_dir + '.promoting'
+    old_dir = final_dir + '.old'
+    for this_leftover in [work_dir, old_dir]:
+        if os.path.exists(this_leftover):
+            shutil.rmtree(this_leftover)
+
+    shutil.copytree(final_dir, work_dir, copy_function=os.link)
+    for this_root, this_dirs, this_files in os.walk(staged_dir):
+        target_root = os.path.join(work_dir, os.path.relpath(this_root, staged_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for this_file in this_files:
+            os.replace(os.path.join(this_root, this_file), os.path.join(target_root, this_file))
+
+    if exchange_paths(work_dir, final_dir):
+        #The old docket is where the clone was
+        shutil.rmtree(work_dir)
+    else:
+        os.rename(final_dir, old_dir)
+        os.rename(work_dir, final_dir)
+        shutil.rmtree(old_dir)
+    shutil.rmtree(staged_dir)
+
+
+def promote_staged_docket(dest_dir, job, agency, docket_id):
+    """Promote one docket a job staged, and return its final directory"""
+    docket_path = os.path.join(job['prefix'].split('/')[0], agency, docket_id)
+    final_dir = os.path.join(dest_dir, docket_path)
+    staged_dir = os.path.join(get_staging_dir(dest_dir, job), docket_path)
+    if os.path.isdir(staged_dir):
+        promote_docket(staged_dir, final_dir)
+    return final_dir
+
+
+def promote_staged_job(dest_dir, job):
+    """Promote every docket a finished job staged, and return their (agency, docket id, final directory)"""
+    staging_dir = get_staging_dir(dest_dir, job)
+    promoted = []
+    for agency, docket_id, staged_dir in list(iter_prefix_dockets(staging_dir, job['prefix'])):
+        promoted.append((agency, docket_id, promote_staged_docket(dest_dir, job, agency, docket_id)))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return promoted
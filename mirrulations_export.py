@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import datetime
+import concurrent.futures
+import click
+
+from mirrulations_config import docket_year
+from mirrulations_index import iter_docket_directories, read_json_record
+import mirrulations_archive
+
+#Exports the downloaded comment and document JSON to Parquet, so analysts can load whole agencies into a dataframe
+#instead of parsing millions of JSON files one at a time.
+#
+#The output is a hive partitioned dataset per record kind, split the way docket ids already are:
+#    {output_dir}/comments/agency={agency}/year={year}/{docketID}.parquet
+#    {output_dir}/documents/agency={agency}/year={year}/{docketID}.parquet
+#Each docket is exported by its own worker process and streamed out in row groups, so memory stays bounded however
+#big a docket is. A rerun only rewrites the files of dockets whose JSON changed since the last export.
+#
+#pyarrow is only needed here, so it is imported lazily and is not in requirements.txt.
+
+#(column name, pyarrow type name) of each dataset
+COMMENT_COLUMNS = [
+    ('comment_id', 'string'),
+    ('docket_id', 'string'),
+    ('agency_id', 'string'),
+    ('document_id', 'string'),
+    ('document_type', 'string'),
+    ('posted_date', 'string'),
+    ('modify_date', 'string'),
+    ('title', 'string'),
+    ('organization', 'string'),
+    ('comment', 'string'),
+    ('attachment_count', 'int64'),
+]
+
+DOCUMENT_COLUMNS = [
+    ('document_id', 'string'),
+    ('docket_id', 'string'),
+    ('agency_id', 'string'),
+    ('document_type', 'string'),
+    ('posted_date', 'string'),
+    ('modify_date', 'string'),
+    ('title', 'string'),
+    ('fr_doc_num', 'string'),
+    ('comment_start_date', 'string'),
+    ('comment_end_date', 'string'),
+]
+
+#How many rows we hold in memory before writing them out as a row group
+BATCH_ROWS = 10000
+
+#Records which dockets were exported and what their JSON looked like at the time.
+#The leading underscore makes pyarrow's dataset reader ignore it.
+EXPORT_STATE_FILE_NAME = '_export_state.json'
+
+
+def pyarrow_available():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def comment_row(data, included):
+    attributes = data.get('attributes') or {}
+    attachment_references = ((data.get('relationships') or {}).get('attachments') or {}).get('data') or []
+    return {
+        'comment_id': data.get('id'),
+        'docket_id': attributes.get('docketId'),
+        'agency_id': attributes.get('agencyId'),
+        'document_id': attributes.get('commentOnDocumentId'),
+        'document_type': attributes.get('documentType'),
+        'posted_date': attributes.get('postedDate'),
+        'modify_date': attributes.get('modifyDate'),
+        'title': attributes.get('title'),
+        'organization': attributes.get('organization'),
+        'comment': attributes.get('comment'),
+        'attachment_count': len(attachment_references) or len([this_item for this_item in included if this_item.get('type') == 'attachments']),
+    }
+
+
+def document_row(data, included):
+    attributes = data.get('attributes') or {}
+    return {
+        'document_id': data.get('id'),
+        'docket_id': attributes.get('docketId'),
+        'agency_id': attributes.get('agencyId'),
+        'document_type': attributes.get('documentType'),
+        'posted_date': attributes.get('postedDate'),
+        'modify_date': attributes.get('modifyDate'),
+        'title': attributes.get('title'),
+        'fr_doc_num': attributes.get('frDocNum'),
+        'comment_start_date': attributes.get('commentStartDate'),
+        'comment_end_date': attributes.get('commentEndDate'),
+    }
+
+
+#Record kind (the directory name below text-{docketID}) -> (columns, row function)
+EXPORTED_KINDS = {
+    'comments': (COMMENT_COLUMNS, comment_row),
+    'documents': (DOCUMENT_COLUMNS, document_row),
+}
+
+
+def list_json_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(this_entry.path for this_entry in os.scandir(directory) if this_entry.name.endswith('.json') and this_entry.is_file())
+
+
+def docket_signature(text_dir):
+    """A cheap fingerprint of a docket's comment and document JSON: file count, total size and newest mtime.
+
+    Adding, removing or rewriting a file changes it, and it only needs a stat per file rather than a parse.
+    """
+    file_count = 0
+    total_size = 0
+    newest_mtime_ns = 0
+    for this_kind in EXPORTED_KINDS:
+        for this_path in list_json_files(os.path.join(text_dir, this_kind)):
+            stat = os.stat(this_path)
+            file_count += 1
+            total_size += stat.st_size
+            newest_mtime_ns = max(newest_mtime_ns, stat.st_mtime_ns)
+    return [file_count, total_size, newest_mtime_ns]
+
+
+def iter_rows(file_paths, row_function, failures):
+    """Parse files one at a time and yield their rows, appending the paths we could not parse to failures"""
+    for this_path in file_paths:
+        try:
+            data, included = read_json_record(this_path)
+        except (ValueError, OSError):
+            failures.append(this_path)
+            continue
+        yield row_function(data, included)
+
+
+def write_parquet_file(rows, columns, path, batch_rows=BATCH_ROWS):
+    """Stream rows into a Parquet file, BATCH_ROWS at a time, and return how many were written.
+
+    The file is written to the side and renamed into place, so readers never see half of it.
+    If there are no rows, any existing file is removed instead.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in columns])
+    temporary_path = path + '.tmp'
+    writer = None
+    row_count = 0
+    batch = []
+
+    def write_batch():
+        nonlocal writer
+        if writer is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pyarrow.parquet.ParquetWriter(temporary_path, schema, compression='zstd')
+        writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+
+    try:
+        for this_row in rows:
+            batch.append(this_row)
+            if len(batch) >= batch_rows:
+                write_batch()
+                row_count += len(batch)
+                batch = []
+        if batch:
+            write_batch()
+            row_count += len(batch)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(temporary_path)
+        raise
+
+    if writer is not None:
+        writer.close()
+        os.replace(temporary_path, path)
+    elif os.path.exists(path):
+        os.remove(path)
+    return row_count
+
+
+def partition_path(output_dir, kind, agency, docket_id):
+    year = docket_year(docket_id) or 'unknown'
+    return os.path.join(output_dir, kind, f"agency={agency}", f"year={year}", f"{docket_id}.parquet")
+
+
+def export_docket(task):
+    """Export one docket's comments and documents (runs in a worker process)"""
+    signature = docket_signature(task['text_dir'])
+    result = {'docket_id': task['docket_id'], 'agency': task['agency'], 'signature': signature,
+              'exported': False, 'rows': {}, 'failures': []}
+    if signature == task['previous_signature']:
+        return result
+
+    for this_kind, (columns, row_function) in EXPORTED_KINDS.items():
+        file_paths = list_json_files(os.path.join(task['text_dir'], this_kind))
+        rows = iter_rows(file_paths, row_function, result['failures'])
+        result['rows'][this_kind] = write_parquet_file(rows, columns, partition_path(task['output_dir'], this_kind, task['agency'], task['docket_id']))
+    result['exported'] = True
+    return result
+
+
+def load_export_state(output_dir):
+    state_file = os.path.join(output_dir, EXPORT_STATE_FILE_NAME)
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as file_handle:
+        return json.load(file_handle)
+
+
+def save_export_state(output_dir, export_state):
+    state_file = os.path.join(output_dir, EXPORT_STATE_FILE_NAME)
+    with open(state_file + '.tmp', 'w') as file_handle:
+        json.dump(export_state, file_handle)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def remove_docket_files(output_dir, agency, docket_id):
+    for this_kind in EXPORTED_KINDS:
+        this_path = partition_path(output_dir, this_kind, agency, docket_id)
+        if os.path.exists(this_path):
+            os.remove(this_path)
+
+
+def run_export(data_root, output_dir, agency_list=None, docket_list=None, workers=1, log=print, archive_dir=None):
+    """Bring the Parquet datasets in output_dir up to date with the JSON under data_root.
+
+    Dockets that --pack moved into archive_dir (the destination's archive directory by default) keep their export.
+    Returns a dict with how many dockets were exported, unchanged and removed, and the files that failed to parse.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    archive_dir = archive_dir or mirrulations_archive.get_archive_dir(data_root)
+    export_state = load_export_state(output_dir)
+    counts = {'exported': 0, 'unchanged': 0, 'removed': 0, 'failures': []}
+
+    #Dockets we exported before that are neither downloaded nor packed any more
+    for docket_id, docket_state in list(export_state.items()):
+        if not os.path.isdir(os.path.join(data_root, 'raw-data', docket_state['agency'], docket_id)) and \
+                not os.path.isfile(mirrulations_archive.archive_path(archive_dir, docket_state['agency'], docket_id)):
+            remove_docket_files(output_dir, docket_state['agency'], docket_id)
+            del export_state[docket_id]
+            counts['removed'] += 1
+
+    tasks = [{'agency': agency, 'docket_id': docket_id, 'text_dir': text_dir, 'output_dir': output_dir,
+              'previous_signature': (export_state.get(docket_id) or {}).get('signature')}
+             for agency, docket_id, text_dir in iter_docket_directories(data_root, agency_list, docket_list)]
+
+    def record_result(result):
+        if not result['exported']:
+            counts['unchanged'] += 1
+            return
+        counts['exported'] += 1
+        counts['failures'] += result['failures']
+        #A docket with files we could not parse is exported again next time, in case they were being written
+        signature = None if result['failures'] else result['signature']
+        export_state[result['docket_id']] = {'agency': result['agency'], 'signature': signature}
+        rows = ", ".join(f"{count} {kind}" for kind, count in result['rows'].items())
+        log(f"Exported {result['docket_id']} ({rows})")
+        #Save as we go, so an interrupted export does not redo the dockets it finished
+        if counts['exported'] % 100 == 0:
+            save_export_state(output_dir, export_state)
+
+    try:
+        if workers <= 1:
+            for this_task in tasks:
+                record_result(export_docket(this_task))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for this_result in executor.map(export_docket, tasks):
+                    record_result(this_result)
+    finally:
+        save_export_state(output_dir, export_state)
+
+    return counts
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Only export these agencies (separated by commas).")
+@click.option('--docket', '-d', default='', help="Only export these dockets (separated by commas).")
+@click.option('--output-dir', required=True, help="Where to write the Parquet datasets")
+@click.option('--workers', default=os.cpu_count() or 1, type=int, help="How many worker processes parse JSON at once (default is the number of CPUs)")
+def main(agency, docket, output_dir, workers):
+    """Export the comment and document JSON in MIRRULATIONS_DESTINATION_PATH to Parquet, partitioned by agency and year"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
+    docket_list = [docket.strip() for docket in docket.split(',') if docket.strip()]
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    if not dest_dir or not os.path.exists(dest_dir):
+        print(f"Error: {dest_dir} does not exist ")
+        exit()
+
+    if not pyarrow_available():
+        print("Error: exporting to Parquet needs pyarrow. Install it with: pip install pyarrow")
+        exit()
+
+    start_time = time.time()
+    counts = run_export(dest_dir, output_dir, agency_list, docket_list, workers)
+    elapsed_time = round(time.time() - start_time)
+
+    for this_path in counts['failures']:
+        print(f"Could not parse {this_path}")
+    print(f"Exported {counts['exported']} dockets, {counts['unchanged']} unchanged, {counts['removed']} removed ( took {datetime.timedelta(seconds = elapsed_time)} )")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import hashlib
+import sqlite3
+import concurrent.futures
+
+from mirrulations_config import get_state_dir
+
+#A persistent cache of file hashes, so that dedup and verify only rehash files that changed since they were last
+#hashed. A cached digest is trusted for as long as the file's size and mtime are the same.
+
+HASH_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT,
+    algorithm TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    digest TEXT,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+#How many files we look up and hash at a time, committing the new hashes after each batch
+BATCH_SIZE = 1000
+
+
+def get_hash_cache_path():
+    return os.path.join(get_state_dir(), 'hash_cache.sqlite')
+
+
+def hash_file(path, algorithm='sha256'):
+    """Hash a file in chunks, so large attachments are never read into memory at once"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file_handle:
+        for this_chunk in iter(lambda: file_handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(this_chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """Hashes files on a thread pool and remembers the results between runs"""
+
+    def __init__(self, cache_path=None, workers=8):
+        self.connection = sqlite3.connect(cache_path or get_hash_cache_path())
+        self.connection.executescript(HASH_CACHE_SCHEMA)
+        self.workers = workers
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def lookup(self, path, stat, algorithm):
+        row = self.connection.execute("SELECT size, mtime_ns, digest FROM file_hashes WHERE path = ? AND algorithm = ?",
+                                      (os.path.abspath(path), algorithm)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    def store(self, path, stat, algorithm, digest):
+        self.connection.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+                                (os.path.abspath(path), algorithm, stat.st_size, stat.st_mtime_ns, digest))
+
+    def hash_files(self, paths, algorithm='sha256'):
+        """Yield (path, stat, digest) for every path, hashing only the ones the cache does not already know.
+
+        Paths are handled BATCH_SIZE at a time, so memory stays flat however many files there are.
+        Files that cannot be read are yielded with a digest of None.
+        """
+        batch = []
+        for this_path in paths:
+            batch.append(this_path)
+            if len(batch) >= BATCH_SIZE:
+                yield from self._hash_batch(batch, algorithm)
+                batch = []
+        if batch:
+            yield from self._hash_batch(batch, algorithm)
+
+    def _hash_batch(self, paths, algorithm):
+        uncached = []
+        for this_path in paths:
+            try:
+                stat = os.stat(this_path)
+            except OSError:
+                yield this_path, None, None
+                continue
+            digest = self.lookup(this_path, stat, algorithm)
+            if digest is None:
+                uncached.append((this_path, stat))
+            else:
+                yield this_path, stat, digest
+
+        def hash_one(item):
+            path, stat = item
+            try:
+                return path, stat, hash_file(path, algorithm)
+            except OSError:
+                return path, stat, None
+
+        #hashlib releases the GIL while it hashes, so threads are enough to keep several cores and disks busy
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path, stat, digest in executor.map(hash_one, uncached):
+                if digest is not None:
+                    self.store(path, stat, algorithm, digest)
+                yield path, stat, digest
+        self.connection.commit()
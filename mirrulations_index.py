@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import html.parser
+import click
+
+from mirrulations_config import get_state_dir
+
+#A comment level index of the data we have already downloaded, so that downstream jobs can look things up
+#in a SQLite database instead of walking millions of small JSON files.
+#
+#Only raw-data/{agency}/{docketID}/text-{docketID}/{comments,documents,docket} is read. Each run only parses files
+#that are new or changed since the last one, and skips directories whose modification time has not changed
+#(rclone writes each file under a temporary name and renames it into place, which updates the directory).
+#
+#The same runs keep a SQLite FTS5 full-text index of the comment bodies, the documents' .htm files and the text
+#extracted from the attachments under derived-data/{agency}/{docketID}/mirrulations/extracted_txt/comments_extracted_text,
+#which search_text() (and mirrulations_search.py) query.
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dockets (
+    docket_id TEXT PRIMARY KEY,
+    agency TEXT,
+    title TEXT,
+    docket_type TEXT,
+    modify_date TEXT,
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS documents (
+    document_id TEXT PRIMARY KEY,
+    docket_id TEXT,
+    agency TEXT,
+    document_type TEXT,
+    posted_date TEXT,
+    title TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS documents_by_docket ON documents (docket_id);
+CREATE TABLE IF NOT EXISTS comments (
+    comment_id TEXT PRIMARY KEY,
+    docket_id TEXT,
+    agency TEXT,
+    document_id TEXT,
+    posted_date TEXT,
+    title TEXT,
+    attachment_count INTEGER,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_by_docket ON comments (docket_id, posted_date);
+CREATE INDEX IF NOT EXISTS comments_by_posted_date ON comments (posted_date);
+CREATE TABLE IF NOT EXISTS comment_attachments (
+    comment_id TEXT,
+    attachment_id TEXT,
+    title TEXT,
+    file_format TEXT,
+    file_url TEXT,
+    PRIMARY KEY (comment_id, attachment_id, file_format)
+);
+CREATE TABLE IF NOT EXISTS indexed_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS indexed_dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS search_sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    kind TEXT,
+    record_id TEXT,
+    docket_id TEXT,
+    agency TEXT
+);
+"""
+
+#Only created when the index is opened for full-text search, so the tables above work with a SQLite without FTS5
+FULL_TEXT_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5 (title, body);"
+
+#The directories below text-{docketID} that we index, and the kind of record their JSON files hold
+TEXT_DIRECTORIES = ['comments', 'documents', 'docket']
+
+#Below derived-data/{agency}/{docketID}, one directory for each tool that extracted text from the attachments (pdfminer...)
+EXTRACTED_TEXT_DIR = os.path.join('mirrulations', 'extracted_txt', 'comments_extracted_text')
+
+#How many files we parse between commits
+BATCH_SIZE = 1000
+
+
+def get_index_path():
+    return os.path.join(get_state_dir(), 'comments_index.sqlite')
+
+
+class IndexConnection(sqlite3.Connection):
+    """A connection to the index that remembers whether it was opened with full-text search"""
+    full_text = False
+
+
+def open_index(index_path=None, full_text=True):
+    """Open (creating if needed) the index database. Raises RuntimeError when full_text is asked for and SQLite has no FTS5.
+
+    Without full_text the index holds only the metadata tables, and add_search_text() leaves the text out.
+    """
+    connection = sqlite3.connect(index_path or get_index_path(), factory=IndexConnection)
+    connection.executescript(INDEX_SCHEMA)
+    if full_text:
+        try:
+            connection.executescript(FULL_TEXT_SCHEMA)
+        except sqlite3.OperationalError as error:
+            connection.close()
+            raise RuntimeError(f"the index needs SQLite with FTS5 for full-text search, which this Python does not have ({error})")
+        connection.full_text = True
+    return connection
+
+
+class TextExtractor(html.parser.HTMLParser):
+    """Collects the text of an HTML page, leaving out scripts and styles"""
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attributes):
+        if tag in ['script', 'style']:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in ['script', 'style'] and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def html_to_text(markup):
+    """The text of an HTML page or fragment, with the whitespace squeezed"""
+    extractor = TextExtractor()
+    extractor.feed(markup or '')
+    extractor.close()
+    return ' '.join(' '.join(extractor.parts).split())
+
+
+def add_search_text(connection, relative_path, kind, record_id, docket_id, agency, title, body):
+    """Put the text of a file into the full-text index, replacing what it held for that file before. Does nothing
+    when the index was opened without full_text"""
+    if not connection.full_text:
+        return
+    row = connection.execute("SELECT id FROM search_sources WHERE path = ?", (relative_path,)).fetchone()
+    if row:
+        connection.execute("DELETE FROM search_text WHERE rowid = ?", row)
+    cursor = connection.execute("INSERT OR REPLACE INTO search_sources VALUES (?, ?, ?, ?, ?, ?)",
+                                (row[0] if row else None, relative_path, kind, record_id, docket_id, agency))
+    connection.execute("INSERT INTO search_text (rowid, title, body) VALUES (?, ?, ?)", (cursor.lastrowid, title or '', body or ''))
+
+
+def read_json_record(file_path):
+    """Read a regulations.gov API record (as mirrulations saves them) and return its 'data' and 'included' parts"""
+    with open(file_path, encoding='utf-8') as file_handle:
+        record = json.load(file_handle)
+    return record.get('data') or {}, record.get('included') or []
+
+
+def index_comment(connection, file_path, relative_path):
+    data, included = read_json_record(file_path)
+    attributes = data.get('attributes') or {}
+    comment_id = data.get('id') or os.path.splitext(os.path.basename(file_path))[0]
+
+    attachment_rows = []
+    for this_attachment in included:
+        if this_attachment.get('type') != 'attachments':
+            continue
+        attachment_attributes = this_attachment.get('attributes') or {}
+        for this_format in attachment_attributes.get('fileFormats') or []:
+            attachment_rows.append((comment_id, this_attachment.get('id'), attachment_attributes.get('title'),
+                                    this_format.get('format'), this_format.get('fileUrl')))
+
+    attachment_references = ((data.get('relationships') or {}).get('attachments') or {}).get('data') or []
+
+    connection.execute("INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+        comment_id, attributes.get('docketId'), attributes.get('agencyId'), attributes.get('commentOnDocumentId'),
+        attributes.get('postedDate'), attributes.get('title'), len(attachment_references) or len({row[1] for row in attachment_rows}),
+        relative_path))
+    connection.execute("DELETE FROM comment_attachments WHERE comment_id = ?", (comment_id,))
+    connection.executemany("INSERT OR REPLACE INTO comment_attachments VALUES (?, ?, ?, ?, ?)", attachment_rows)
+    add_search_text(connection, relative_path, 'comment', comment_id, attributes.get('docketId'), attributes.get('agencyId'),
+                    attributes.get('title'), html_to_text(attributes.get('comment')))
+
+
+def index_document(connection, file_path, relative_path):
+    data, included = read_json_record(file_path)
+    attributes = data.get('attributes') or {}
+    document_id = data.get('id') or os.path.splitext(os.path.basename(file_path))[0]
+
+    connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)", (
+        document_id, attributes.get('docketId'), attributes.get('agencyId'), attributes.get('documentType'),
+        attributes.get('postedDate'), attributes.get('title'), relative_path))
+
+
+def index_docket(connection, file_path, relative_path):
+    data, included = read_json_record(file_path)
+    attributes = data.get('attributes') or {}
+    docket_id = data.get('id') or os.path.splitext(os.path.basename(file_path))[0]
+
+    connection.execute("INSERT OR REPLACE INTO dockets VALUES (?, ?, ?, ?, ?, ?)", (
+        docket_id, attributes.get('agencyId'), attributes.get('title'), attributes.get('docketType'),
+        attributes.get('modifyDate'), relative_path))
+
+
+def path_docket(relative_path):
+    """The agency and docket id of a path below raw-data or derived-data"""
+    parts = relative_path.split(os.sep)
+    return parts[1], parts[2]
+
+
+def index_document_text(connection, file_path, relative_path):
+    """A document's content, which regulations.gov serves as (almost) HTML in {documentID}_content.htm"""
+    with open(file_path, encoding='utf-8', errors='replace') as file_handle:
+        body = html_to_text(file_handle.read())
+    agency, docket_id = path_docket(relative_path)
+    document_id = os.path.splitext(os.path.basename(file_path))[0].replace('_content', '')
+    add_search_text(connection, relative_path, 'document', document_id, docket_id, agency, '', body)
+
+
+def index_extracted_text(connection, file_path, relative_path):
+    """The text extracted from a comment attachment, named {commentID}_attachment_{n}.txt"""
+    with open(file_path, encoding='utf-8', errors='replace') as file_handle:
+        body = file_handle.read()
+    agency, docket_id = path_docket(relative_path)
+    attachment_id = os.path.splitext(os.path.basename(file_path))[0]
+    add_search_text(connection, relative_path, 'attachment', attachment_id, docket_id, agency, '', body)
+
+
+#(kind of directory, file extension) -> what reads that kind of file into the index
+FILE_INDEXERS = {
+    ('comments', '.json'): index_comment,
+    ('documents', '.json'): index_document,
+    ('documents', '.htm'): index_document_text,
+    ('docket', '.json'): index_docket,
+    ('extracted_text', '.txt'): index_extracted_text,
+}
+
+
+def iter_docket_directories(data_root, agency_list=None, docket_list=None):
+    """Yield (agency, docket id, text-{docketID} directory) for every docket below raw-data.
+
+    Each level of the layout is a known directory, so we only scandir our way down rather than walking every file.
+    """
+    raw_data_dir = os.path.join(data_root, 'raw-data')
+    if not os.path.isdir(raw_data_dir):
+        return
+
+    for agency_entry in sorted(os.scandir(raw_data_dir), key=lambda entry: entry.name):
+        if not agency_entry.is_dir() or (agency_list and agency_entry.name not in agency_list):
+            continue
+        for docket_entry in sorted(os.scandir(agency_entry.path), key=lambda entry: entry.name):
+            if not docket_entry.is_dir() or (docket_list and docket_entry.name not in docket_list):
+                continue
+            yield agency_entry.name, docket_entry.name, os.path.join(docket_entry.path, f"text-{docket_entry.name}")
+
+
+def iter_text_directories(data_root, agency_list=None, docket_list=None):
+    """Yield (kind, directory path) for every directory of files we index.
+
+    These are the comments/documents/docket directories below raw-data, and the directories of text extracted from
+    the attachments below derived-data, whose kind is 'extracted_text'.
+    """
+    for agency, docket_id, text_dir in iter_docket_directories(data_root, agency_list, docket_list):
+        for this_kind in TEXT_DIRECTORIES:
+            kind_dir = os.path.join(text_dir, this_kind)
+            if os.path.isdir(kind_dir):
+                yield this_kind, kind_dir
+
+    derived_data_dir = os.path.join(data_root, 'derived-data')
+    if not os.path.isdir(derived_data_dir):
+        return
+    for agency_entry in sorted(os.scandir(derived_data_dir), key=lambda entry: entry.name):
+        if not agency_entry.is_dir() or (agency_list and agency_entry.name not in agency_list):
+            continue
+        for docket_entry in sorted(os.scandir(agency_entry.path), key=lambda entry: entry.name):
+            if not docket_entry.is_dir() or (docket_list and docket_entry.name not in docket_list):
+                continue
+            extracted_dir = os.path.join(docket_entry.path, EXTRACTED_TEXT_DIR)
+            if not os.path.isdir(extracted_dir):
+                continue
+            for tool_entry in sorted(os.scandir(extracted_dir), key=lambda entry: entry.name):
+                if tool_entry.is_dir():
+                    yield 'extracted_text', tool_entry.path
+
+
+def index_tree(connection, data_root, agency_list=None, docket_list=None, log=print):
+    """Bring the index up to date with the downloaded data under data_root.
+
+    Returns a dict with how many files were indexed, skipped as unchanged, and failed to parse.
+    """
+    counts = {'indexed': 0, 'unchanged': 0, 'failed': 0, 'skipped_dirs': 0}
+    pending = 0
+
+    for this_kind, kind_dir in iter_text_directories(data_root, agency_list, docket_list):
+        relative_dir = os.path.relpath(kind_dir, data_root)
+        dir_mtime_ns = os.stat(kind_dir).st_mtime_ns
+        row = connection.execute("SELECT mtime_ns FROM indexed_dirs WHERE path = ?", (relative_dir,)).fetchone()
+        if row and row[0] == dir_mtime_ns:
+            counts['skipped_dirs'] += 1
+            continue
+
+        failed_before = counts['failed']
+        for file_entry in os.scandir(kind_dir):
+            indexer = FILE_INDEXERS.get((this_kind, os.path.splitext(file_entry.name)[1]))
+            if not indexer or not file_entry.is_file():
+                continue
+
+            relative_path = os.path.join(relative_dir, file_entry.name)
+            stat = file_entry.stat()
+            row = connection.execute("SELECT mtime_ns, size FROM indexed_files WHERE path = ?", (relative_path,)).fetchone()
+            if row and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                counts['unchanged'] += 1
+                continue
+
+            try:
+                indexer(connection, file_entry.path, relative_path)
+            except (ValueError, OSError) as error:
+                log(f"Could not index {relative_path}: {error}")
+                counts['failed'] += 1
+                continue
+
+            connection.execute("INSERT OR REPLACE INTO indexed_files VALUES (?, ?, ?)", (relative_path, stat.st_mtime_ns, stat.st_size))
+            counts['indexed'] += 1
+            pending += 1
+            if pending >= BATCH_SIZE:
+                connection.commit()
+                pending = 0
+
+        #A directory with files we could not parse is looked at again next time, in case they were being written
+        if counts['failed'] == failed_before:
+            connection.execute("INSERT OR REPLACE INTO indexed_dirs VALUES (?, ?)", (relative_dir, dir_mtime_ns))
+
+    connection.commit()
+    return counts
+
+
+def prefix_selection(prefix):
+    """The agency and docket lists index_tree needs to cover a bucket prefix like raw-data/CMS/ or derived-data/CMS/CMS-2025-0050/"""
+    parts = prefix.strip('/').split('/')
+    return parts[1:2], parts[2:3]
+
+
+def search_text(connection, query, agency_list=None, docket_list=None, kinds=None, limit=20):
+    """Find the comments, documents and attachment texts that match an FTS5 query, best matches first.
+
+    Returns dicts with the 'kind' (comment, document or attachment), 'record_id', 'docket_id', 'agency', 'path' below
+    the data directory and a 'snippet' with the matching words in [brackets].
+    """
+    sql = """SELECT search_sources.kind, search_sources.record_id, search_sources.docket_id, search_sources.agency, search_sources.path,
+                    snippet(search_text, 1, '[', ']', '...', 16)
+             FROM search_text JOIN search_sources ON search_sources.id = search_text.rowid
+             WHERE search_text MATCH ?"""
+    parameters = [query]
+    for column, values in [('agency', agency_list), ('docket_id', docket_list), ('kind', kinds)]:
+        if values:
+            sql += f" AND search_sources.{column} IN ({', '.join('?' * len(values))})"
+            parameters += list(values)
+    sql += " ORDER BY rank LIMIT ?"
+    parameters.append(limit)
+
+    keys = ['kind', 'record_id', 'docket_id', 'agency', 'path', 'snippet']
+    return [dict(zip(keys, this_row)) for this_row in connection.execute(sql, parameters)]
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Only index these agencies (separated by commas).")
+@click.option('--docket', '-d', default='', help="Only index these dockets (separated by commas).")
+@click.option('--index-path', default='', help="Where to keep the index (default is comments_index.sqlite in MIRRULATIONS_STATE_PATH)")
+def main(agency, docket, index_path):
+    """Update the comment level index of the data in MIRRULATIONS_DESTINATION_PATH"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
+    docket_list = [docket.strip() for docket in docket.split(',') if docket.strip()]
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    if not dest_dir or not os.path.exists(dest_dir):
+        print(f"Error: {dest_dir} does not exist ")
+        exit()
+
+    try:
+        connection = open_index(index_path or None)
+    except RuntimeError as error:
+        print(f"Error: {error}")
+        exit()
+    start_time = time.time()
+    counts = index_tree(connection, dest_dir, agency_list, docket_list)
+    elapsed_time = round(time.time() - start_time)
+
+    total_comments = connection.execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+    total_texts = connection.execute("SELECT COUNT(*) FROM search_sources").fetchone()[0]
+    print(f"Indexed {counts['indexed']} files, {counts['unchanged']} unchanged, {counts['failed']} failed, {counts['skipped_dirs']} directories unchanged")
+    print(f"The index now holds {total_comments} comments and {total_texts} searchable texts ( took {datetime.timedelta(seconds = elapsed_time)} )")
+
+
+if __name__ == "__main__":
+    main()
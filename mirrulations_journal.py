@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import hashlib
+
+from mirrulations_config import get_state_dir
+
+#An append-only, on-disk record of the units of work (copy jobs) planned for a run and how each one finished.
+#Every event is flushed and fsynced as it is written, so if the machine goes down mid-run,
+#a --resume run can tell which units were already finished and skip them.
+
+#rclone exit codes that mean a unit is done: success, and "the source directory does not exist" (nothing to copy)
+FINISHED_EXIT_CODES = [0, 3]
+
+
+def journal_signature(unit_names, run_key=None):
+    """Identify a run by the units it is made of and by run_key, everything else that decides what those units copy
+    (a unit named raw-data/CMS/ copies other files for other years or another --shard), so only the same selection
+    and sharding maps to the same journal"""
+    signature = "\n".join(unit_names)
+    if run_key is not None:
+        signature += "\n" + json.dumps(run_key, sort_keys=True, default=str)
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+
+def get_journal_path(unit_names, run_key=None):
+    journal_dir = os.path.join(get_state_dir(), 'journals')
+    os.makedirs(journal_dir, exist_ok=True)
+    return os.path.join(journal_dir, f"journal-{journal_signature(unit_names, run_key)}.jsonl")
+
+
+def append_journal_event(journal_path, event, **details):
+    """Durably append one event to the journal"""
+    record = {'event': event, 'time': time.time(), **details}
+    with open(journal_path, 'a') as file_handle:
+        file_handle.write(json.dumps(record) + "\n")
+        file_handle.flush()
+        os.fsync(file_handle.fileno())
+
+
+def read_journal(journal_path):
+    """Yield the events in a journal, skipping a last line that was only half written when we crashed"""
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path) as file_handle:
+        for this_line in file_handle:
+            try:
+                yield json.loads(this_line)
+            except json.JSONDecodeError:
+                continue
+
+
+def load_finished_units(journal_path):
+    """The set of units whose most recent attempt finished successfully"""
+    finished_units = set()
+    for this_event in read_journal(journal_path):
+        if this_event['event'] == 'started':
+            finished_units.discard(this_event['unit'])
+        elif this_event['event'] == 'finished' and this_event['exit_code'] in FINISHED_EXIT_CODES:
+            finished_units.add(this_event['unit'])
+    return finished_units
+
+
+def start_journal(unit_names, resume, run_key=None):
+    """Open the journal for this set of units and run_key (see journal_signature()).
+
+    When resuming, returns the journal path and the units that were already finished. Otherwise any old journal
+    for the same units is replaced and nothing counts as finished.
+    """
+    journal_path = get_journal_path(unit_names, run_key)
+
+    if resume:
+        finished_units = load_finished_units(journal_path)
+        #If we crashed half way through writing an event, end that line so it does not swallow the next event
+        if os.path.isfile(journal_path) and os.path.getsize(journal_path) > 0:
+            with open(journal_path, 'rb+') as file_handle:
+                file_handle.seek(-1, os.SEEK_END)
+                if file_handle.read(1) != b"\n":
+                    file_handle.write(b"\n")
+    else:
+        finished_units = set()
+        if os.path.isfile(journal_path):
+            os.remove(journal_path)
+
+    for this_unit in unit_names:
+        if this_unit not in finished_units:
+            append_journal_event(journal_path, 'planned', unit=this_unit)
+
+    return journal_path, finished_units
@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import datetime
+import tempfile
+import subprocess
+import click
+
+from mirrulations_config import DATA_DIRECTORIES, docket_shard, get_remote, get_state_dir, is_local_remote, iter_batches, parse_bucket_path
+from mirrulations_hashes import hash_file
+
+#A local copy of the bucket listing, so that we only have to pay for listing the bucket when we refresh it,
+#rather than every time we download something.
+#
+#The bucket holds tens of millions of objects, so a listing is never held in memory: entries are read from rclone one
+#at a time as it writes them and go into SQLite LISTING_BATCH_SIZE at a time.
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    data_directory TEXT,
+    agency TEXT,
+    docket TEXT,
+    year INTEGER,
+    section TEXT,
+    ext TEXT,
+    size INTEGER,
+    modtime REAL
+);
+CREATE INDEX IF NOT EXISTS objects_by_docket ON objects (agency, year, docket);
+CREATE TABLE IF NOT EXISTS listings (
+    prefix TEXT PRIMARY KEY,
+    listed_at REAL,
+    object_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS synced_objects (
+    path TEXT PRIMARY KEY,
+    docket TEXT,
+    size INTEGER,
+    modtime REAL,
+    synced_at REAL
+);
+"""
+
+#rclone exits with this code when the directory we asked it to list does not exist
+RCLONE_DIRECTORY_NOT_FOUND = 3
+
+#How many listing entries are handled at a time
+LISTING_BATCH_SIZE = 10000
+
+RCLONE_TIME_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$')
+
+
+def get_manifest_path():
+    return os.path.join(get_state_dir(), 'manifest.sqlite')
+
+
+def open_manifest(manifest_path=None):
+    """Open (creating if needed) the manifest database"""
+    connection = sqlite3.connect(manifest_path or get_manifest_path())
+    connection.executescript(MANIFEST_SCHEMA)
+    #So a machine's slice of the docket space (--shard) can be selected in SQL
+    connection.create_function('docket_shard', 2, docket_shard, deterministic=True)
+    return connection
+
+
+def parse_rclone_time(time_str):
+    """Turn an rclone RFC3339 timestamp (with up to nanosecond precision) into epoch seconds"""
+    match = RCLONE_TIME_PATTERN.match(time_str)
+    if not match:
+        raise ValueError(f"Unrecognised rclone time: {time_str}")
+
+    seconds, fraction, zone = match.groups()
+    if zone == 'Z':
+        zone = '+00:00'
+    parsed = datetime.datetime.fromisoformat(seconds + zone)
+    return parsed.timestamp() + float(fraction or 0)
+
+
+def iter_remote_listing(remote, rclone_config_file, prefix='', with_md5=False):
+    """Yield (path, size, modtime) for every object below the prefix, with paths relative to the bucket root.
+
+    With with_md5 each entry also carries the object's MD5 as a fourth item. The bucket only knows the MD5 of objects
+    that were not uploaded in parts, so it can be None.
+    A local directory laid out like the bucket can stand in for the remote, which is handy for testing.
+    """
+    if is_local_remote(remote):
+        top = os.path.join(remote, prefix)
+        for this_dir, dir_names, file_names in os.walk(top):
+            dir_names.sort()
+            for this_file in sorted(file_names):
+                full_path = os.path.join(this_dir, this_file)
+                stat = os.stat(full_path)
+                entry = (os.path.relpath(full_path, remote).replace(os.sep, '/'), stat.st_size, stat.st_mtime)
+                yield entry + (hash_file(full_path, 'md5'),) if with_md5 else entry
+        return
+
+    rclone_command = ['rclone', 'lsjson', '-R', '--files-only', '--no-mimetype', f"{remote}{prefix}"]
+    if with_md5:
+        rclone_command += ['--hash', '--hash-type', 'MD5']
+    if rclone_config_file:
+        rclone_command += ['--config', rclone_config_file]
+
+    for this_entry in iter_rclone_lsjson(rclone_command, prefix):
+        entry = (prefix + this_entry['Path'], this_entry['Size'], parse_rclone_time(this_entry['ModTime']))
+        yield entry + ((this_entry.get('Hashes') or {}).get('md5') or None,) if with_md5 else entry
+
+
+def iter_rclone_lsjson(rclone_command, prefix=''):
+    """Run rclone lsjson and yield its entries one by one as it writes them.
+
+    rclone writes a JSON array with one entry per line, so each line can be parsed on its own. Yields nothing when
+    the prefix does not exist, and raises RuntimeError when rclone fails.
+    """
+    with tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen(rclone_command, stdout=subprocess.PIPE, stderr=error_file, text=True)
+        try:
+            for this_line in process.stdout:
+                this_line = this_line.strip().rstrip(',')
+                if this_line in ['', '[', ']']:
+                    continue
+                yield json.loads(this_line)
+            exit_code = process.wait()
+        finally:
+            #The consumer stopped early
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        if exit_code == RCLONE_DIRECTORY_NOT_FOUND:
+            return
+        if exit_code != 0:
+            error_file.seek(0)
+            raise RuntimeError(f"rclone lsjson failed for {prefix or 'the bucket root'}: {error_file.read().decode('utf-8', errors='replace').strip()}")
+
+
+def list_remote_directories(remote, rclone_config_file, prefix=''):
+    """The names of the directories directly below the prefix"""
+    if is_local_remote(remote):
+        top = os.path.join(remote, prefix)
+        if not os.path.isdir(top):
+            return []
+        return sorted(this_entry.name for this_entry in os.scandir(top) if this_entry.is_dir())
+
+    rclone_command = ['rclone', 'lsf', '--dirs-only', f"{remote}{prefix}"]
+    if rclone_config_file:
+        rclone_command += ['--config', rclone_config_file]
+
+    result = subprocess.run(rclone_command, capture_output=True, text=True)
+    if result.returncode == RCLONE_DIRECTORY_NOT_FOUND:
+        return []
+    if result.returncode != 0:
+        raise RuntimeError(f"rclone lsf failed for {prefix or 'the bucket root'}: {result.stderr.strip()}")
+
+    return sorted(this_line.rstrip('/') for this_line in result.stdout.splitlines() if this_line.strip())
+
+
+def refresh_manifest(connection, entries, prefix=''):
+    """Bring the manifest rows below the prefix in line with a fresh listing of that prefix.
+
+    entries can be any iterable, and is consumed a batch at a time: the listing is staged in a temporary table on disk,
+    and the new and changed objects are copied from there in batches too.
+    Returns a dict with the number of added, changed, unchanged and removed objects.
+    """
+    #Temporary tables spill to disk instead of growing in memory
+    connection.execute("PRAGMA temp_store = FILE")
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY, size INTEGER, modtime REAL)")
+    connection.execute("DELETE FROM listing")
+    for this_batch in iter_batches(entries, LISTING_BATCH_SIZE):
+        connection.executemany("INSERT OR REPLACE INTO listing (path, size, modtime) VALUES (?, ?, ?)", this_batch)
+
+    prefix_range = (prefix, prefix + '\uffff')
+    counts = {}
+    counts['added'] = connection.execute(
+        "SELECT COUNT(*) FROM listing WHERE path NOT IN (SELECT path FROM objects)").fetchone()[0]
+    counts['changed'] = connection.execute(
+        """SELECT COUNT(*) FROM listing JOIN objects USING (path)
+           WHERE listing.size != objects.size OR listing.modtime != objects.modtime""").fetchone()[0]
+    counts['unchanged'] = connection.execute("SELECT COUNT(*) FROM listing").fetchone()[0] - counts['added'] - counts['changed']
+    counts['removed'] = connection.execute(
+        "SELECT COUNT(*) FROM objects WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM listing)",
+        prefix_range).fetchone()[0]
+
+    connection.execute(
+        "DELETE FROM objects WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM listing)", prefix_range)
+
+    #A batch at a time, each one starting after the last path of the one before, since the copied rows stop matching
+    last_path = ''
+    while True:
+        new_or_changed = connection.execute(
+            """SELECT path, size, modtime FROM listing WHERE path > ? AND NOT EXISTS
+               (SELECT 1 FROM objects WHERE objects.path = listing.path AND objects.size = listing.size AND objects.modtime = listing.modtime)
+               ORDER BY path LIMIT ?""", (last_path, LISTING_BATCH_SIZE)).fetchall()
+        if not new_or_changed:
+            break
+        rows = []
+        for path, size, modtime in new_or_changed:
+            parsed = parse_bucket_path(path)
+            rows.append((path, parsed['data_directory'], parsed['agency'], parsed['docket'], parsed['year'], parsed['section'],
+                         os.path.splitext(path)[1][1:], size, modtime))
+        connection.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        last_path = new_or_changed[-1][0]
+
+    connection.execute("INSERT OR REPLACE INTO listings (prefix, listed_at, object_count) VALUES (?, ?, (SELECT COUNT(*) FROM listing))",
+                       (prefix, time.time()))
+    connection.execute("DELETE FROM listing")
+    connection.commit()
+
+    return counts
+
+
+def manifest_object_count(connection):
+    return connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+
+def job_where_clause(job, textonly):
+    """Build the SQL condition (and its parameters) that matches a job from plan_copy_jobs against the objects table"""
+    where = "objects.path >= ? AND objects.path < ?"
+    parameters = [job['prefix'], job['prefix'] + '\uffff']
+
+    if job['years'] and job['docket_depth'] > 0:
+        where += f" AND objects.year IN ({','.join('?' * len(job['years']))})"
+        parameters += list(job['years'])
+
+    if job['file_types'] != ['*']:
+        extensions = [this_file_type[2:] for this_file_type in job['file_types'] if this_file_type.startswith('*.')]
+        where += f" AND objects.ext IN ({','.join('?' * len(extensions))})"
+        parameters += extensions
+
+    #Text-first runs split each raw-data job into a text and a binary half
+    if textonly or job.get('section') == 'text':
+        where += " AND (objects.section IS NULL OR objects.section != 'binary')"
+    elif job.get('section') == 'binary':
+        where += " AND objects.section = 'binary'"
+
+    #Only the dockets that belong to this machine, when the selection is split between several
+    if job.get('shard'):
+        where += " AND objects.docket IS NOT NULL AND docket_shard(objects.docket, ?) = ?"
+        parameters += [job['shard'][1], job['shard'][0]]
+
+    #Only the dockets picked by their attributes (see mirrulations_catalog.py), passed as one JSON array however many there are
+    if 'dockets' in job and job['docket_depth'] > 0:
+        where += " AND objects.docket IN (SELECT value FROM json_each(?))"
+        parameters.append(json.dumps(job['dockets']))
+
+    return where, parameters
+
+
+def select_job_paths(connection, job, textonly):
+    """Resolve a job from plan_copy_jobs against the manifest.
+
+    Returns the matching paths relative to the job's prefix, ready to be handed to rclone --files-from.
+    """
+    where, parameters = job_where_clause(job, textonly)
+    query = f"SELECT path FROM objects WHERE {where} ORDER BY path"
+
+    return [path[len(job['prefix']):] for (path,) in connection.execute(query, parameters)]
+
+
+def select_job_entries(connection, job, textonly):
+    """Like select_job_paths, but yields (path relative to the job's prefix, size) as it reads them"""
+    where, parameters = job_where_clause(job, textonly)
+    for path, size in connection.execute(f"SELECT path, size FROM objects WHERE {where} ORDER BY path", parameters):
+        yield path[len(job['prefix']):], size
+
+
+def select_job_dockets(connection, job, textonly):
+    """The docket ids of a job's objects in the manifest, without reading every path"""
+    where, parameters = job_where_clause(job, textonly)
+    query = f"SELECT DISTINCT docket FROM objects WHERE {where} AND objects.docket IS NOT NULL ORDER BY docket"
+    return [docket for (docket,) in connection.execute(query, parameters)]
+
+
+def summarize_job(connection, job, textonly):
+    """Count the objects and bytes a job covers, per agency, year and kind of data.
+
+    The kind is 'raw text' (the text-{docketID} directories), 'raw binary' (the binary-{docketID} attachments)
+    or 'derived' (everything in derived-data). Yields (agency, year, kind, object_count, total_bytes).
+    """
+    where, parameters = job_where_clause(job, textonly)
+    query = f"""SELECT agency, year,
+                       CASE WHEN data_directory = 'derived-data' THEN 'derived'
+                            WHEN section = 'binary' THEN 'raw binary'
+                            ELSE 'raw text' END AS kind,
+                       COUNT(*), SUM(size)
+                FROM objects WHERE {where} GROUP BY agency, year, kind"""
+    yield from connection.execute(query, parameters)
+
+
+def select_job_delta(connection, job, textonly):
+    """Compare a job's objects in the manifest with what the last successful run copied.
+
+    Returns the paths (relative to the job's prefix) that are new or changed since then, and a dict of
+    docket -> {'added': n, 'changed': n, 'unchanged': n}.
+    """
+    where, parameters = job_where_clause(job, textonly)
+    query = f"""SELECT objects.path, objects.docket,
+                       CASE WHEN synced_objects.path IS NULL THEN 'added'
+                            WHEN synced_objects.size != objects.size OR synced_objects.modtime != objects.modtime THEN 'changed'
+                            ELSE 'unchanged' END
+                FROM objects LEFT JOIN synced_objects ON synced_objects.path = objects.path
+                WHERE {where} ORDER BY objects.path"""
+
+    paths = []
+    docket_counts = {}
+    for path, docket, status in connection.execute(query, parameters):
+        counts = docket_counts.setdefault(docket, {'added': 0, 'changed': 0, 'unchanged': 0})
+        counts[status] += 1
+        if status != 'unchanged':
+            paths.append(path[len(job['prefix']):])
+
+    return paths, docket_counts
+
+
+def record_synced_paths(connection, prefix, relative_paths):
+    """Remember that these objects (as the manifest currently describes them) were copied successfully"""
+    synced_at = time.time()
+    connection.executemany(
+        """INSERT OR REPLACE INTO synced_objects (path, docket, size, modtime, synced_at)
+           SELECT path, docket, size, modtime, ? FROM objects WHERE path = ?""",
+        ((synced_at, prefix + this_path) for this_path in relative_paths))
+    connection.commit()
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Only refresh these agencies (separated by commas) instead of the whole bucket.")
+def main(agency):
+    """Refresh the local manifest of the mirrulations bucket listing"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
+
+    remote = get_remote()
+    rclone_config_file = os.getenv('RCLONE_CONFIG_FILE')
+    if not is_local_remote(remote) and (not rclone_config_file or not os.path.isfile(rclone_config_file)):
+        print(f"Error: {rclone_config_file} is not found")
+        exit()
+
+    if agency_list:
+        prefixes = [f"{this_data_directory}/{this_agency}/" for this_agency in agency_list for this_data_directory in DATA_DIRECTORIES]
+    else:
+        prefixes = [f"{this_data_directory}/" for this_data_directory in DATA_DIRECTORIES]
+
+    connection = open_manifest()
+    start_time = time.time()
+
+    for this_prefix in prefixes:
+        print(f"Listing {remote}{this_prefix}")
+        try:
+            counts = refresh_manifest(connection, iter_remote_listing(remote, rclone_config_file, this_prefix), this_prefix)
+        except RuntimeError as error:
+            print(f"Error: {error}")
+            exit(1)
+        print(f"\t{counts['added']} added, {counts['changed']} changed, {counts['unchanged']} unchanged, {counts['removed']} removed")
+
+    elapsed_time = round(time.time() - start_time)
+    print(f"Manifest {get_manifest_path()} now lists {manifest_object_count(connection)} objects ( took {datetime.timedelta(seconds = elapsed_time)} )")
+
+
+if __name__ == "__main__":
+    main()
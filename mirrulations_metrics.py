@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+
+from mirrulations_tuning import read_latest_rclone_stats
+
+#Periodically turns the rclone stats of every shard in a run into metrics that monitoring can scrape:
+#a Prometheus textfile (for node_exporter's textfile collector) and a JSON-lines stream.
+
+PROMETHEUS_FILE_NAME = 'mirrulations.prom'
+JSON_LINES_FILE_NAME = 'mirrulations_metrics.jsonl'
+
+#(metric name, type, help text, key in the group totals)
+PROMETHEUS_METRICS = [
+    ('mirrulations_bytes_transferred_total', 'counter', "Bytes transferred so far in this run", 'bytes'),
+    ('mirrulations_files_transferred_total', 'counter', "Files transferred so far in this run", 'files'),
+    ('mirrulations_objects_checked_total', 'counter', "Objects checked against the destination so far in this run", 'checks'),
+    ('mirrulations_errors_total', 'counter', "Errors so far in this run", 'errors'),
+    ('mirrulations_bytes_per_second', 'gauge', "Current transfer rate of the running shards in bytes per second", 'bytes_per_second'),
+    ('mirrulations_files_per_second', 'gauge', "Current transfer rate of the running shards in files per second", 'files_per_second'),
+    ('mirrulations_eta_seconds', 'gauge', "rclone's estimate of the time left for the slowest running shard", 'eta'),
+    ('mirrulations_shards_running', 'gauge', "Shards that are running right now", 'running'),
+    ('mirrulations_shards_finished', 'gauge', "Shards that have finished", 'finished'),
+]
+
+
+def job_labels(job):
+    """The agency and data directory (raw-data or derived-data) a job's prefix belongs to"""
+    parts = job['prefix'].strip('/').split('/')
+    agency = parts[1] if len(parts) > 1 else 'all'
+    return parts[0], agency
+
+
+def job_stats(job):
+    """The latest stats for a job: its final stats once it has finished, or whatever its log says so far while it runs"""
+    if 'final_stats' in job:
+        return job['final_stats']
+    if 'started_at' in job:
+        return read_latest_rclone_stats(job['log_file'], job.get('log_offset', 0))
+    return None
+
+
+def collect_metrics(jobs):
+    """Add up the stats of every job, grouped by (data directory, agency)"""
+    groups = {}
+    for this_job in jobs:
+        data_directory, agency = job_labels(this_job)
+        group = groups.setdefault((data_directory, agency), {
+            'bytes': 0, 'files': 0, 'checks': 0, 'errors': 0,
+            'bytes_per_second': 0, 'files_per_second': 0, 'eta': 0, 'running': 0, 'finished': 0,
+        })
+
+        is_finished = 'final_stats' in this_job
+        is_running = 'started_at' in this_job and not is_finished
+        group['finished'] += int(is_finished)
+        group['running'] += int(is_running)
+
+        stats = job_stats(this_job)
+        if not stats:
+            continue
+
+        group['bytes'] += stats.get('bytes', 0)
+        group['files'] += stats.get('transfers', 0)
+        group['checks'] += stats.get('checks', 0)
+        group['errors'] += stats.get('errors', 0)
+        if is_running:
+            group['bytes_per_second'] += stats.get('speed', 0)
+            if stats.get('elapsedTime'):
+                group['files_per_second'] += stats.get('transfers', 0) / stats['elapsedTime']
+            group['eta'] = max(group['eta'], stats.get('eta') or 0)
+
+    return groups
+
+
+def format_prometheus(groups, timestamp):
+    """Render the grouped metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric_name, metric_type, help_text, key in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for (data_directory, agency), group in sorted(groups.items()):
+            lines.append(f'{metric_name}{{agency="{agency}",data_directory="{data_directory}"}} {group[key]}')
+    lines.append("# HELP mirrulations_last_update_timestamp_seconds When these metrics were written")
+    lines.append("# TYPE mirrulations_last_update_timestamp_seconds gauge")
+    lines.append(f"mirrulations_last_update_timestamp_seconds {timestamp}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(jobs, metrics_dir):
+    """Write one snapshot of the metrics: replace the Prometheus textfile and append a line to the JSON-lines stream"""
+    timestamp = time.time()
+    groups = collect_metrics(jobs)
+
+    #The textfile collector may read the file at any moment, so write it to the side and rename it into place
+    prometheus_file = os.path.join(metrics_dir, PROMETHEUS_FILE_NAME)
+    with open(prometheus_file + '.tmp', 'w') as file_handle:
+        file_handle.write(format_prometheus(groups, timestamp))
+    os.replace(prometheus_file + '.tmp', prometheus_file)
+
+    record = {
+        'time': timestamp,
+        'groups': [{'data_directory': data_directory, 'agency': agency, **group} for (data_directory, agency), group in sorted(groups.items())],
+    }
+    with open(os.path.join(metrics_dir, JSON_LINES_FILE_NAME), 'a') as file_handle:
+        file_handle.write(json.dumps(record) + "\n")
+
+
+class MetricsExporter:
+    """Writes metrics for a run's jobs every `interval` seconds on a background thread"""
+
+    def __init__(self, jobs, metrics_dir, interval=15):
+        #An interval below a second would have the thread write metrics as fast as it can
+        if interval < 1:
+            raise ValueError(f"the metrics interval must be at least 1 second, not {interval}")
+        self.jobs = jobs
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread and write one last snapshot, so the final totals are always exported"""
+        self.stopped.set()
+        self.thread.join()
+        write_metrics(self.jobs, self.metrics_dir)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            write_metrics(self.jobs, self.metrics_dir)
@@ -0,0 +1,293 @@
+import json
+import time
+import socket
+import datetime
+import threading
+import urllib.error
+import urllib.request
+
+#Keeps the combined download rate of every running rclone process under a cap that can change with the time of day.
+#Each rclone process runs its remote control server on a port of its own (--rc), and a background thread asks every
+#one of them how much it moved since last time and hands out the cap between them with core/bwlimit.
+#
+#A schedule uses rclone's own --bwlimit timetable syntax: space separated HH:MM,RATE entries, optionally starting
+#with a day of the week, where each entry holds until the next one, e.g.
+#    "08:00,5M 18:00,off Sat-00:00,off Sun-00:00,off"
+#Rates are rclone sizes in bytes per second (512K, 20M, 1G, plain numbers are KiB) or 'off' for no limit.
+
+#Seconds between two rounds of measuring and re-dividing the cap
+PACING_INTERVAL = 5
+#A shard that moved less than this part of its share last round only needs what it moved, plus HEADROOM to grow into,
+#which has to leave it under UNDERUSED so that it stays put while its rate does
+UNDERUSED = 0.8
+HEADROOM = 1.5
+#Nobody is ever given less than this, in bytes per second
+MINIMUM_RATE = 64 * 1024
+#When the shards together move at least this part of what they are allowed, they are counted as throttled
+THROTTLED = 0.9
+
+#The port is only free when we pick it, so something else can take it before rclone starts. rclone logs this and
+#stops, and the shard is started again on another port up to RC_PORT_ATTEMPTS times
+RC_START_FAILED = 'Failed to start remote control'
+RC_PORT_ATTEMPTS = 3
+
+RATE_SUFFIXES = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_rate(rate):
+    """Turn an rclone rate like 512K or 20M into bytes per second. '' and 'off' mean no limit and give None"""
+    rate = str(rate).strip()
+    if rate in ['', 'off']:
+        return None
+    number, multiplier = rate, RATE_SUFFIXES['K']
+    if rate[-1].upper() in RATE_SUFFIXES:
+        number, multiplier = rate[:-1], RATE_SUFFIXES[rate[-1].upper()]
+    try:
+        bytes_per_second = float(number) * multiplier
+    except ValueError:
+        raise ValueError(f"{rate} is not a rate, use something like 512K, 20M or off")
+    if bytes_per_second <= 0:
+        raise ValueError(f"{rate}: a rate has to be more than 0, use off for no limit")
+    return bytes_per_second
+
+
+def format_rate(bytes_per_second):
+    """The other way around, in whole KiB for rclone"""
+    if bytes_per_second is None:
+        return 'off'
+    return f"{max(1, round(bytes_per_second / 1024))}K"
+
+
+def parse_schedule(schedule):
+    """Turn a timetable into a list of (minute of the week, bytes per second or None), sorted by time.
+
+    Entries without a day apply to every day of the week, the ones with a day replace them on that day.
+    """
+    daily = {}
+    weekly = {}
+    for this_entry in schedule.split():
+        try:
+            when, rate = this_entry.split(',')
+            day = None
+            if '-' in when:
+                day, when = when.split('-')
+                day = WEEKDAYS.index(day.capitalize())
+            hour, minute = (int(this_part) for this_part in when.split(':'))
+        except ValueError:
+            raise ValueError(f"--bwlimit-schedule: {this_entry} should look like 08:00,5M or Sat-00:00,off")
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"--bwlimit-schedule: {when} is not a time of day")
+        if day is None:
+            daily[hour * 60 + minute] = parse_rate(rate)
+        else:
+            weekly[day * MINUTES_PER_DAY + hour * 60 + minute] = parse_rate(rate)
+
+    timetable = {}
+    for this_day in range(7):
+        day_entries = {this_minute: this_rate for this_minute, this_rate in weekly.items() if this_minute // MINUTES_PER_DAY == this_day}
+        if not day_entries:
+            day_entries = {this_day * MINUTES_PER_DAY + this_minute: this_rate for this_minute, this_rate in daily.items()}
+        timetable.update(day_entries)
+    return sorted(timetable.items())
+
+
+def scheduled_rate(timetable, now=None):
+    """The rate a timetable sets at a moment (a datetime, local time), or None when it sets no limit"""
+    if not timetable:
+        return None
+    now = now or datetime.datetime.now()
+    minute_of_week = now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+    #Before the first entry of the week, the last entry of the week before still holds
+    rate = timetable[-1][1]
+    for this_minute, this_rate in timetable:
+        if this_minute > minute_of_week:
+            break
+        rate = this_rate
+    return rate
+
+
+def allocate_bandwidth(cap, shards):
+    """Divide a cap in bytes per second between the running shards, fairly but without wasting any of it.
+
+    shards maps each shard to (the rate it moved at last round, the rate it was allowed, its own ceiling or None).
+    A shard that left a good part of its allowance unused only keeps what it used plus some headroom, and one with a
+    ceiling (--text-bwlimit, --binary-bwlimit) never gets more than that. The rest is split evenly between the others,
+    and whatever nobody can use goes back to everyone below their ceiling so they can speed up.
+    """
+    demands = {}
+    for key, (rate, allowed, ceiling) in shards.items():
+        demand = ceiling
+        if allowed and rate < allowed * UNDERUSED:
+            demand = max(rate * HEADROOM, MINIMUM_RATE) if ceiling is None else min(ceiling, max(rate * HEADROOM, MINIMUM_RATE))
+        demands[key] = demand
+
+    #Satisfy the smallest demands first, each shard getting at most an even split of what is left
+    allocations = {}
+    remaining = cap
+    ordered = sorted(demands, key=lambda key: float('inf') if demands[key] is None else demands[key])
+    for index, key in enumerate(ordered):
+        fair_share = remaining / (len(ordered) - index)
+        allocations[key] = fair_share if demands[key] is None else min(demands[key], fair_share)
+        remaining -= allocations[key]
+
+    growing = [key for key in ordered if shards[key][2] is None or allocations[key] < shards[key][2]]
+    for key in growing:
+        extra = remaining / len(growing)
+        if shards[key][2] is not None:
+            extra = min(extra, shards[key][2] - allocations[key])
+        allocations[key] += extra
+
+    return {key: max(MINIMUM_RATE, allocation) for key, allocation in allocations.items()}
+
+
+def pick_rc_port(taken=()):
+    """A free local port for an rclone process's remote control server, other than the ones in taken"""
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as this_socket:
+            this_socket.bind(('127.0.0.1', 0))
+            port = this_socket.getsockname()[1]
+        if port not in taken:
+            return port
+
+
+def rc_flags(port):
+    #core/stats and core/bwlimit do not need authorisation, and without it nobody can call anything that does
+    return f" --rc --rc-addr 127.0.0.1:{port} "
+
+
+def rc_start_failed(log_file, start_offset=0):
+    """True when rclone logged, after start_offset, that it could not start its remote control (the port was taken).
+    rclone stops straight away when that happens"""
+    try:
+        with open(log_file, 'rb') as file_handle:
+            file_handle.seek(start_offset)
+            return RC_START_FAILED in file_handle.read().decode('utf-8', errors='replace')
+    except OSError:
+        return False
+
+
+def call_rc(port, command, parameters=None, timeout=2):
+    """Call an rclone remote control command, returning its reply, or None if the process is not listening (yet)"""
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/{command}", data=json.dumps(parameters or {}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+
+
+class BandwidthPacer:
+    """Re-divides the current cap between a run's running shards every `interval` seconds on a background thread.
+
+    The cap is the lower of the timetable's rate and total_rate (either may be None). Jobs take part once job_started
+    gave them an 'rc_port', and stop when they have 'final_stats'. A job that is 'retry_waiting' (waiting to copy its
+    failed files again) sits out until start_job starts it again. Along the way it counts how long the shards were
+    held back by the cap ('throttled') and how long they moved less than they were allowed ('network').
+    """
+
+    def __init__(self, jobs, timetable=None, total_rate=None, interval=PACING_INTERVAL):
+        self.jobs = jobs
+        self.timetable = timetable or []
+        self.total_rate = total_rate
+        self.interval = interval
+        self.seconds = {'throttled': 0, 'network': 0}
+        self.last_tick = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def current_cap(self, now=None):
+        rates = [this_rate for this_rate in [scheduled_rate(self.timetable, now), self.total_rate] if this_rate is not None]
+        return min(rates) if rates else None
+
+    def running_jobs(self):
+        return [this_job for this_job in self.jobs if 'rc_port' in this_job and 'final_stats' not in this_job and not this_job.get('retry_waiting')]
+
+    def start_job(self, job):
+        """Give a shard that is about to start (or start again) its port and a starting rate, and re-divide the cap straight away"""
+        with self.lock:
+            job['rc_port'] = pick_rc_port({this_job['rc_port'] for this_job in self.running_jobs()})
+            #A new process counts its bytes from 0 again
+            job.pop('paced_bytes', None)
+            ceiling = job.get('bwlimit_ceiling')
+            cap = self.current_cap()
+            allowed = None if cap is None else cap / len(self.running_jobs())
+            if ceiling is not None:
+                allowed = ceiling if allowed is None else min(allowed, ceiling)
+            job['bwlimit_allowed'] = allowed
+            job['bwlimit_applied'] = format_rate(allowed)
+        self.wakeup.set()
+        return rc_flags(job['rc_port']) + f" --bwlimit {format_rate(allowed)} "
+
+    def tick(self):
+        """Measure every running shard, hand out the cap again and add the time since the last round to the totals"""
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.last_tick if self.last_tick else 0
+            self.last_tick = now
+            cap = self.current_cap()
+
+            running = self.running_jobs()
+            shards = {}
+            moved = 0
+            for index, this_job in enumerate(running):
+                stats = call_rc(this_job['rc_port'], 'core/stats')
+                allowed = this_job.get('bwlimit_allowed')
+                if stats is None or 'paced_bytes' not in this_job or elapsed <= 0:
+                    #Not listening yet, or nothing to compare with: assume it uses all it is allowed
+                    rate = allowed or 0
+                else:
+                    rate = max(0, stats.get('bytes', 0) - this_job['paced_bytes']) / elapsed
+                    moved += rate
+                if stats is not None:
+                    this_job['paced_bytes'] = stats.get('bytes', 0)
+                shards[index] = (rate, allowed, this_job.get('bwlimit_ceiling'))
+
+            if not shards:
+                return
+
+            ceilings = [this_shard[2] for this_shard in shards.values()]
+            limit = cap
+            if None not in ceilings:
+                limit = sum(ceilings) if cap is None else min(cap, sum(ceilings))
+            if elapsed > 0:
+                self.seconds['throttled' if limit is not None and moved >= limit * THROTTLED else 'network'] += elapsed
+
+            if cap is None:
+                allocations = {index: shards[index][2] for index in shards}
+            else:
+                allocations = allocate_bandwidth(cap, shards)
+            for index, allowed in allocations.items():
+                this_job = running[index]
+                if this_job.get('bwlimit_applied') == format_rate(allowed):
+                    continue
+                if call_rc(this_job['rc_port'], 'core/bwlimit', {'rate': format_rate(allowed)}) is not None:
+                    this_job['bwlimit_applied'] = format_rate(allowed)
+                    this_job['bwlimit_allowed'] = allowed
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+
+    def summary(self):
+        """Seconds spent held back by the cap and seconds spent limited by the network"""
+        return {this_key: round(this_value) for this_key, this_value in self.seconds.items()}
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.tick()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+def print_pacing_summary(summary):
+    print(f"Bandwidth: held back by the cap for {datetime.timedelta(seconds = summary['throttled'])}, "
+          f"limited by the network for {datetime.timedelta(seconds = summary['network'])}")
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import hashlib
+import click
+
+from mirrulations_config import docket_shard, docket_year, get_remote, get_state_dir, parse_bucket_path
+import mirrulations_manifest
+import mirrulations_journal
+import mirrulations_catalog
+import mirrulations_sampling
+import mirrulations_planning
+
+#Splits one selection between several machines. Every docket belongs to exactly one of N shards, by a hash of its id
+#(docket_shard in mirrulations_config.py), so `--shard i/N` on N machines downloads N disjoint slices that together
+#make up the whole selection. Each machine writes a report of the dockets it finished to
+#    {MIRRULATIONS_STATE_PATH}/shards/{selection}-{i}-of-{N}.json
+#and running this script on the reports of all N machines checks that they cover everything.
+
+
+def parse_shard_spec(shard_spec):
+    """Turn 'i/N' into (i, N), with machines numbered from 1 to N"""
+    try:
+        index, count = (int(this_part) for this_part in shard_spec.split('/'))
+    except ValueError:
+        raise ValueError(f"--shard must look like i/N (e.g. 2/4), not {shard_spec}")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"--shard {shard_spec}: i must be between 1 and N")
+    return index, count
+
+
+def list_job_remote_dockets(job, rclone_config_file):
+    """The docket ids below a job's prefix in the bucket, keeping only the job's years"""
+    if job['docket_depth'] == 0:
+        return [job['prefix'].strip('/').split('/')[2]]
+
+    if job['docket_depth'] == 1:
+        agency_prefixes = [job['prefix']]
+    else:
+        agency_prefixes = [f"{job['prefix']}{this_agency}/" for this_agency in mirrulations_manifest.list_remote_directories(get_remote(), rclone_config_file, job['prefix'])]
+
+    dockets = []
+    for this_prefix in agency_prefixes:
+        for this_docket in mirrulations_manifest.list_remote_directories(get_remote(), rclone_config_file, this_prefix):
+            if not job['years'] or docket_year(this_docket) in job['years']:
+                dockets.append(this_docket)
+    return sorted(dockets)
+
+
+def partition_jobs(jobs, shard, rclone_config_file, manifest_connection=None, textonly=False):
+    """Cut every job down to the dockets of one shard, dropping the jobs that have none.
+
+    Jobs that copy a list of files keep the files of their dockets. Every other job gets the 'dockets' to keep, which
+    its filter rules then name one by one. They come from the manifest when there is one (where the job's shard also
+    narrows what resolving it selects), and otherwise from a directories-only listing below the job's prefix.
+    """
+    partitioned = []
+    for this_job in jobs:
+        this_job['shard'] = shard
+        if 'files' in this_job:
+            this_job['files'] = [this_file for this_file in this_job['files'] if owns_path(this_job['prefix'] + this_file, shard)]
+            if this_job['files']:
+                partitioned.append(this_job)
+            continue
+        if manifest_connection:
+            this_job['dockets'] = mirrulations_manifest.select_job_dockets(manifest_connection, this_job, textonly)
+        else:
+            this_job['dockets'] = [this_docket for this_docket in list_job_remote_dockets(this_job, rclone_config_file) if docket_shard(this_docket, shard[1]) == shard[0]]
+        if this_job['dockets']:
+            partitioned.append(this_job)
+    return partitioned
+
+
+def owns_path(bucket_path, shard):
+    docket_id = parse_bucket_path(bucket_path)['docket']
+    return docket_id is not None and docket_shard(docket_id, shard[1]) == shard[0]
+
+
+def job_dockets(job):
+    """The docket ids a job covers, as far as we know them"""
+    if 'dockets' in job:
+        return set(job['dockets'])
+    if 'files' in job:
+        return {parse_bucket_path(job['prefix'] + this_file)['docket'] for this_file in job['files']} - {None}
+    if job['docket_depth'] == 0:
+        return {job['prefix'].strip('/').split('/')[2]}
+    return set()
+
+
+def report_selection(selection):
+    """The parts of a selection that decide which dockets it covers and what of each is downloaded, with the attributes
+    and the sampling settings checked, so the same selection always reads the same"""
+    reported = {this_key: selection[this_key] for this_key in ['agencies', 'years', 'dockets', 'textonly', 'getall', 'files_from']}
+    reported['attributes'] = mirrulations_catalog.check_attributes(selection['attributes'])
+    reported['sampling'] = mirrulations_sampling.check_sampling(selection['sampling'])
+    return reported
+
+
+def selection_signature(selection):
+    """Identify a selection, so the reports of the machines splitting it can be told apart from other runs"""
+    return hashlib.sha1(json.dumps(report_selection(selection), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def write_shard_report(selection, shard, jobs, results_by_name, report_dir=None):
+    """Record which dockets this machine finished and return the report's path.
+
+    A docket is finished when every job that covers it (raw-data and derived-data, text and binary) finished.
+    results_by_name maps job names to exit codes, jobs a resumed run skipped count as finished.
+    """
+    finished = set()
+    failed = set()
+    for this_job in jobs:
+        exit_code = results_by_name.get(this_job['name'], 0)
+        if exit_code in mirrulations_journal.FINISHED_EXIT_CODES:
+            finished |= job_dockets(this_job)
+        else:
+            failed |= job_dockets(this_job)
+
+    report_dir = report_dir or os.path.join(get_state_dir(), 'shards')
+    os.makedirs(report_dir, exist_ok=True)
+    report_file = os.path.join(report_dir, f"{selection_signature(selection)}-{shard[0]}-of-{shard[1]}.json")
+    report = {
+        'shard': shard[0],
+        'count': shard[1],
+        'selection': report_selection(selection),
+        'time': time.time(),
+        'finished_dockets': sorted(finished - failed),
+        'failed_dockets': sorted(failed),
+    }
+    with open(report_file + '.tmp', 'w') as file_handle:
+        json.dump(report, file_handle, indent=1)
+    os.replace(report_file + '.tmp', report_file)
+    return report_file
+
+
+def check_coverage(reports, expected_dockets):
+    """Compare the reports of all the machines with the dockets the selection covers.
+
+    Returns a dict with the 'missing_shards' numbers nobody reported, the 'missing' dockets no machine finished
+    (each with the shard that should have), 'misplaced' dockets finished by a machine they do not belong to,
+    and 'duplicated' dockets finished by more than one.
+    """
+    count = reports[0]['count']
+    reported = {}
+    for this_report in reports:
+        for this_docket in this_report['finished_dockets']:
+            reported.setdefault(this_docket, []).append(this_report['shard'])
+
+    coverage = {
+        'missing_shards': sorted(set(range(1, count + 1)) - {this_report['shard'] for this_report in reports}),
+        'missing': sorted((this_docket, docket_shard(this_docket, count)) for this_docket in set(expected_dockets) - set(reported)),
+        'misplaced': sorted(this_docket for this_docket, shards in reported.items() if any(this_shard != docket_shard(this_docket, count) for this_shard in shards)),
+        'duplicated': sorted(this_docket for this_docket, shards in reported.items() if len(shards) > 1),
+        'covered': len(set(reported) & set(expected_dockets)),
+        'expected': len(set(expected_dockets)),
+    }
+    return coverage
+
+
+def load_reports(paths):
+    """Read the reports from files and directories of them"""
+    reports = []
+    for this_path in paths:
+        if os.path.isdir(this_path):
+            reports += load_reports(sorted(os.path.join(this_path, this_name) for this_name in os.listdir(this_path) if this_name.endswith('.json')))
+        else:
+            with open(this_path) as file_handle:
+                reports.append(json.load(file_handle))
+    return reports
+
+
+def expected_selection_dockets(selection, rclone_config_file, use_manifest=False):
+    """Every docket a selection covers, from a listing of the bucket or from the manifest, narrowed down to the ones
+    whose metadata matches the selection's attributes in the catalog. Raises RuntimeError"""
+    included_file_types = ['*.txt', '*.json', '*.htm'] if selection['textonly'] else ['*']
+    jobs = mirrulations_planning.plan_copy_jobs(selection['agencies'] or ['*'], selection['years'] or ['*'], selection['dockets'], included_file_types)
+
+    dockets = set()
+    if use_manifest:
+        manifest_connection = mirrulations_manifest.open_manifest()
+        for this_job in jobs:
+            dockets.update(mirrulations_manifest.select_job_dockets(manifest_connection, this_job, selection['textonly']))
+        manifest_connection.close()
+    else:
+        for this_job in jobs:
+            dockets.update(list_job_remote_dockets(this_job, rclone_config_file))
+
+    #The machines only downloaded the dockets that match, the others are not missing
+    attributes = mirrulations_catalog.check_attributes(selection['attributes'])
+    if attributes:
+        connection = mirrulations_catalog.open_catalog()
+        try:
+            mirrulations_catalog.build_catalog(connection, jobs, attributes, rclone_config_file)
+            dockets &= {docket_id for agency, docket_id in mirrulations_catalog.select_dockets(connection, attributes)}
+        finally:
+            connection.close()
+    return dockets
+
+
+@click.command()
+@click.argument('reports', nargs=-1, required=True)
+@click.option('--use-manifest', is_flag=True, help="Take the dockets the selection covers from the manifest instead of listing the bucket")
+def main(reports, use_manifest):
+    """Check that the shard reports of every machine (files, or directories of them) together cover the whole selection"""
+    reports = load_reports(reports)
+    if not reports:
+        print("Error: no shard reports found")
+        exit()
+    if len({json.dumps(this_report['selection'], sort_keys=True) for this_report in reports}) > 1 or len({this_report['count'] for this_report in reports}) > 1:
+        print("Error: the reports are for different selections or numbers of shards")
+        exit()
+    if reports[0]['selection']['files_from']:
+        print("Error: a --files-from selection cannot be checked, the list only exists on the machines that ran it")
+        exit()
+
+    try:
+        expected_dockets = expected_selection_dockets(reports[0]['selection'], os.getenv('RCLONE_CONFIG_FILE'), use_manifest)
+    except RuntimeError as error:
+        print(f"Error: {error}")
+        exit()
+    coverage = check_coverage(reports, expected_dockets)
+
+    count = reports[0]['count']
+    for this_shard in coverage['missing_shards']:
+        print(f"No report from shard {this_shard}/{count}")
+    for this_docket, this_shard in coverage['missing']:
+        print(f"missing: {this_docket} (shard {this_shard}/{count})")
+    for this_docket in coverage['misplaced']:
+        print(f"misplaced: {this_docket} was downloaded by a machine it does not belong to")
+    for this_docket in coverage['duplicated']:
+        print(f"duplicated: {this_docket} was downloaded by more than one machine")
+
+    print(f"{coverage['covered']} of {coverage['expected']} dockets covered by {len(reports)} of {count} shards")
+    if coverage['missing_shards'] or coverage['missing']:
+        for this_shard in sorted({this_shard for this_docket, this_shard in coverage['missing']} | set(coverage['missing_shards'])):
+            print(f"To finish shard {this_shard}: run the same command with --shard {this_shard}/{count} --resume on its machine")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
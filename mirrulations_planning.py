@@ -0,0 +1,394 @@
+import os
+import json
+import time
+import datetime
+import hashlib
+import tempfile
+
+from mirrulations_config import DATA_DIRECTORIES, docket_year, get_remote, get_state_dir
+import mirrulations_manifest
+import mirrulations_tuning
+import mirrulations_archive
+
+#Turns a selection into copy jobs and the rclone commands that run them, without running anything. Each job is a
+#dict with the bucket 'prefix' it copies and what to keep below it (see plan_copy_jobs), which the rest of the
+#downloader adds to as the job is resolved, sampled, run and finished. mirrulations_api.py runs the jobs, and
+#mirrulations_bulk_downloader.py is the command line on top of both.
+
+
+def parse_years(year_str):
+    years = []
+    for item in year_str.split(','):
+        if '-' in item:
+            start, end = map(int, item.split('-'))
+            years.extend(range(start, end + 1))
+        else:
+            years.append(int(item))
+    return years
+
+
+def build_shards(agency_list, year_list, docket_list, shard_by):
+    """Split the agency/year/docket selection into independent shards that can each be handed to their own rclone process"""
+    if len(docket_list) > 0:
+        if shard_by == 'none':
+            return [ {'name': 'dockets', 'agency_list': agency_list, 'year_list': year_list, 'docket_list': docket_list} ]
+        #Any sharding of an explicit docket list is per docket, since that is the finest unit we have
+        return [ {'name': this_docket, 'agency_list': agency_list, 'year_list': year_list, 'docket_list': [ this_docket ]} for this_docket in docket_list ]
+
+    if shard_by == 'none':
+        return [ {'name': 'all', 'agency_list': agency_list, 'year_list': year_list, 'docket_list': []} ]
+
+    if shard_by == 'docket':
+        #We cannot know which dockets exist without listing the bucket, so agency-year is the finest we can go
+        print("Sharding by docket needs --docket, sharding by agency-year instead")
+        shard_by = 'agency-year'
+
+    shards = []
+    for this_agency in agency_list:
+        if shard_by == 'agency':
+            shards.append({'name': this_agency.replace('*', 'all'), 'agency_list': [ this_agency ], 'year_list': year_list, 'docket_list': []})
+        else:
+            for this_year in year_list:
+                shards.append({'name': f"{this_agency}-{this_year}".replace('*', 'all'), 'agency_list': [ this_agency ], 'year_list': [ this_year ], 'docket_list': []})
+
+    return shards
+
+
+#rclone exits with this code when the source directory does not exist. Since we copy concrete prefixes, that just means
+#there was nothing to copy (for example a docket that has no derived-data yet)
+RCLONE_DIRECTORY_NOT_FOUND = 3
+
+#Text-first runs mark each docket whose text is all there with a file in {MIRRULATIONS_DESTINATION_PATH}/text-complete/{agency}/
+TEXT_COMPLETE_DIR_NAME = 'text-complete'
+
+
+def plan_copy_jobs(agency_list, year_list, docket_list, included_file_types):
+    """Turn the agency/year/docket selection into the smallest set of bucket prefixes to copy.
+
+    Returns a list of jobs, each a dict with
+        'prefix': what to copy, relative to the bucket root (and also used as the destination subpath)
+        'docket_depth': how many directory levels there are between the prefix and the docket directories
+        'years': the docket years to keep below the prefix (empty means every year)
+        'file_types': the file type patterns to keep
+    Rooting each copy at its prefix means rclone only ever lists the part of the bucket we asked for.
+    """
+    jobs_by_prefix = {}
+
+    def add_job(prefix, docket_depth, year):
+        this_job = jobs_by_prefix.setdefault(prefix, {'prefix': prefix, 'docket_depth': docket_depth, 'years': [], 'file_types': list(included_file_types)})
+        if year == '*':
+            #Any 'every year' request for a prefix wins over specific years
+            this_job['all_years'] = True
+        elif year is not None and year not in this_job['years']:
+            this_job['years'].append(year)
+
+    # Handle specific dockets
+    if len(docket_list) > 0:
+        for this_docket in docket_list:
+            # Extract agency from docket ID (format: AGENCY-YEAR-ID)
+            docket_parts = this_docket.split('-')
+            if len(docket_parts) >= 3:
+                agency = docket_parts[0]
+
+                for this_data_directory in DATA_DIRECTORIES:
+                    add_job(f"{this_data_directory}/{agency}/{this_docket}/", 0, None)
+    else:
+        # Handle agency/year combinations
+        for this_agency in agency_list:
+            for this_year in year_list:
+                for this_data_directory in DATA_DIRECTORIES:
+                    if this_agency == '*':
+                        # All agencies, so we have to start from the top of the data directory
+                        add_job(f"{this_data_directory}/", 2, this_year)
+                    else:
+                        add_job(f"{this_data_directory}/{this_agency}/", 1, this_year)
+
+    jobs = []
+    for this_job in jobs_by_prefix.values():
+        if this_job.pop('all_years', False):
+            this_job['years'] = []
+        this_job['years'] = sorted(this_job['years'])
+        jobs.append(this_job)
+
+    return jobs
+
+
+def plan_files_from_jobs(bucket_paths):
+    """Turn a list of exact bucket paths (like the repair list from mirrulations_verify.py) into one job per agency prefix,
+    each carrying its files relative to that prefix"""
+    jobs_by_prefix = {}
+    for this_path in bucket_paths:
+        parts = this_path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] not in DATA_DIRECTORIES:
+            print(f"Skipping {this_path}: it is not a path in the bucket")
+            continue
+        prefix = f"{parts[0]}/{parts[1]}/"
+        #A listed file may be corrupt with the right size and modtime, so it is copied whatever the destination looks like
+        this_job = jobs_by_prefix.setdefault(prefix, {'prefix': prefix, 'docket_depth': 1, 'years': [], 'file_types': ['*'], 'files': [], 'ignore_times': True})
+        this_job['files'].append('/'.join(parts[2:]))
+
+    return [jobs_by_prefix[this_prefix] for this_prefix in sorted(jobs_by_prefix)]
+
+
+def split_text_first(jobs):
+    """Split jobs into a text phase and a binary phase, with every text job ahead of every binary job.
+
+    Each raw-data job becomes a text half (everything but the binary-{docketID} directories) and a binary half.
+    derived-data is all text, so it only goes into the text phase.
+    """
+    text_jobs = []
+    binary_jobs = []
+    for this_job in jobs:
+        text_jobs.append(dict(this_job, section='text', name=f"text:{this_job['name']}"))
+        if this_job['prefix'].startswith('raw-data/'):
+            binary_jobs.append(dict(this_job, section='binary', name=f"binary:{this_job['name']}"))
+    return text_jobs + binary_jobs
+
+
+def text_group_key(job):
+    """Text jobs that cover the same dockets (raw-data/CMS/ and derived-data/CMS/, say) share a key"""
+    return job['prefix'].split('/', 1)[1], tuple(job['years'])
+
+
+def job_writes_docket(job, data_directory, agency, docket_id):
+    """True when a job copies into a docket's directory: below its prefix, in its years and, for a shard, in its dockets"""
+    parts = job['prefix'].strip('/').split('/')
+    if parts[0] != data_directory or (len(parts) > 1 and parts[1] != agency) or (len(parts) > 2 and parts[2] != docket_id):
+        return False
+    if 'dockets' in job and docket_id not in job['dockets']:
+        return False
+    return not job['years'] or docket_year(docket_id) in job['years']
+
+
+def list_job_dockets(dest_dir, job):
+    """The (agency, docket id) of every docket a job has put in the destination"""
+    data_directory = job['prefix'].split('/')[0]
+    return {(agency, docket_id) for agency, docket_id, docket_dir in mirrulations_archive.iter_prefix_dockets(dest_dir, job['prefix'])
+            if job_writes_docket(job, data_directory, agency, docket_id)}
+
+
+def mark_text_complete(dest_dir, dockets):
+    """Drop a marker for each docket whose text and metadata have all been downloaded, so processing can start on it"""
+    for agency, docket_id in sorted(dockets):
+        marker_file = os.path.join(dest_dir, TEXT_COMPLETE_DIR_NAME, agency, docket_id)
+        os.makedirs(os.path.dirname(marker_file), exist_ok=True)
+        with open(marker_file + '.tmp', 'w') as file_handle:
+            file_handle.write(json.dumps({'docket': docket_id, 'agency': agency, 'completed_at': time.time()}) + "\n")
+        os.replace(marker_file + '.tmp', marker_file)
+
+
+def brace_alternation(items):
+    """Join items into an rclone glob alternation like {a,b,c}, or just the item when there is only one"""
+    items = [str(item) for item in items]
+    if len(items) == 1:
+        return items[0]
+    return "{" + ",".join(items) + "}"
+
+
+def job_docket_glob(job):
+    """The rclone glob, relative to a job's prefix, that matches the docket directories the job keeps"""
+    #Everything between the prefix and the docket directories is an agency (or nothing at all)
+    agency_levels = '/*' * (job['docket_depth'] - 1) if job['docket_depth'] > 0 else ''
+    if job['docket_depth'] == 0:
+        return ''
+    if 'dockets' in job:
+        #This machine's slice of the dockets (--shard) or the dockets picked by their attributes, already narrowed down to the job's years
+        return f"{agency_levels}/{brace_alternation(job['dockets'])}"
+    if job['years']:
+        return f"{agency_levels}/*-{brace_alternation(job['years'])}-*"
+    return f"{agency_levels}/*"
+
+
+def compile_filter_rules(job, textonly):
+    """Compile a job from plan_copy_jobs into a short, fixed order list of rclone filter rules.
+
+    Instead of one --include per agency x year x file type combination, years and file types are folded into
+    brace alternations, so there is a single include rule however big the selection is.
+    Returns an empty list when everything below the prefix should be copied.
+    """
+    file_types = sorted(job['file_types'])
+    if not job['years'] and file_types == ['*'] and not textonly and not job.get('section') and 'dockets' not in job:
+        return []
+
+    if file_types == ['*']:
+        file_type_glob = '*'
+    elif all(this_file_type.startswith('*.') for this_file_type in file_types):
+        file_type_glob = '*.' + brace_alternation([this_file_type[2:] for this_file_type in file_types])
+    else:
+        file_type_glob = brace_alternation(file_types)
+
+    docket_glob = job_docket_glob(job)
+
+    rules = []
+    if job.get('section') == 'binary':
+        #The second half of a text-first run only wants the attachments
+        rules.append(f"+ {docket_glob}/binary-*/**")
+    else:
+        if (textonly or job.get('section') == 'text') and job['prefix'].startswith('raw-data/'):
+            #Prune the binary directories outright, so rclone never even lists them
+            rules.append(f"- {'/*' * job['docket_depth']}/binary-*/**")
+        rules.append(f"+ {docket_glob}/**/{file_type_glob}")
+    rules.append("- **")
+
+    return rules
+
+
+def write_state_list_file(directory_name, file_prefix, lines):
+    """Write lines to a file under the state directory named after their content, so identical lists share one file, and return its path.
+
+    The lines can come from any iterable and are written as they come, so a list of millions of files is never held in memory twice.
+    """
+    list_dir = os.path.join(get_state_dir(), directory_name)
+    os.makedirs(list_dir, exist_ok=True)
+
+    content_hash = hashlib.sha1()
+    temporary_fd, temporary_file = tempfile.mkstemp(dir=list_dir, suffix='.tmp')
+    with os.fdopen(temporary_fd, 'w') as file_handle:
+        for this_line in lines:
+            this_line = f"{this_line}\n"
+            content_hash.update(this_line.encode('utf-8'))
+            file_handle.write(this_line)
+
+    list_file = os.path.join(list_dir, f"{file_prefix}-{content_hash.hexdigest()[:12]}.txt")
+    if os.path.isfile(list_file):
+        os.remove(temporary_file)
+    else:
+        os.replace(temporary_file, list_file)
+
+    return list_file
+
+
+def write_filter_file(rules):
+    """Write filter rules to a file for rclone --filter-from and return its path"""
+    return write_state_list_file('filters', 'filter', rules)
+
+
+def build_rclone_command(job, dest_dir, rclone_config_file, always_flags, textonly=False):
+    """Build the rclone copy command for a single job from plan_copy_jobs.
+
+    Jobs that were resolved against the manifest carry a 'files' list, which is passed as an exact --files-from list
+    instead of a filter, so rclone does not have to list the source at all. The destination is local disk, where
+    checking each file is cheap, so we skip listing that too.
+    A job with a 'staging_dir' copies into that instead, skipping whatever the destination already has.
+    """
+    source = f"{get_remote()}{job['prefix']}"
+    destination = os.path.join(dest_dir, job['prefix'])
+
+    if job.get('staging_dir'):
+        this_command = f"rclone copy {source} {os.path.join(job['staging_dir'], job['prefix'])} --compare-dest {destination} --config {rclone_config_file} {always_flags}"
+    else:
+        this_command = f"rclone copy {source} {destination} --config {rclone_config_file} {always_flags}"
+
+    if 'files' in job:
+        this_command += f" --files-from '{write_state_list_file('files-from', 'files', job['files'])}' --no-traverse "
+        if job.get('ignore_times'):
+            this_command += " --ignore-times "
+    else:
+        filter_rules = compile_filter_rules(job, textonly)
+        if filter_rules:
+            this_command += f" --filter-from '{write_filter_file(filter_rules)}' "
+
+    return this_command
+
+
+def list_bucket_agencies(rclone_config_file):
+    """Every agency that has a directory in either of the data directories of the bucket"""
+    agencies = set()
+    for this_data_directory in DATA_DIRECTORIES:
+        agencies.update(mirrulations_manifest.list_remote_directories(get_remote(), rclone_config_file, f"{this_data_directory}/"))
+    return sorted(agencies)
+
+
+def format_bytes(size):
+    """Human readable size, like rclone prints them"""
+    for this_unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if size < 1024 or this_unit == 'TiB':
+            return f"{size:.1f} {this_unit}" if this_unit != 'B' else f"{size} B"
+        size /= 1024
+
+
+def print_plan(manifest_connection, jobs, textonly, parallel):
+    """Report what the selection covers, per agency and year, and estimate how long it would take from past throughput"""
+    kinds = ['raw text', 'raw binary', 'derived']
+    totals = {}
+    for this_job in jobs:
+        for agency, year, kind, object_count, total_bytes in mirrulations_manifest.summarize_job(manifest_connection, this_job, textonly):
+            counts = totals.setdefault((agency or '', year or 0), {this_kind: [0, 0] for this_kind in kinds})
+            counts[kind][0] += object_count
+            counts[kind][1] += total_bytes or 0
+
+    print(f"{'Agency':<12}{'Year':>6}" + "".join(f"{this_kind:>28}" for this_kind in kinds) + f"{'total':>28}")
+    grand_totals = {this_kind: [0, 0] for this_kind in kinds}
+    for (agency, year), counts in sorted(totals.items()):
+        row = f"{agency:<12}{year or '?':>6}"
+        for this_kind in kinds:
+            row += f"{counts[this_kind][0]:>12,} / {format_bytes(counts[this_kind][1]):>13}"
+            grand_totals[this_kind][0] += counts[this_kind][0]
+            grand_totals[this_kind][1] += counts[this_kind][1]
+        row += f"{sum(this_count[0] for this_count in counts.values()):>12,} / {format_bytes(sum(this_count[1] for this_count in counts.values())):>13}"
+        print(row)
+
+    row = f"{'total':<18}"
+    for this_kind in kinds:
+        row += f"{grand_totals[this_kind][0]:>12,} / {format_bytes(grand_totals[this_kind][1]):>13}"
+    total_objects = sum(this_count[0] for this_count in grand_totals.values())
+    total_bytes = sum(this_count[1] for this_count in grand_totals.values())
+    row += f"{total_objects:>12,} / {format_bytes(total_bytes):>13}"
+    print(row)
+
+    #Small text files are limited by how many files per second we move, attachments by bytes per second
+    text_rate = mirrulations_tuning.average_throughput('text')
+    binary_rate = mirrulations_tuning.average_throughput('binary')
+    if not text_rate and not binary_rate:
+        print("\nNo throughput history yet, so no time estimate. Any finished download will provide one.")
+        return
+
+    estimate = 0
+    text_objects = grand_totals['raw text'][0] + grand_totals['derived'][0]
+    if text_objects:
+        if text_rate and text_rate['files_per_second'] > 0:
+            estimate += text_objects / text_rate['files_per_second']
+        else:
+            print("No throughput history for text files, the estimate leaves them out")
+    if grand_totals['raw binary'][1]:
+        if binary_rate and binary_rate['bytes_per_second'] > 0:
+            estimate += grand_totals['raw binary'][1] / binary_rate['bytes_per_second']
+        else:
+            print("No throughput history for binary attachments, the estimate leaves them out")
+
+    #The history is per shard, so running several shards at once divides the time (assuming the link keeps up)
+    estimate = round(estimate / parallel)
+    print(f"\nEstimated time with --parallel {parallel}: {datetime.timedelta(seconds = estimate)} (from the throughput of past runs)")
+
+
+def resolve_jobs_with_manifest(manifest_connection, jobs, textonly, delta):
+    """Attach the exact list of files to copy to each job, dropping the jobs that have nothing to copy.
+
+    In delta mode only the objects that are new or changed since the last successful run are kept,
+    and a per docket report of added, changed and unchanged objects is printed.
+    """
+    resolved_jobs = []
+    docket_counts = {}
+
+    for this_job in jobs:
+        if delta:
+            this_job['files'], job_docket_counts = mirrulations_manifest.select_job_delta(manifest_connection, this_job, textonly)
+            for this_docket, counts in job_docket_counts.items():
+                total_counts = docket_counts.setdefault(this_docket, {'added': 0, 'changed': 0, 'unchanged': 0})
+                for this_status, count in counts.items():
+                    total_counts[this_status] += count
+        else:
+            this_job['files'] = mirrulations_manifest.select_job_paths(manifest_connection, this_job, textonly)
+
+        if this_job['files']:
+            resolved_jobs.append(this_job)
+        else:
+            print(f"Nothing to copy for {this_job['name']}, skipping it")
+
+    if delta:
+        print("Changes since the last successful run:")
+        for this_docket in sorted(docket_counts, key=str):
+            counts = docket_counts[this_docket]
+            print(f"\t{this_docket}: {counts['added']} added, {counts['changed']} changed, {counts['unchanged']} unchanged")
+
+    return resolved_jobs
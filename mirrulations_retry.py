@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import random
+
+from mirrulations_config import get_state_dir
+
+#Retries only the files a job failed to copy, instead of the whole job. rclone's JSON log has an error entry naming
+#the object for every file it gave up on. Those files go into a RetryQueue, which decides from the kind of error
+#whether and when to try each one again, and are copied again as a small --files-from job.
+#(rclone's own --retries would run the whole job again, checking every object, so it is set to 1 when we retry.)
+
+RCLONE_RETRY_FLAGS = " --retries 1 "
+
+#The error classes, and words in rclone's error message that put an error in them. The first class that matches wins
+ERROR_CLASSES = [
+    ('throttled', ['slowdown', 'slow down', ' 503', ' 429', 'too many requests', 'requestlimitexceeded', 'throttl', 'rate exceeded']),
+    ('not_found', ['nosuchkey', ' 404', 'object not found', 'not found']),
+    ('forbidden', ['accessdenied', 'access denied', ' 403', 'forbidden']),
+    ('local', ['no space left on device', 'read-only file system', 'disk quota exceeded', 'permission denied', 'file name too long']),
+    ('transient', ['timeout', 'connection reset', 'connection refused', 'broken pipe', 'unexpected eof', ' 500', ' 502', ' 504',
+                   'internalerror', 'serviceunavailable', 'temporary']),
+]
+
+#How many times each class of error is retried, the delay before the first retry and the longest delay, in seconds.
+#The delay doubles with each attempt. Objects that are gone, that we may not read, or that the local disk cannot take
+#are not worth retrying in the same run.
+RETRY_POLICIES = {
+    'throttled': {'attempts': 5, 'delay': 30, 'max_delay': 600},
+    'transient': {'attempts': 4, 'delay': 5, 'max_delay': 120},
+    'other': {'attempts': 2, 'delay': 10, 'max_delay': 60},
+    'not_found': {'attempts': 0},
+    'forbidden': {'attempts': 0},
+    'local': {'attempts': 0},
+}
+
+#rclone's closing summaries of a run are logged as errors too, but they are not about any one file
+SUMMARY_MESSAGE_PATTERN = re.compile(r'^(Attempt \d+/\d+ (failed|succeeded)|Failed to \w+ with \d+ errors|There was nothing to transfer)')
+
+#How many still failing files we print, the full list is in the report
+PRINTED_PATHS = 20
+
+
+def classify_error(message):
+    """Which class of ERROR_CLASSES an rclone error message belongs to, or 'other'"""
+    message = f" {message}".lower()
+    for error_class, markers in ERROR_CLASSES:
+        if any(this_marker in message for this_marker in markers):
+            return error_class
+    return 'other'
+
+
+def parse_error_line(line):
+    """Read an rclone JSON log line. Returns (object, message) for an error about one file, (None, message) for an error
+    about something else (a directory that could not be listed...), and None for every other line"""
+    if '"error"' not in line:
+        return None
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if entry.get('level') != 'error':
+        return None
+    message = str(entry.get('msg', '')).strip()
+    if SUMMARY_MESSAGE_PATTERN.match(message):
+        return None
+    object_path = entry.get('object')
+    if not object_path or object_path.endswith('/') or 'Object' not in entry.get('objectType', 'Object'):
+        return None, message
+    return object_path, message
+
+
+def read_failed_transfers(log_file, start_offset=0):
+    """The files an rclone run logged errors for after start_offset in its log.
+
+    Returns a dict of object path (relative to what was copied) -> last error message, and a list of the errors that
+    were not about a file, which a retry of single files cannot fix.
+    """
+    failures = {}
+    other_errors = []
+    if not os.path.isfile(log_file):
+        return failures, other_errors
+
+    with open(log_file, 'rb') as file_handle:
+        file_handle.seek(start_offset)
+        for this_line in file_handle:
+            parsed = parse_error_line(this_line.decode('utf-8', errors='replace'))
+            if parsed is None:
+                continue
+            object_path, message = parsed
+            if object_path is None:
+                other_errors.append(message)
+            else:
+                failures[object_path] = message
+    return failures, other_errors
+
+
+def backoff_delay(policy, attempt):
+    """Seconds to wait before retry number `attempt` (from 1): doubling from the policy's delay up to its maximum,
+    with some jitter so that many shards that were throttled together do not all come back at the same moment"""
+    delay = min(policy['max_delay'], policy['delay'] * 2 ** (attempt - 1))
+    return delay * random.uniform(0.75, 1.25)
+
+
+class RetryQueue:
+    """The failed files of one job, each with its error class, the attempts so far and when it is due again.
+
+    record() takes the outcome of each attempt: the files that failed again stay queued (or are given up on once their
+    policy runs out), and the files that were retried and did not fail are done.
+    """
+
+    def __init__(self, policies=None):
+        self.policies = policies or RETRY_POLICIES
+        self.queued = {}
+        self.given_up = {}
+        self.failed = set()
+
+    def record(self, failures, retried=()):
+        now = time.time()
+        for this_path in retried:
+            if this_path not in failures:
+                self.queued.pop(this_path, None)
+
+        for this_path, message in failures.items():
+            self.failed.add(this_path)
+            item = self.queued.pop(this_path, None) or {'attempts': 0}
+            item['attempts'] += 1
+            item['message'] = message
+            item['error_class'] = classify_error(message)
+            policy = self.policies.get(item['error_class'], self.policies['other'])
+            #The first attempt was the job itself, so a policy of n attempts allows n retries after it
+            if item['attempts'] > policy['attempts']:
+                self.given_up[this_path] = item
+            else:
+                item['due_at'] = now + backoff_delay(policy, item['attempts'])
+                self.queued[this_path] = item
+
+    def next_due(self):
+        """When the next file is due, or None when nothing is queued"""
+        return min((this_item['due_at'] for this_item in self.queued.values()), default=None)
+
+    def take_due(self):
+        """The files that are due now, sorted"""
+        now = time.time()
+        return sorted(this_path for this_path, this_item in self.queued.items() if this_item['due_at'] <= now)
+
+    def give_up(self, message):
+        """Stop retrying everything still queued, e.g. when a retry failed in a way that is not about single files"""
+        for this_path, this_item in self.queued.items():
+            this_item['message'] = message
+            self.given_up[this_path] = this_item
+        self.queued = {}
+
+    def summary(self):
+        return {
+            'failed': len(self.failed),
+            'recovered': len(self.failed - set(self.given_up) - set(self.queued)),
+            'still_failing': {this_path: {'error_class': this_item['error_class'], 'message': this_item['message'], 'attempts': this_item['attempts']}
+                              for this_path, this_item in sorted(self.given_up.items())},
+        }
+
+
+def write_still_failing(still_failing, report_dir=None):
+    """Write the files that are still failing as a --files-from list, with their errors next to it as JSON, and return the list's path"""
+    report_dir = report_dir or os.path.join(get_state_dir(), 'retry')
+    os.makedirs(report_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    list_file = os.path.join(report_dir, f"still-failing-{stamp}.txt")
+    with open(list_file, 'w') as file_handle:
+        file_handle.write("".join(f"{this_path}\n" for this_path in sorted(still_failing)))
+    with open(os.path.join(report_dir, f"still-failing-{stamp}.json"), 'w') as file_handle:
+        json.dump(still_failing, file_handle, indent=1, sort_keys=True)
+    return list_file
+
+
+def print_retry_summary(failed, recovered, still_failing, list_file=None):
+    print(f"{failed} files failed to copy: {recovered} recovered by retrying them, {len(still_failing)} still failing")
+    for this_path in sorted(still_failing)[:PRINTED_PATHS]:
+        details = still_failing[this_path]
+        print(f"\tstill failing: {this_path} ({details['error_class']} after {details['attempts']} attempts: {details['message']})")
+    if len(still_failing) > PRINTED_PATHS:
+        print(f"\t... and {len(still_failing) - PRINTED_PATHS} more")
+    if list_file:
+        print(f"To try them again: python mirrulations_bulk_downloader.py --files-from {list_file}")
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import hashlib
+
+from mirrulations_config import get_remote, get_state_dir, parse_bucket_path
+from mirrulations_pacing import RATE_SUFFIXES
+import mirrulations_manifest
+import mirrulations_verify
+import mirrulations_planning
+
+#Quick exploratory pulls: a sample of the comments of each docket instead of all of them, and caps on the size of
+#single binaries and of each docket. Every job's objects are listed once (or read from the manifest), and the job is
+#handed the files it keeps as an exact --files-from list, so rclone does not list anything again.
+#
+#Everything that belongs to a comment is named after its id: comments/{commentID}.json, the attachments in
+#binary-{docketID}/comments_attachements/{commentID}_attachment_{n}.{ext} and the text extracted from them in
+#derived-data/.../comments_extracted_text/{tool}/{commentID}_attachment_{n}.txt. A comment is in the sample when a
+#hash of the seed and its id says so, so the same seed always picks the same comments, on every machine and every
+#run. The docket and document files are always kept.
+
+#How many skipped files we print, the full list is in the report
+PRINTED_PATHS = 20
+
+
+def parse_size(size):
+    """Turn an rclone size like 500K or 20M into bytes. Plain numbers are KiB, as in rclone's --max-size"""
+    size = str(size).strip()
+    number, multiplier = size, RATE_SUFFIXES['K']
+    if size and size[-1].upper() in RATE_SUFFIXES:
+        number, multiplier = size[:-1], RATE_SUFFIXES[size[-1].upper()]
+    try:
+        size_bytes = float(number) * multiplier
+    except ValueError:
+        raise ValueError(f"{size} is not a size, use something like 500K, 20M or 1G")
+    if size_bytes <= 0:
+        raise ValueError(f"{size}: a size cap has to be more than 0")
+    return int(size_bytes)
+
+
+def check_sampling(sampling):
+    """Check a selection's sampling settings and turn them into what sample_jobs() takes. Raises ValueError.
+
+    'sample' is a fraction of the comments (5% or 0.05) or a number of comments per docket (200), 'seed' picks which
+    ones, 'attachments' keeps the sampled comments' attachments too, and 'max_file_size' and 'max_docket_size' cap
+    the binaries in rclone's size syntax.
+    """
+    unknown = sorted(set(sampling) - {'sample', 'seed', 'attachments', 'max_file_size', 'max_docket_size'})
+    if unknown:
+        raise ValueError(f"Unknown sampling settings: {', '.join(unknown)}")
+
+    checked = {'seed': int(sampling.get('seed') or 0), 'attachments': bool(sampling.get('attachments'))}
+    sample = str(sampling.get('sample') or '').strip()
+    if sample:
+        try:
+            if sample.endswith('%'):
+                checked['fraction'] = float(sample[:-1]) / 100
+            elif '.' in sample:
+                checked['fraction'] = float(sample)
+            else:
+                checked['per_docket'] = int(sample)
+        except ValueError:
+            raise ValueError(f"--sample must be a fraction (5% or 0.05) or a number of comments per docket (200), not {sample}")
+        if not 0 < checked.get('fraction', 1) <= 1 or checked.get('per_docket', 1) < 1:
+            raise ValueError(f"--sample {sample}: a fraction has to be more than 0 and at most 100%, a number at least 1")
+
+    for this_key in ['max_file_size', 'max_docket_size']:
+        if sampling.get(this_key):
+            checked[this_key] = parse_size(sampling[this_key])
+    return checked
+
+
+def is_sampling(sampling):
+    """True when the checked settings leave anything out at all"""
+    return any(this_key in sampling for this_key in ['fraction', 'per_docket', 'max_file_size', 'max_docket_size'])
+
+
+def sample_key(seed, comment_id):
+    """Where a comment falls between 0 and 1 for a seed. It is in a sample of fraction f when this is below f"""
+    return int(hashlib.sha1(f"{seed}:{comment_id}".encode('utf-8')).hexdigest()[:15], 16) / 16 ** 15
+
+
+def comment_id_of(bucket_path):
+    """The id of the comment a file belongs to, or None for the docket's other files"""
+    parts = bucket_path.split('/')
+    if not any(this_part.startswith('comments') for this_part in parts[3:-1]):
+        return None
+    file_name = parts[-1]
+    if '_attachment_' in file_name:
+        return file_name.split('_attachment_')[0]
+    return os.path.splitext(file_name)[0]
+
+
+def is_comment_record(bucket_path):
+    parts = bucket_path.split('/')
+    return len(parts) == 6 and parts[0] == 'raw-data' and parts[4] == 'comments' and parts[5].endswith('.json')
+
+
+def iter_job_entries(job, textonly, manifest_connection, rclone_config_file):
+    """(path relative to the job's prefix, size) of every object a job copies, from the manifest or a listing of its prefix"""
+    if manifest_connection:
+        yield from mirrulations_manifest.select_job_entries(manifest_connection, job, textonly)
+        return
+
+    dockets = set(job['dockets']) if 'dockets' in job else None
+    for this_path, size, mtime in mirrulations_manifest.iter_remote_listing(get_remote(), rclone_config_file, job['prefix']):
+        parsed = parse_bucket_path(this_path)
+        if not mirrulations_verify.path_matches_job(this_path, job, textonly):
+            continue
+        if dockets is not None and parsed['docket'] not in dockets:
+            continue
+        #The text or the binary half of a text-first job
+        if job.get('section') and (job['section'] == 'binary') != (parsed['section'] == 'binary'):
+            continue
+        yield this_path[len(job['prefix']):], size
+
+
+def sample_jobs(jobs, sampling, textonly, manifest_connection=None, rclone_config_file=None):
+    """Give every job the exact list of files it keeps under the sampling settings, dropping the jobs that keep none.
+
+    Jobs that already have a list of files (from the manifest, --delta or --files-from) keep a part of it.
+    Returns the jobs and a summary with how many comments were sampled and which files the size caps skipped.
+    A sample of N comments per docket is taken from the comments' JSON, so the raw-data and derived-data of a docket
+    agree on it. The binaries of each docket go in smallest first until --max-docket-size is reached.
+    """
+    entries = []
+    for index, this_job in enumerate(jobs):
+        listed = set(this_job['files']) if 'files' in this_job else None
+        for this_path, size in iter_job_entries(this_job, textonly, manifest_connection, rclone_config_file):
+            if listed is None or this_path in listed:
+                entries.append((index, this_job['prefix'] + this_path, size or 0))
+
+    #Which comments are in the sample
+    comment_ids = {}
+    for index, this_path, size in entries:
+        comment_id = comment_id_of(this_path)
+        if comment_id:
+            parsed = parse_bucket_path(this_path)
+            comment_ids.setdefault((parsed['agency'], parsed['docket']), {}).setdefault(comment_id, False)
+            if is_comment_record(this_path):
+                comment_ids[(parsed['agency'], parsed['docket'])][comment_id] = True
+
+    sampled = set()
+    for this_docket, docket_comments in comment_ids.items():
+        if 'per_docket' in sampling:
+            #Dockets whose comments' JSON is not part of this run sample from whatever else names their comments
+            candidates = [this_id for this_id, has_record in docket_comments.items() if has_record] or list(docket_comments)
+            sampled.update(sorted(candidates, key=lambda comment_id: sample_key(sampling['seed'], comment_id))[:sampling['per_docket']])
+        elif 'fraction' in sampling:
+            sampled.update(this_id for this_id in docket_comments if sample_key(sampling['seed'], this_id) < sampling['fraction'])
+        else:
+            sampled.update(docket_comments)
+
+    kept = {index: [] for index in range(len(jobs))}
+    skipped = {}
+    docket_bytes = {}
+    binaries = {}
+    for index, this_path, size in entries:
+        parsed = parse_bucket_path(this_path)
+        this_docket = (parsed['agency'], parsed['docket'])
+        comment_id = comment_id_of(this_path)
+        if comment_id and comment_id not in sampled:
+            continue
+        if parsed['section'] != 'binary':
+            docket_bytes[this_docket] = docket_bytes.get(this_docket, 0) + size
+            kept[index].append(this_path)
+        elif comment_id and not sampling['attachments'] and ('fraction' in sampling or 'per_docket' in sampling):
+            continue
+        elif 'max_file_size' in sampling and size > sampling['max_file_size']:
+            skipped[this_path] = {'size': size, 'reason': 'max_file_size'}
+        else:
+            binaries.setdefault(this_docket, []).append((size, this_path, index))
+
+    for this_docket, docket_binaries in binaries.items():
+        for size, this_path, index in sorted(docket_binaries):
+            if 'max_docket_size' in sampling and docket_bytes.get(this_docket, 0) + size > sampling['max_docket_size']:
+                skipped[this_path] = {'size': size, 'reason': 'max_docket_size'}
+                continue
+            docket_bytes[this_docket] = docket_bytes.get(this_docket, 0) + size
+            kept[index].append(this_path)
+
+    sampled_jobs = []
+    for index, this_job in enumerate(jobs):
+        this_job['files'] = sorted(this_path[len(this_job['prefix']):] for this_path in kept[index])
+        if this_job['files']:
+            sampled_jobs.append(this_job)
+
+    summary = {'comments': sum(len(this_comments) for this_comments in comment_ids.values()), 'sampled_comments': len(sampled),
+               'dockets': len(comment_ids), 'files': sum(len(this_files) for this_files in kept.values()), 'skipped': skipped}
+    return sampled_jobs, summary
+
+
+def write_skipped(skipped, report_dir=None):
+    """Write the files the size caps skipped as a --files-from list, with their sizes and reasons next to it as JSON, and return the list's path"""
+    report_dir = report_dir or os.path.join(get_state_dir(), 'sampling')
+    os.makedirs(report_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    list_file = os.path.join(report_dir, f"skipped-{stamp}.txt")
+    with open(list_file, 'w') as file_handle:
+        file_handle.write("".join(f"{this_path}\n" for this_path in sorted(skipped)))
+    with open(os.path.join(report_dir, f"skipped-{stamp}.json"), 'w') as file_handle:
+        json.dump(skipped, file_handle, indent=1, sort_keys=True)
+    return list_file
+
+
+def print_sampling_summary(summary, list_file=None):
+    if summary['comments']:
+        print(f"Sampled {summary['sampled_comments']} of {summary['comments']} comments in {summary['dockets']} dockets")
+    skipped = summary['skipped']
+    if not skipped:
+        return
+    skipped_bytes = sum(this_file['size'] for this_file in skipped.values())
+    print(f"Skipped {len(skipped)} binaries ({mirrulations_planning.format_bytes(skipped_bytes)}) over the size caps")
+    for this_path in sorted(skipped, key=lambda this_path: -skipped[this_path]['size'])[:PRINTED_PATHS]:
+        print(f"\tskipped: {this_path} ({mirrulations_planning.format_bytes(skipped[this_path]['size'])}, {skipped[this_path]['reason']})")
+    if len(skipped) > PRINTED_PATHS:
+        print(f"\t... and {len(skipped) - PRINTED_PATHS} more")
+    if list_file:
+        print(f"To download them later: python mirrulations_bulk_downloader.py --files-from {list_file}")
@@ -0,0 +1,60 @@
+import os
+import time
+import sqlite3
+import click
+
+from mirrulations_index import open_index, search_text
+
+#Full-text search over the comments, documents and extracted attachment text that mirrulations_index.py (or a
+#download with --index) has indexed. Queries use SQLite's FTS5 syntax:
+#    python mirrulations_search.py '"prior authorization"' -a CMS
+#    python mirrulations_search.py 'telehealth AND rural NOT medicare' --kind comment
+#    python mirrulations_search.py 'authoriz*' -d CMS-2025-0050
+
+
+@click.command()
+@click.argument('query')
+@click.option('--agency', '-a', default='', help="Only search these agencies (separated by commas).")
+@click.option('--docket', '-d', default='', help="Only search these dockets (separated by commas).")
+@click.option('--kind', default='', help="Only search these kinds of text, separated by commas: comment, document, attachment")
+@click.option('--phrase', is_flag=True, help="Search for the query as one exact phrase instead of using FTS5 query syntax")
+@click.option('--limit', default=20, type=int, help="How many matches to show, best first (default is 20)")
+@click.option('--index-path', default='', help="The index to search (default is comments_index.sqlite in MIRRULATIONS_STATE_PATH)")
+def main(query, agency, docket, kind, phrase, limit, index_path):
+    """Search the text of the downloaded data for QUERY"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()]
+    docket_list = [docket.strip() for docket in docket.split(',') if docket.strip()]
+    kinds = [kind.strip() for kind in kind.split(',') if kind.strip()]
+
+    unknown_kinds = set(kinds) - {'comment', 'document', 'attachment'}
+    if unknown_kinds:
+        print(f"Error: unknown kinds {', '.join(sorted(unknown_kinds))}, use comment, document or attachment")
+        exit()
+
+    if phrase:
+        query = '"' + query.replace('"', '""') + '"'
+
+    try:
+        connection = open_index(index_path or None)
+    except RuntimeError as error:
+        print(f"Error: {error}")
+        exit()
+
+    start_time = time.time()
+    try:
+        matches = search_text(connection, query, agency_list, docket_list, kinds, limit)
+    except sqlite3.OperationalError as error:
+        print(f"Error: {query} is not a valid search ({error}). Use --phrase to search for it as it is")
+        exit()
+    elapsed_time = time.time() - start_time
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH') or ''
+    for this_match in matches:
+        print(f"{this_match['kind']} {this_match['record_id']} ({this_match['docket_id']})")
+        print(f"\t{os.path.join(dest_dir, this_match['path'])}")
+        print(f"\t{this_match['snippet']}")
+    print(f"{len(matches)} matches in {elapsed_time * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
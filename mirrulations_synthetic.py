@@ -0,0 +1,136 @@
+import os
+import json
+import random
+import click
+
+#Generates a synthetic mirrulations bucket on local disk, laid out like the real one:
+#    raw-data/{agency}/{docketID}/text-{docketID}/{docket,documents,comments}/...
+#    raw-data/{agency}/{docketID}/binary-{docketID}/comments_attachements/...
+#    derived-data/{agency}/{docketID}/mirrulations/extracted_txt/comments_extracted_text/pdfminer/...
+#A local directory can stand in for the bucket (set MIRRULATIONS_REMOTE to it), or the tree can be copied into a local
+#S3 stand-in such as MinIO with rclone. The same seed always produces the same tree, down to the file sizes and mtimes.
+
+#Every file gets this mtime (plus its index in seconds), so two trees from the same seed list identically
+BASE_MTIME = 1704067200
+
+#Attachment formats and how likely each one is
+ATTACHMENT_FORMATS = [('pdf', 0.7), ('docx', 0.2), ('jpg', 0.1)]
+
+
+def padded_bytes(header, size, rng):
+    """header followed by filler, so the file is exactly size bytes (or just the header if that is longer)"""
+    header = header.encode('utf-8')
+    if size <= len(header):
+        return header
+    return header + rng.randbytes(size - len(header))
+
+
+def text_filler(size, rng):
+    words = ['comment', 'rule', 'agency', 'public', 'health', 'program', 'support', 'oppose', 'please', 'cost']
+    text = []
+    length = 0
+    while length < size:
+        this_word = rng.choice(words)
+        text.append(this_word)
+        length += len(this_word) + 1
+    return " ".join(text)[:size]
+
+
+def comment_record(agency, docket_id, comment_id, year, attachment_ids, comment_size, rng):
+    return {
+        'data': {
+            'id': comment_id,
+            'type': 'comments',
+            'attributes': {
+                'agencyId': agency,
+                'docketId': docket_id,
+                'commentOnDocumentId': f"{docket_id}-0001",
+                'documentType': 'Public Submission',
+                'postedDate': f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T05:00:00Z",
+                'title': f"Comment from {rng.choice(['Anonymous', 'a citizen', 'an organization'])}",
+                'comment': text_filler(comment_size, rng),
+            },
+            'relationships': {'attachments': {'data': [{'id': this_id, 'type': 'attachments'} for this_id in attachment_ids]}},
+        },
+        'included': [{'id': this_id, 'type': 'attachments', 'attributes': {'title': 'Attachment', 'fileFormats': []}} for this_id in attachment_ids],
+    }
+
+
+def generate_bucket(root_dir, agencies=3, dockets_per_agency=4, comments_per_docket=25, years=(2020, 2025),
+                    attachment_rate=0.3, comment_size=2000, attachment_size=200000, seed=0):
+    """Write a synthetic bucket below root_dir and return how many files and bytes it holds.
+
+    Comment text sizes and attachment sizes are drawn from exponential distributions around comment_size and
+    attachment_size, which gives the long tail of a few very large files that the real bucket has.
+    """
+    rng = random.Random(seed)
+    totals = {'files': 0, 'bytes': 0}
+    agency_names = [f"AG{this_index:02d}" if agencies > 3 else ['CMS', 'EPA', 'FDA'][this_index] for this_index in range(agencies)]
+
+    def write(relative_path, data):
+        file_path = os.path.join(root_dir, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as file_handle:
+            file_handle.write(data)
+        os.utime(file_path, (BASE_MTIME + totals['files'], BASE_MTIME + totals['files']))
+        totals['files'] += 1
+        totals['bytes'] += len(data)
+
+    for agency in agency_names:
+        for docket_number in range(1, dockets_per_agency + 1):
+            year = rng.randint(years[0], years[1])
+            docket_id = f"{agency}-{year}-{docket_number:04d}"
+            raw_dir = f"raw-data/{agency}/{docket_id}"
+            text_dir = f"{raw_dir}/text-{docket_id}"
+
+            write(f"{text_dir}/docket/{docket_id}.json", json.dumps({'data': {'id': docket_id, 'type': 'dockets', 'attributes': {
+                'agencyId': agency, 'title': f"Synthetic docket {docket_id}", 'docketType': 'Rulemaking'}}}).encode('utf-8'))
+            document_id = f"{docket_id}-0001"
+            write(f"{text_dir}/documents/{document_id}.json", json.dumps({'data': {'id': document_id, 'type': 'documents', 'attributes': {
+                'agencyId': agency, 'docketId': docket_id, 'documentType': 'Proposed Rule', 'postedDate': f"{year}-01-02T05:00:00Z"}}}).encode('utf-8'))
+            write(f"{text_dir}/documents/{document_id}_content.htm", f"<html><body>{text_filler(comment_size * 5, rng)}</body></html>".encode('utf-8'))
+
+            for comment_number in range(2, comments_per_docket + 2):
+                comment_id = f"{docket_id}-{comment_number:04d}"
+                attachment_ids = []
+                if rng.random() < attachment_rate:
+                    attachment_ids = [f"{comment_id}_attachment_{this_index}" for this_index in range(1, rng.choice([1, 1, 1, 2, 3]) + 1)]
+
+                record = comment_record(agency, docket_id, comment_id, year, attachment_ids, int(rng.expovariate(1 / comment_size)) + 1, rng)
+                write(f"{text_dir}/comments/{comment_id}.json", json.dumps(record).encode('utf-8'))
+
+                for this_attachment in attachment_ids:
+                    file_format = rng.choices([this_format for this_format, weight in ATTACHMENT_FORMATS], [weight for this_format, weight in ATTACHMENT_FORMATS])[0]
+                    size = int(rng.expovariate(1 / attachment_size)) + 1
+                    write(f"{raw_dir}/binary-{docket_id}/comments_attachements/{this_attachment}.{file_format}", padded_bytes(f"{file_format} ", size, rng))
+                    if file_format == 'pdf':
+                        write(f"derived-data/{agency}/{docket_id}/mirrulations/extracted_txt/comments_extracted_text/pdfminer/{this_attachment}.txt",
+                              text_filler(max(1, size // 10), rng).encode('utf-8'))
+
+    return totals
+
+
+@click.command()
+@click.argument('root_dir')
+@click.option('--agencies', default=3, type=int, help="How many agencies (default is 3)")
+@click.option('--dockets', default=4, type=int, help="How many dockets per agency (default is 4)")
+@click.option('--comments', default=25, type=int, help="How many comments per docket (default is 25)")
+@click.option('--years', default='2020-2025', help="The range of docket years (default is 2020-2025)")
+@click.option('--attachment-rate', default=0.3, type=float, help="The fraction of comments with attachments (default is 0.3)")
+@click.option('--comment-size', default=2000, type=int, help="The mean size of a comment's text in bytes (default is 2000)")
+@click.option('--attachment-size', default=200000, type=int, help="The mean size of an attachment in bytes (default is 200000)")
+@click.option('--seed', default=0, type=int, help="The random seed, the same seed always gives the same tree (default is 0)")
+def main(root_dir, agencies, dockets, comments, years, attachment_rate, comment_size, attachment_size, seed):
+    """Generate a synthetic mirrulations bucket in ROOT_DIR"""
+    first_year, last_year = (int(this_year) for this_year in years.split('-'))
+    if os.path.exists(root_dir) and os.listdir(root_dir):
+        print(f"Error: {root_dir} is not empty")
+        exit()
+
+    totals = generate_bucket(root_dir, agencies, dockets, comments, (first_year, last_year), attachment_rate, comment_size, attachment_size, seed)
+    print(f"Wrote {totals['files']} files ({totals['bytes'] / 1024 ** 2:.1f} MiB) to {root_dir}")
+    print(f"To download from it: export MIRRULATIONS_REMOTE={os.path.abspath(root_dir)}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+
+from mirrulations_config import get_state_dir
+
+#rclone flags that make it write its periodic stats into the log file as JSON, so we can read them back.
+#Each stats line carries a 'stats' object with bytes, speed, transfers, checks, errors and so on.
+RCLONE_STATS_FLAGS = " --use-json-log --stats 10s --stats-log-level NOTICE "
+
+#How far back from the end of a log file we look for the latest stats line
+STATS_TAIL_BYTES = 256 * 1024
+
+
+def read_latest_rclone_stats(log_file, start_offset=0):
+    """Return the most recent 'stats' object rclone wrote to a JSON log file, or None if there is none yet.
+
+    Only the part of the file after start_offset is considered, so that when several shards run one after
+    another into the same log file, a shard never picks up the stats of the one before it.
+    """
+    if not os.path.isfile(log_file):
+        return None
+
+    with open(log_file, 'rb') as file_handle:
+        file_handle.seek(0, os.SEEK_END)
+        file_handle.seek(max(start_offset, file_handle.tell() - STATS_TAIL_BYTES))
+        lines = file_handle.read().decode('utf-8', errors='replace').splitlines()
+
+    for this_line in reversed(lines):
+        if '"stats"' not in this_line:
+            continue
+        try:
+            return json.loads(this_line)['stats']
+        except (json.JSONDecodeError, KeyError):
+            continue
+
+    return None
+
+
+def job_profile(job, textonly):
+    """Group jobs by the kind of files they move, since tiny JSON files and large attachments want very different concurrency"""
+    if job['prefix'].startswith('raw-data/') and not textonly and job.get('section') != 'text':
+        return 'binary'
+    return 'text'
+
+
+def profile_rate(profile, stats):
+    """The rate we try to maximise: bytes per second for binaries, files per second for small text files"""
+    elapsed_time = stats.get('elapsedTime') or 0
+    if elapsed_time <= 0:
+        return 0
+    if profile == 'binary':
+        return stats.get('bytes', 0) / elapsed_time
+    return stats.get('transfers', 0) / elapsed_time
+
+
+def record_throughput_history(job_name, profile, transfers, stats):
+    """Append what a finished job achieved to the throughput history, which later runs use for estimates"""
+    record = {
+        'time': time.time(),
+        'job': job_name,
+        'profile': profile,
+        'transfers': transfers,
+        'bytes': stats.get('bytes', 0),
+        'files': stats.get('transfers', 0),
+        'errors': stats.get('errors', 0),
+        'elapsed': stats.get('elapsedTime', 0),
+    }
+    with open(os.path.join(get_state_dir(), 'throughput_history.jsonl'), 'a') as file_handle:
+        file_handle.write(json.dumps(record) + "\n")
+
+
+def average_throughput(profile, history_length=50):
+    """Bytes per second and files per second that recent shards of this profile achieved, or None if we have no history"""
+    history_file = os.path.join(get_state_dir(), 'throughput_history.jsonl')
+    if not os.path.isfile(history_file):
+        return None
+
+    with open(history_file) as file_handle:
+        records = [json.loads(this_line) for this_line in file_handle if this_line.strip()]
+    records = [this_record for this_record in records if this_record['profile'] == profile and this_record['elapsed'] > 0][-history_length:]
+    if not records:
+        return None
+
+    total_elapsed = sum(this_record['elapsed'] for this_record in records)
+    return {
+        'bytes_per_second': sum(this_record['bytes'] for this_record in records) / total_elapsed,
+        'files_per_second': sum(this_record['files'] for this_record in records) / total_elapsed,
+    }
+
+
+class ConcurrencyTuner:
+    """Pick --transfers for each new shard by hill climbing on what the previous shards of the same profile achieved.
+
+    rclone cannot change --transfers while it is running, so the unit of adjustment is a shard: every finished shard
+    is an experiment, and the next shard of the same profile runs with a value nudged towards whatever did best.
+    Errors (usually throttling) always back concurrency off.
+    """
+
+    #Shards that moved less than this are too small to tell us anything
+    MINIMUM_ELAPSED = 5
+    MINIMUM_FILES = 10
+    #An error rate above this is treated as being throttled
+    MAXIMUM_ERROR_RATE = 0.02
+    #A new rate has to beat the best one by this much to count as better rather than noise
+    IMPROVEMENT = 1.05
+
+    def __init__(self, initial_transfers, minimum=4, maximum=256, log=print):
+        self.initial_transfers = int(initial_transfers)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.log = log
+        self.profiles = {}
+
+    def _state(self, profile):
+        return self.profiles.setdefault(profile, {
+            'current': self.initial_transfers,
+            'best': None,
+            'best_rate': 0,
+            'factor': 1.5,
+            'direction': 1,
+        })
+
+    def _clamp(self, transfers):
+        return max(self.minimum, min(self.maximum, int(round(transfers))))
+
+    def next_transfers(self, profile):
+        """How many transfers the next shard of this profile should use"""
+        return self._state(profile)['current']
+
+    def record(self, profile, transfers, stats):
+        """Feed back the final stats of a shard that ran with the given number of transfers"""
+        if not stats:
+            return
+
+        state = self._state(profile)
+        files = stats.get('transfers', 0)
+        errors = stats.get('errors', 0)
+        if stats.get('elapsedTime', 0) < self.MINIMUM_ELAPSED or files + errors < self.MINIMUM_FILES:
+            return
+
+        rate = profile_rate(profile, stats)
+        error_rate = errors / (files + errors)
+
+        if error_rate > self.MAXIMUM_ERROR_RATE or stats.get('retryError'):
+            state['current'] = self._clamp(transfers * 0.5)
+            state['direction'] = -1
+            reason = f"{error_rate:.1%} errors"
+        elif state['best'] is None or rate > state['best_rate'] * self.IMPROVEMENT:
+            state['best'] = transfers
+            state['best_rate'] = rate
+            state['current'] = self._clamp(transfers * state['factor'] ** state['direction'])
+            reason = "rate improved"
+        else:
+            #Going this way did not help, so turn around from the best value with a smaller step
+            state['direction'] = -state['direction']
+            state['factor'] = max(1.1, state['factor'] ** 0.5)
+            state['current'] = self._clamp(state['best'] * state['factor'] ** state['direction'])
+            reason = "no improvement"
+
+        unit = "bytes/s" if profile == 'binary' else "files/s"
+        self.log(f"Auto-tune ({profile}): {rate:.1f} {unit} at {transfers} transfers, {reason}, next shard gets {state['current']} transfers")
@@ -0,0 +1,192 @@
+import os
+import time
+import hashlib
+import sqlite3
+import fnmatch
+import datetime
+import click
+
+from mirrulations_config import get_remote, get_state_dir, iter_batches, parse_bucket_path
+from mirrulations_hashes import HashCache
+import mirrulations_archive
+import mirrulations_manifest
+import mirrulations_planning
+
+#Checks that the local copy matches the bucket: every object in the selection should be on disk with the same size
+#and, where the bucket knows it, the same MD5. The files that are missing or corrupt are written to a repair list that
+#the downloader takes straight back with --files-from. Dockets packed with --pack are checked against their archive.
+
+#How many paths of each kind we print, the full lists are in the report files
+PRINTED_PATHS = 20
+
+REPORT_KINDS = ['missing', 'corrupt', 'extra']
+
+
+def path_matches_job(path, job, textonly):
+    """Whether a bucket path is part of what a job from plan_copy_jobs would copy"""
+    parsed = parse_bucket_path(path)
+    if job['years'] and parsed['year'] not in job['years']:
+        return False
+    if textonly and parsed['section'] == 'binary':
+        return False
+    file_name = path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(file_name, this_file_type) for this_file_type in job['file_types'])
+
+
+def iter_local_paths(dest_dir, prefix):
+    """Every file below a prefix in the destination, as a path relative to the bucket root, leaving out the ones rclone is still copying"""
+    for this_root, this_dirs, this_files in os.walk(os.path.join(dest_dir, prefix)):
+        for this_file in this_files:
+            if this_file.endswith(mirrulations_archive.PARTIAL_SUFFIX):
+                continue
+            yield os.path.relpath(os.path.join(this_root, this_file), dest_dir).replace(os.sep, '/')
+
+
+def verify_jobs(dest_dir, jobs, rclone_config_file, textonly=False, workers=8, cache_path=None, report_dir=None, archive_dir=None):
+    """Compare the destination with the bucket for every job's prefix, writing each problem to report_dir as it is found.
+
+    missing.txt gets what is in the bucket but neither on disk nor in its docket's archive, corrupt.txt what differs in
+    size or MD5, and extra.txt what is on disk but not in the bucket. repair.txt gets the missing and corrupt paths together.
+    Returns a dict with how many paths of each kind were found, the first PRINTED_PATHS of each in 'examples', the
+    'checked', 'packed' and 'unhashed' counts, and the 'repair_file'. Objects the bucket has no MD5 for can only be
+    checked by size.
+    """
+    report_dir = report_dir or os.path.join(get_state_dir(), 'verify')
+    archive_dir = archive_dir or mirrulations_archive.get_archive_dir(dest_dir)
+    os.makedirs(report_dir, exist_ok=True)
+    report = {'missing': 0, 'corrupt': 0, 'extra': 0, 'checked': 0, 'packed': 0, 'unhashed': 0,
+              'examples': {this_kind: [] for this_kind in REPORT_KINDS}, 'repair_file': os.path.join(report_dir, 'repair.txt')}
+    report_files = {this_kind: open(os.path.join(report_dir, f"{this_kind}.txt"), 'w') for this_kind in REPORT_KINDS + ['repair']}
+    hash_cache = HashCache(cache_path, workers)
+    #The listing of a prefix can run to millions of objects, so it goes into a scratch database on disk (an empty
+    #name makes SQLite create one that is deleted on close) instead of a dict
+    scratch = sqlite3.connect('')
+    #The archive of the docket we are looking in, as (agency, docket id, DocketArchive or None)
+    open_archive = [None, None, None]
+
+    def found(kind, path):
+        report_files[kind].write(f"{path}\n")
+        if kind != 'extra':
+            report_files['repair'].write(f"{path}\n")
+        report[kind] += 1
+        if len(report['examples'][kind]) < PRINTED_PATHS:
+            report['examples'][kind].append(path)
+
+    def docket_archive(agency, docket_id):
+        #The paths come in order, so each docket's archive is opened once
+        if open_archive[:2] != [agency, docket_id]:
+            if open_archive[2]:
+                open_archive[2].close()
+            try:
+                open_archive[:] = [agency, docket_id, mirrulations_archive.DocketArchive(mirrulations_archive.archive_path(archive_dir, agency, docket_id))]
+            except FileNotFoundError:
+                open_archive[:] = [agency, docket_id, None]
+        return open_archive[2]
+
+    try:
+        for this_job in jobs:
+            scratch.execute("DROP TABLE IF EXISTS remote_objects")
+            scratch.execute("CREATE TABLE remote_objects (path TEXT PRIMARY KEY, size INTEGER, md5 TEXT, found INTEGER DEFAULT 0)")
+            listing = mirrulations_manifest.iter_remote_listing(get_remote(), rclone_config_file, this_job['prefix'], with_md5=True)
+            for this_batch in iter_batches(((path, size, md5) for path, size, modtime, md5 in listing if path_matches_job(path, this_job, textonly)),
+                                           mirrulations_manifest.LISTING_BATCH_SIZE):
+                scratch.executemany("INSERT OR REPLACE INTO remote_objects (path, size, md5) VALUES (?, ?, ?)", this_batch)
+
+            local_paths = (this_path for this_path in iter_local_paths(dest_dir, this_job['prefix']) if path_matches_job(this_path, this_job, textonly))
+            for this_batch in iter_batches(local_paths, mirrulations_manifest.LISTING_BATCH_SIZE):
+                #Sizes are free to compare, so only files of the right size are worth hashing
+                to_hash = {}
+                for this_path in this_batch:
+                    row = scratch.execute("SELECT size, md5 FROM remote_objects WHERE path = ?", (this_path,)).fetchone()
+                    if row is None:
+                        found('extra', this_path)
+                        continue
+                    scratch.execute("UPDATE remote_objects SET found = 1 WHERE path = ?", (this_path,))
+                    report['checked'] += 1
+                    size, md5 = row
+                    if os.path.getsize(os.path.join(dest_dir, this_path)) != size:
+                        found('corrupt', this_path)
+                    elif md5:
+                        to_hash[os.path.join(dest_dir, this_path)] = (this_path, md5)
+                    else:
+                        report['unhashed'] += 1
+
+                for file_path, stat, digest in hash_cache.hash_files(to_hash, 'md5'):
+                    this_path, md5 = to_hash[file_path]
+                    if digest != md5:
+                        found('corrupt', this_path)
+
+            #What is not on disk may have been moved into its docket's archive by --pack
+            for this_path, size, md5 in scratch.execute("SELECT path, size, md5 FROM remote_objects WHERE found = 0 ORDER BY path"):
+                parsed = parse_bucket_path(this_path)
+                archive = docket_archive(parsed['agency'], parsed['docket']) if parsed['docket'] else None
+                info = archive.info(this_path) if archive else None
+                if info is None:
+                    found('missing', this_path)
+                    continue
+                report['checked'] += 1
+                report['packed'] += 1
+                if info[0] != size:
+                    found('corrupt', this_path)
+                elif md5:
+                    if hashlib.md5(archive.read(this_path)).hexdigest() != md5:
+                        found('corrupt', this_path)
+                else:
+                    report['unhashed'] += 1
+    finally:
+        if open_archive[2]:
+            open_archive[2].close()
+        scratch.close()
+        hash_cache.close()
+        for this_handle in report_files.values():
+            this_handle.close()
+
+    return report
+
+
+@click.command()
+@click.option('--agency', '-a', default='', help="Agency acronyms(s) separated by commas.")
+@click.option('--year', '-y', default='', help="Year(s) or range(s) of years separated by commas or dash (e.g., 2010-2015).")
+@click.option('--docket','-d', default='', help="Verify specific docket ids (separated by commas)")
+@click.option('--textonly', is_flag=True, help="Only verify the text files, like a --textonly download")
+@click.option('--workers', default=8, type=int, help="How many files to hash at the same time (default is 8)")
+@click.option('--report-dir', default='', help="Where to write the missing, corrupt, extra and repair lists (default is verify/ in MIRRULATIONS_STATE_PATH)")
+def main(agency, year, docket, textonly, workers, report_dir):
+    """Check the files in MIRRULATIONS_DESTINATION_PATH against the bucket by size and MD5"""
+    agency_list = [agency.strip() for agency in agency.split(',') if agency.strip()] or ['*']
+    docket_list = [docket.strip() for docket in docket.split(',') if docket.strip()]
+    year_list = mirrulations_planning.parse_years(year) if year else ['*']
+
+    dest_dir = os.getenv('MIRRULATIONS_DESTINATION_PATH')
+    rclone_config_file = os.getenv('RCLONE_CONFIG_FILE')
+    if not dest_dir or not os.path.exists(dest_dir):
+        print(f"Error: {dest_dir} does not exist ")
+        exit()
+
+    included_file_types = ['*.txt', '*.json', '*.htm'] if textonly else ['*']
+    jobs = mirrulations_planning.plan_copy_jobs(agency_list, year_list, docket_list, included_file_types)
+
+    start_time = time.time()
+    try:
+        report = verify_jobs(dest_dir, jobs, rclone_config_file, textonly, workers, report_dir=report_dir)
+    except RuntimeError as error:
+        print(f"Error: {error}")
+        exit()
+    elapsed_time = round(time.time() - start_time)
+
+    for this_kind in REPORT_KINDS:
+        for this_path in report['examples'][this_kind]:
+            print(f"{this_kind}: {this_path}")
+        if report[this_kind] > PRINTED_PATHS:
+            print(f"... and {report[this_kind] - PRINTED_PATHS} more {this_kind}")
+
+    print(f"Checked {report['checked']} files, {report['packed']} of them packed ( took {datetime.timedelta(seconds = elapsed_time)} ): "
+          f"{report['missing']} missing, {report['corrupt']} corrupt, {report['extra']} extra, "
+          f"{report['unhashed']} only checked by size")
+    if report['missing'] or report['corrupt']:
+        print(f"To repair them: python mirrulations_bulk_downloader.py --files-from {report['repair_file']}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
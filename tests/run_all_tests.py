@@ -70,6 +70,24 @@ def main():
     print("1. Download all AHRQ files")
     print("2. Download all data from 1995 (any agency)")
     print("3. Download specific docket CMS-2025-0050")
+    print("4. Shard planning and parallel execution (offline)")
+    print("5. Manifest building and selection resolution (offline)")
+    print("6. Checkpoint journal and resume (offline)")
+    print("7. rclone stats and auto-tune (offline)")
+    print("8. Live transfer metrics (offline)")
+    print("9. Comment level index of downloaded data (offline)")
+    print("10. Parquet export of downloaded data (offline)")
+    print("11. Packed per-docket archives (offline)")
+    print("12. Content-hash deduplication (offline)")
+    print("13. Integrity verification and repair list (offline)")
+    print("14. Synthetic bucket generator (offline)")
+    print("15. Completion event stream and staging (offline)")
+    print("16. Async Python API (offline)")
+    print("17. Multi-machine partitioning and coverage check (offline)")
+    print("18. Bandwidth schedule and rate pacing (offline)")
+    print("19. Retry queue for failed files (offline)")
+    print("20. Metadata-first selection by attributes (offline)")
+    print("21. Comment sampling and size caps (offline)")
     print()
     
     # Ensure we're running from the project root
@@ -106,7 +124,25 @@ def main():
     tests = [
         ("test_ahrq_download.py", "Download all AHRQ files"),
         ("test_1995_download.py", "Download all data from 1995 (any agency)"),
-        ("test_cms_docket_download.py", "Download specific docket CMS-2025-0050")
+        ("test_cms_docket_download.py", "Download specific docket CMS-2025-0050"),
+        ("test_shard_planning.py", "Shard planning and parallel execution (offline)"),
+        ("test_manifest.py", "Manifest building and selection resolution (offline)"),
+        ("test_journal.py", "Checkpoint journal and resume (offline)"),
+        ("test_tuning.py", "rclone stats and auto-tune (offline)"),
+        ("test_metrics.py", "Live transfer metrics (offline)"),
+        ("test_index.py", "Comment level index of downloaded data (offline)"),
+        ("test_export.py", "Parquet export of downloaded data (offline)"),
+        ("test_archive.py", "Packed per-docket archives (offline)"),
+        ("test_dedup.py", "Content-hash deduplication (offline)"),
+        ("test_verify.py", "Integrity verification and repair list (offline)"),
+        ("test_synthetic.py", "Synthetic bucket generator (offline)"),
+        ("test_events.py", "Completion event stream and staging (offline)"),
+        ("test_api.py", "Async Python API (offline)"),
+        ("test_partition.py", "Multi-machine partitioning and coverage check (offline)"),
+        ("test_pacing.py", "Bandwidth schedule and rate pacing (offline)"),
+        ("test_retry.py", "Retry queue for failed files (offline)"),
+        ("test_catalog.py", "Metadata-first selection by attributes (offline)"),
+        ("test_sampling.py", "Comment sampling and size caps (offline)")
     ]
     
     # Track results
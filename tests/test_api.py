@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the async Python API. Does not need network access: a stand-in rclone on the PATH takes
+the place of the real one.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Sleeps a moment like a transfer would, and fails any copy from FDA
+FAKE_RCLONE = """#!/bin/sh
+case "$*" in
+    *FDA*) exit 1 ;;
+esac
+sleep 1
+exit 0
+"""
+
+def run_api_test():
+    """Run the API test"""
+    print("=" * 60)
+    print("TESTING: Async Python API")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_api_test_")
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+        file_handle.write(FAKE_RCLONE)
+    os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+    config_file = os.path.join(work_dir, 'rclone.conf')
+    open(config_file, 'w').close()
+
+    old_environment = dict(os.environ)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+    os.environ['MIRRULATIONS_REMOTE'] = os.path.join(work_dir, 'bucket') + '/'
+
+    import mirrulations_api
+
+    def options(name, **extra):
+        dest_dir = os.path.join(work_dir, name)
+        os.makedirs(dest_dir, exist_ok=True)
+        return {'dest_dir': dest_dir, 'rclone_config_file': config_file, **extra}
+
+    try:
+        # Planning problems are raised before anything runs
+        expected_errors = [
+            ({}, options('empty'), mirrulations_api.SelectionError),
+            ({'agencies': ['CMS']}, {'dest_dir': os.path.join(work_dir, 'missing'), 'rclone_config_file': config_file}, mirrulations_api.ConfigurationError),
+            ({'agencies': ['CMS']}, options('unknown', colour='blue'), mirrulations_api.SelectionError),
+            ({'agencies': ['CMS'], 'getall': True}, options('both'), mirrulations_api.SelectionError),
+        ]
+        for selection, these_options, error_class in expected_errors:
+            try:
+                asyncio.run(mirrulations_api.download(selection, these_options))
+                print(f"ERROR: Expected {error_class.__name__} for {selection}")
+                success = False
+            except error_class:
+                pass
+        if success:
+            print("✓ Bad selections and missing configuration raise typed exceptions")
+
+        # Auto-tuning retunes between shards, so it splits a selection that would otherwise be one shard
+        run = mirrulations_api.prepare_download({'agencies': ['CMS'], 'years': [2024, 2025]}, options('auto-tune', auto_tune=True))
+        shard_names = sorted({this_job['name'].split(':')[0] for this_job in run['jobs']})
+        if shard_names != ['CMS-2024', 'CMS-2025']:
+            print(f"ERROR: Expected --auto-tune to shard by agency-year, got {shard_names}")
+            success = False
+        else:
+            print("✓ --auto-tune splits a single shard selection by agency-year")
+
+        # Two downloads run side by side in one event loop
+        async def run_two():
+            started_at = time.time()
+            cms = await mirrulations_api.download({'agencies': ['CMS']}, options('cms', parallel=2))
+            fda = await mirrulations_api.download({'agencies': ['FDA']}, options('fda'))
+            await asyncio.sleep(0.5)
+            running = [this_shard['status'] for this_shard in cms.shards()]
+            cms_result = await cms.wait()
+            try:
+                await fda.wait()
+                fda_error = None
+            except mirrulations_api.ShardsFailedError as error:
+                fda_error = error
+            return running, cms_result, fda_error, cms.progress(), time.time() - started_at
+
+        running, cms_result, fda_error, progress, elapsed = asyncio.run(run_two())
+        if running != ['running', 'running']:
+            print(f"ERROR: Expected both CMS shards to be running after half a second, got {running}")
+            success = False
+        elif [this_shard['status'] for this_shard in cms_result['shards']] != ['finished', 'finished'] or cms_result['failed_shards'] != 0:
+            print(f"ERROR: Expected both CMS shards to finish, got {cms_result}")
+            success = False
+        elif fda_error is None or fda_error.result['failed_shards'] != 2 or fda_error.result['shards'][0]['exit_code'] != 1:
+            print(f"ERROR: Expected ShardsFailedError with both FDA shards failed, got {fda_error}")
+            success = False
+        elif progress['finished'] != 2 or progress['shards'] != 2:
+            print(f"ERROR: Expected progress to count two finished shards, got {progress}")
+            success = False
+        elif elapsed > 1.9:
+            print(f"ERROR: Expected the two downloads to overlap, they took {elapsed:.1f}s")
+            success = False
+        else:
+            print("✓ Downloads run concurrently and report per shard status and failures")
+
+        # Cancelling stops the rclone processes and raises DownloadCancelled
+        async def run_cancelled():
+            handle = await mirrulations_api.download({'agencies': ['CMS']}, options('cancelled'))
+            await asyncio.sleep(0.3)
+            handle.cancel()
+            try:
+                await handle.wait()
+                return False
+            except mirrulations_api.DownloadCancelled:
+                return True
+
+        started_at = time.time()
+        if not asyncio.run(run_cancelled()) or time.time() - started_at > 0.9:
+            print("ERROR: Expected cancel() to stop the download early with DownloadCancelled")
+            success = False
+        else:
+            print("✓ A cancelled download stops its rclone processes")
+
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 API test PASSED!")
+    else:
+        print(f"\n❌ API test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_api_test()
+    sys.exit(0 if success else 1)
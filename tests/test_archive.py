@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Test script to validate packing downloaded dockets into per-docket archives. Does not need network access.
+"""
+
+import os
+import sys
+import asyncio
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Copies one file per docket: the year and the half of a text-first job are read from the filter rules. Some files
+#are written under rclone's .partial name first, and stay that way while the other shards finish
+FAKE_RCLONE = """#!{python}
+import os, re, sys, time
+arguments = sys.argv[1:]
+destination = arguments[2]
+with open(arguments[arguments.index('--filter-from') + 1]) as file_handle:
+    rule = [this_line for this_line in file_handle if this_line.startswith('+ ')][0]
+if '/raw-data/' not in destination:
+    sys.exit(0)
+year = re.search('-([0-9]{{4}})-', rule).group(1)
+docket_id = f"CMS-{{year}}-0001"
+if 'binary-' in rule:
+    file_path = os.path.join(destination, docket_id, f"binary-{{docket_id}}", 'comments_attachments', f"{{docket_id}}-0001_attachment_1.pdf")
+else:
+    file_path = os.path.join(destination, docket_id, f"text-{{docket_id}}", 'comments', f"{{docket_id}}-0001.json")
+os.makedirs(os.path.dirname(file_path), exist_ok=True)
+slow = (year == '2025') != ('binary-' in rule)
+with open(file_path + ('.partial' if slow else ''), 'w') as file_handle:
+    file_handle.write(rule)
+if slow:
+    time.sleep(1.5)
+    os.rename(file_path + '.partial', file_path)
+    if year == '2024':
+        #The text of this docket finished long ago, but we were still copying into it
+        text_file = os.path.join(destination, docket_id, f"text-{{docket_id}}", 'comments', f"{{docket_id}}-0001.json")
+        open(os.path.join(os.environ['FAKE_RCLONE_STATE'], 'text_still_loose' if os.path.exists(text_file) else 'text_packed_early'), 'w').close()
+"""
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file_handle:
+        file_handle.write(data)
+
+def run_archive_test():
+    """Run the archive test"""
+    print("=" * 60)
+    print("TESTING: Packed per-docket archives")
+    print("=" * 60)
+
+    success = True
+    dest_dir = tempfile.mkdtemp(prefix="mirrulations_archive_test_")
+    archive_dir = os.path.join(dest_dir, 'packed')
+
+    from mirrulations_archive import DocketArchive, archive_path, open_member, pack_prefix
+    import mirrulations_api
+
+    try:
+        comment_path = 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'
+        binary_path = 'raw-data/CMS/CMS-2025-0050/binary-CMS-2025-0050/comments_attachments/CMS-2025-0050-0002_attachment_1.pdf'
+        comment_data = b'{"data": {"id": "CMS-2025-0050-0002"}}' * 50
+        binary_data = os.urandom(4096)
+        write_file(os.path.join(dest_dir, comment_path), comment_data)
+        write_file(os.path.join(dest_dir, binary_path), binary_data)
+        write_file(os.path.join(dest_dir, 'raw-data/CMS/CMS-2024-0010/text-CMS-2024-0010/docket/CMS-2024-0010.json'), b'{}')
+
+        totals = pack_prefix(dest_dir, archive_dir, 'raw-data/CMS/')
+        if totals['dockets'] != 2 or totals['packed'] != 3:
+            print(f"ERROR: Expected 3 files packed from 2 dockets, got {totals}")
+            success = False
+        elif os.path.exists(os.path.join(dest_dir, 'raw-data', 'CMS')):
+            print("ERROR: Expected the loose files and their empty directories to be removed")
+            success = False
+        else:
+            print("✓ Each docket is packed into one archive and the loose files are removed")
+
+        with DocketArchive(archive_path(archive_dir, 'CMS', 'CMS-2025-0050')) as archive:
+            members = archive.namelist()
+            stored = archive.connection.execute("SELECT path, compressed FROM members ORDER BY path").fetchall()
+            if members != sorted([comment_path, binary_path]) or dict(stored) != {binary_path: 0, comment_path: 1}:
+                print(f"ERROR: Unexpected members {stored}")
+                success = False
+            elif archive.read(binary_path) != binary_data:
+                print("ERROR: Expected a stored binary to read back unchanged")
+                success = False
+            else:
+                print("✓ Text is compressed, incompressible files are stored as they are")
+
+        member = open_member(archive_dir, comment_path)
+        member.seek(8)
+        if member.read(6) != comment_data[8:14]:
+            print("ERROR: Expected to read a member by its bucket path")
+            success = False
+        else:
+            print("✓ A member can be opened by its bucket path")
+
+        # A new comment arrives in a docket that is already packed
+        write_file(os.path.join(dest_dir, 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json'), b'{}')
+        totals = pack_prefix(dest_dir, archive_dir, 'raw-data/CMS/CMS-2025-0050/')
+        with DocketArchive(archive_path(archive_dir, 'CMS', 'CMS-2025-0050')) as archive:
+            member_count = len(archive.namelist())
+        if totals['packed'] != 1 or member_count != 3:
+            print(f"ERROR: Expected the new comment to be added to the existing archive, got {totals} and {member_count} members")
+            success = False
+        else:
+            print("✓ Packing again adds to the existing archive")
+
+        # Shards of the same agency run side by side, and each packs only its own dockets once nothing is copying into them
+        work_dir = os.path.join(dest_dir, 'parallel')
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        os.makedirs(os.path.join(work_dir, 'dest'))
+        with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+            file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+        os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+        config_file = os.path.join(work_dir, 'rclone.conf')
+        open(config_file, 'w').close()
+        old_environment = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_RCLONE_STATE'] = work_dir
+        os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+        os.environ['MIRRULATIONS_REMOTE'] = 's3:bucket/'
+
+        async def download():
+            handle = await mirrulations_api.download({'agencies': ['CMS'], 'years': [2024, 2025]},
+                                                     {'dest_dir': os.path.join(work_dir, 'dest'), 'rclone_config_file': config_file,
+                                                      'parallel': 6, 'text_first': True, 'pack': True})
+            return await handle.wait()
+
+        try:
+            result = asyncio.run(download())
+        except mirrulations_api.ShardsFailedError as error:
+            result = error.result
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environment)
+        members = {}
+        for docket_id in ['CMS-2024-0001', 'CMS-2025-0001']:
+            with DocketArchive(archive_path(os.path.join(work_dir, 'dest', 'packed'), 'CMS', docket_id)) as archive:
+                members[docket_id] = archive.namelist()
+        if result['failed_shards']:
+            print(f"ERROR: Expected every shard to finish, got {result['shards']}")
+            success = False
+        elif os.path.exists(os.path.join(work_dir, 'dest', 'raw-data')):
+            print("ERROR: Expected every docket to be packed by the end of the run")
+            success = False
+        elif [len(this_members) for this_members in members.values()] != [2, 2] or any(this_path.endswith('.partial') for this_path in sum(members.values(), [])):
+            print(f"ERROR: Expected the text and the attachment of each docket, and no partial files, got {members}")
+            success = False
+        elif not os.path.exists(os.path.join(work_dir, 'text_still_loose')):
+            print("ERROR: Expected a docket not to be packed while another shard was still copying into it")
+            success = False
+        else:
+            print("✓ Parallel shards sharing a prefix pack only their own dockets, and never files still being copied")
+
+    finally:
+        shutil.rmtree(dest_dir)
+
+    if success:
+        print(f"\n🎉 Archive test PASSED!")
+    else:
+        print(f"\n❌ Archive test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_archive_test()
+    sys.exit(0 if success else 1)
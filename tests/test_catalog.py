@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Test script to validate selecting dockets by their metadata: fetching only the small JSON files into the catalog and
+narrowing the download to the dockets that match. Does not need network access.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def run_catalog_test():
+    """Run the catalog test"""
+    print("=" * 60)
+    print("TESTING: Metadata-first selection by attributes")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_catalog_test_")
+    bucket_dir = os.path.join(work_dir, 'bucket')
+    dest_dir = os.path.join(work_dir, 'dest')
+    os.makedirs(dest_dir)
+    config_file = os.path.join(work_dir, 'rclone.conf')
+    open(config_file, 'w').close()
+    old_environment = dict(os.environ)
+    os.environ['MIRRULATIONS_REMOTE'] = bucket_dir + '/'
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+
+    from mirrulations_synthetic import generate_bucket
+    from mirrulations_planning import compile_filter_rules, plan_copy_jobs
+    from mirrulations_manifest import iter_remote_listing, open_manifest, refresh_manifest, select_job_paths
+    import mirrulations_api
+    import mirrulations_catalog
+    import mirrulations_index
+
+    def docket_dirs(agency):
+        return sorted(os.listdir(os.path.join(bucket_dir, 'raw-data', agency)))
+
+    def select(attributes, agencies=('CMS',)):
+        jobs = plan_copy_jobs(list(agencies), ['*'], [], ['*'])
+        return mirrulations_catalog.select_jobs_by_attributes(jobs, mirrulations_catalog.check_attributes(attributes), config_file)
+
+    def selected_dockets(jobs):
+        return set().union(*[set(this_job['dockets']) for this_job in jobs])
+
+    try:
+        generate_bucket(bucket_dir, agencies=2, dockets_per_agency=6, comments_per_docket=10)
+        cms_dockets = docket_dirs('CMS')
+
+        #One docket has an AI summary, one has a final rule, and one has fewer comments than the others
+        summary_docket, rule_docket, small_docket = cms_dockets[0], cms_dockets[1], cms_dockets[2]
+        os.makedirs(os.path.join(bucket_dir, 'derived-data', 'CMS', summary_docket, 'ai_summary'))
+        with open(os.path.join(bucket_dir, 'derived-data', 'CMS', summary_docket, 'ai_summary', 'summary.json'), 'w') as file_handle:
+            file_handle.write('{}')
+        document_file = os.path.join(bucket_dir, 'raw-data', 'CMS', rule_docket, f"text-{rule_docket}", 'documents', f"{rule_docket}-0001.json")
+        with open(document_file) as file_handle:
+            document = json.load(file_handle)
+        document['data']['attributes']['documentType'] = 'Rule'
+        with open(document_file, 'w') as file_handle:
+            json.dump(document, file_handle)
+        comments_dir = os.path.join(bucket_dir, 'raw-data', 'CMS', small_docket, f"text-{small_docket}", 'comments')
+        for this_file in sorted(os.listdir(comments_dir))[:4]:
+            os.remove(os.path.join(comments_dir, this_file))
+
+        # The attributes are checked
+        try:
+            mirrulations_catalog.check_attributes({'posted_after': '2024/01/01'})
+            print("ERROR: Expected a date that is not ISO to be rejected")
+            success = False
+        except ValueError:
+            print("✓ Attributes are checked")
+
+        # Only the docket and document JSON is fetched for attributes that do not need the comments
+        jobs = select({'derived': ['ai_summary']})
+        catalog_data = os.path.join(work_dir, 'state', 'catalog', 'data')
+        fetched_kinds = {this_dir.split(os.sep)[-1] for this_dir, dir_names, file_names in os.walk(catalog_data) if file_names}
+        if selected_dockets(jobs) != {summary_docket} or {this_job['prefix'] for this_job in jobs} != {'raw-data/CMS/', 'derived-data/CMS/'}:
+            print(f"ERROR: Expected only {summary_docket} with its AI summary, got {[(this_job['prefix'], this_job.get('dockets')) for this_job in jobs]}")
+            success = False
+        elif fetched_kinds != {'docket', 'documents'}:
+            print(f"ERROR: Expected only docket and document metadata in the catalog, got {fetched_kinds}")
+            success = False
+        elif summary_docket not in compile_filter_rules(jobs[0], False)[0]:
+            print(f"ERROR: Expected the filter rules to name the selected docket, got {compile_filter_rules(jobs[0], False)}")
+            success = False
+        else:
+            print("✓ The derived-data directories select a docket, fetching only docket and document JSON")
+
+        if selected_dockets(select({'document_types': ['rule']})) != {rule_docket}:
+            print(f"ERROR: Expected only {rule_docket} to have a final rule")
+            success = False
+        else:
+            print("✓ The document type selects a docket")
+
+        # The comment attributes fetch the comments' JSON too
+        expected = set()
+        for this_docket in cms_dockets:
+            this_dir = os.path.join(bucket_dir, 'raw-data', 'CMS', this_docket, f"text-{this_docket}", 'comments')
+            for this_file in os.listdir(this_dir):
+                with open(os.path.join(this_dir, this_file)) as file_handle:
+                    posted_date = json.load(file_handle)['data']['attributes']['postedDate'][:10]
+                if '2022-03-01' <= posted_date <= '2023-06-30':
+                    expected.add(this_docket)
+        dockets = selected_dockets(select({'posted_after': '2022-03-01', 'posted_before': '2023-06-30'}) or [{'dockets': []}])
+        if dockets != expected:
+            print(f"ERROR: Expected the dockets with comments posted in the range to be {sorted(expected)}, got {sorted(dockets)}")
+            success = False
+        else:
+            print(f"✓ The posting date range selects {len(expected)} of {len(cms_dockets)} dockets")
+
+        dockets = selected_dockets(select({'min_comments': 8}))
+        if dockets != set(cms_dockets) - {small_docket}:
+            print(f"ERROR: Expected every docket but {small_docket} to have 8 comments, got {sorted(dockets)}")
+            success = False
+        else:
+            print("✓ The comment count selects the dockets with enough comments")
+
+        # The catalog is kept between runs, and only what changed is read again
+        connection = mirrulations_catalog.open_catalog()
+        counts = mirrulations_catalog.build_catalog(connection, plan_copy_jobs(['CMS'], ['*'], [], ['*']), {'min_comments': 1}, config_file)
+        connection.close()
+        if counts['indexed'] != 0:
+            print(f"ERROR: Expected nothing new to read on the second run, got {counts}")
+            success = False
+        else:
+            print("✓ A second selection over the same agency reads nothing again")
+
+        # Selecting by attributes works with a SQLite that has no FTS5, only full-text search needs it
+        full_text_schema = mirrulations_index.FULL_TEXT_SCHEMA
+        mirrulations_index.FULL_TEXT_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING no_such_module (title, body);"
+        try:
+            connection = mirrulations_catalog.open_catalog(os.path.join(work_dir, 'no_fts.sqlite'))
+            counts = mirrulations_catalog.build_catalog(connection, plan_copy_jobs(['CMS'], ['*'], [], ['*']), {'min_comments': 1}, config_file)
+            dockets = {docket_id for agency, docket_id in mirrulations_catalog.select_dockets(connection, {'min_comments': 8})}
+            connection.close()
+            try:
+                mirrulations_index.open_index(os.path.join(work_dir, 'no_fts_index.sqlite')).close()
+                full_text_refused = False
+            except RuntimeError:
+                full_text_refused = True
+        finally:
+            mirrulations_index.FULL_TEXT_SCHEMA = full_text_schema
+        if not counts['indexed'] or dockets != set(cms_dockets) - {small_docket}:
+            print(f"ERROR: Expected the catalog to select without FTS5, got {sorted(dockets)}")
+            success = False
+        elif not full_text_refused:
+            print("ERROR: Expected the full-text index to still need FTS5")
+            success = False
+        else:
+            print("✓ The catalog selects dockets without FTS5, the full-text index still asks for it")
+
+        # The manifest resolves a narrowed job to the selected dockets' files only
+        manifest_connection = open_manifest()
+        refresh_manifest(manifest_connection, iter_remote_listing(bucket_dir + '/', None, 'raw-data/'), 'raw-data/')
+        jobs = select({'document_types': ['Rule']})
+        paths = select_job_paths(manifest_connection, [this_job for this_job in jobs if this_job['prefix'] == 'raw-data/CMS/'][0], False)
+        manifest_connection.close()
+        if not paths or {this_path.split('/')[0] for this_path in paths} != {rule_docket}:
+            print(f"ERROR: Expected the manifest to give only {rule_docket}'s files, got {len(paths)} files")
+            success = False
+        else:
+            print(f"✓ The manifest resolves the narrowed job to {len(paths)} files of the selected docket")
+
+        # The API narrows the download, and says so when nothing matches
+        run = mirrulations_api.prepare_download({'agencies': ['CMS', 'EPA'], 'attributes': {'derived': ['ai_summary']}},
+                                                {'dest_dir': dest_dir, 'rclone_config_file': config_file})
+        try:
+            mirrulations_api.prepare_download({'agencies': ['EPA'], 'attributes': {'document_types': ['Rule']}},
+                                              {'dest_dir': dest_dir, 'rclone_config_file': config_file})
+            print("ERROR: Expected a selection without matching dockets to be rejected")
+            success = False
+        except mirrulations_api.SelectionError:
+            if {this_job['prefix'] for this_job in run['jobs']} != {'raw-data/CMS/', 'derived-data/CMS/'}:
+                print(f"ERROR: Expected the API to drop the EPA jobs, got {[this_job['prefix'] for this_job in run['jobs']]}")
+                success = False
+            else:
+                print("✓ The API downloads only the agencies with matching dockets")
+
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Catalog test PASSED!")
+    else:
+        print(f"\n❌ Catalog test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_catalog_test()
+    sys.exit(0 if success else 1)
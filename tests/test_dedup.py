@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test script to validate content-hash deduplication of downloaded files. Does not need network access.
+"""
+
+import os
+import errno
+import sys
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file_handle:
+        file_handle.write(data)
+
+def run_dedup_test():
+    """Run the dedup test"""
+    print("=" * 60)
+    print("TESTING: Content-hash deduplication")
+    print("=" * 60)
+
+    success = True
+    dest_dir = tempfile.mkdtemp(prefix="mirrulations_dedup_test_")
+    cache_path = os.path.join(dest_dir, 'hash_cache.sqlite')
+
+    import mirrulations_api
+    import mirrulations_dedup
+    import mirrulations_hashes
+    from mirrulations_dedup import dedup_tree
+
+    try:
+        campaign_letter = b'Please do not cut this program. ' * 500
+        copies = [os.path.join(dest_dir, 'raw-data', 'EPA', docket, f"binary-{docket}", 'comments_attachments', f"{docket}-000{number}_attachment_1.pdf")
+                  for number, docket in enumerate(['EPA-HQ-OAR-2021-0317', 'EPA-HQ-OAR-2021-0317', 'EPA-HQ-OAR-2022-0001'])]
+        for this_path in copies:
+            write_file(this_path, campaign_letter)
+        write_file(os.path.join(dest_dir, 'raw-data', 'EPA', 'EPA-HQ-OAR-2022-0001', 'other.pdf'), os.urandom(8192))
+        write_file(os.path.join(dest_dir, 'raw-data', 'EPA', 'EPA-HQ-OAR-2022-0001', 'tiny.txt'), b'small')
+
+        counts = dedup_tree(dest_dir, link_mode='hardlink', cache_path=cache_path, log=lambda message: None)
+        inodes = {os.stat(this_path).st_ino for this_path in copies}
+        if counts['scanned'] != 4 or counts['linked'] != 2 or counts['bytes_saved'] != 2 * len(campaign_letter):
+            print(f"ERROR: Expected 4 files scanned and 2 duplicates linked, got {counts}")
+            success = False
+        elif len(inodes) != 1 or open(copies[2], 'rb').read() != campaign_letter:
+            print("ERROR: Expected every copy to be the same file with the same content")
+            success = False
+        else:
+            print("✓ Duplicates are replaced with hardlinks to one stored copy")
+
+        # The second pass must come entirely from the hash cache
+        def no_hashing(path, algorithm='sha256'):
+            raise AssertionError(f"{path} was hashed again")
+        real_hash_file = mirrulations_hashes.hash_file
+        mirrulations_hashes.hash_file = no_hashing
+        try:
+            counts = dedup_tree(dest_dir, link_mode='hardlink', cache_path=cache_path, log=lambda message: None)
+        finally:
+            mirrulations_hashes.hash_file = real_hash_file
+        if counts['linked'] != 0 or counts['already_linked'] != 4 or counts['failed'] != 0:
+            print(f"ERROR: Expected a second pass to find everything already linked, got {counts}")
+            success = False
+        else:
+            print("✓ Unchanged files are not hashed again")
+
+        for this_path in copies:
+            os.remove(this_path)
+        counts = dedup_tree(dest_dir, link_mode='hardlink', cache_path=cache_path, log=lambda message: None)
+        if counts['pruned'] != 1:
+            print(f"ERROR: Expected the stored copy nobody links to any more to be pruned, got {counts}")
+            success = False
+        else:
+            print("✓ Stored copies without any links are pruned")
+
+        # By default duplicates are reflinked, and stay copies where the filesystem cannot reflink. Either way they
+        # never share an inode (and so an mtime) like hardlinks do
+        for this_path in copies:
+            write_file(this_path, campaign_letter)
+        counts = dedup_tree(dest_dir, cache_path=cache_path, log=lambda message: None)
+        if len({os.stat(this_path).st_ino for this_path in copies}) != 3 or counts['linked'] + counts['copied'] != 2:
+            print(f"ERROR: Expected reflinks to leave every copy its own inode, got {counts}")
+            success = False
+        else:
+            print("✓ Duplicates are reflinked by default and keep their own inodes")
+
+        def no_reflinks(source_path, target_path):
+            open(target_path, 'wb').close()
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+        real_reflink = mirrulations_dedup.reflink
+        mirrulations_dedup.reflink = no_reflinks
+        messages = []
+        try:
+            shutil.rmtree(mirrulations_dedup.get_content_store_dir(dest_dir))
+            for this_path in copies:
+                os.remove(this_path)
+                write_file(this_path, campaign_letter)
+            counts = dedup_tree(dest_dir, cache_path=cache_path, log=messages.append)
+        finally:
+            mirrulations_dedup.reflink = real_reflink
+        leftovers = [this_file for this_root, this_dirs, these_files in os.walk(dest_dir) for this_file in these_files if '.dedup-' in this_file]
+        if counts['copied'] != 2 or counts['failed'] != 0 or len(messages) != 1 or leftovers:
+            print(f"ERROR: Expected a filesystem without reflinks to leave the duplicates as copies, got {counts}, {messages}, {leftovers}")
+            success = False
+        elif any(open(this_path, 'rb').read() != campaign_letter for this_path in copies):
+            print("ERROR: Expected the copies to keep their content")
+            success = False
+        else:
+            print("✓ Without reflinks the duplicates stay copies, with one message")
+
+        try:
+            mirrulations_api.prepare_download({'getall': True}, {'dedup': True, 'pack': True, 'dest_dir': dest_dir})
+            print("ERROR: Expected --dedup with --pack to be refused")
+            success = False
+        except mirrulations_api.SelectionError:
+            print("✓ --dedup with --pack is refused")
+
+    finally:
+        shutil.rmtree(dest_dir)
+
+    if success:
+        print(f"\n🎉 Dedup test PASSED!")
+    else:
+        print(f"\n❌ Dedup test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_dedup_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the completion event stream and staged docket promotion. Does not need network access.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import asyncio
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Copies a --files-from list one docket at a time, logging each file the way rclone does, and notes when it exits
+FAKE_RCLONE = """#!{python}
+import os, sys, json, time
+arguments = sys.argv[1:]
+destination = arguments[2]
+log_file = arguments[arguments.index('--log-file') + 1]
+with open(arguments[arguments.index('--files-from') + 1]) as file_handle:
+    files = [this_line.strip() for this_line in file_handle if this_line.strip()]
+last_docket = None
+for this_file in files:
+    if last_docket and this_file.split('/')[0] != last_docket:
+        time.sleep(2.5)
+    last_docket = this_file.split('/')[0]
+    os.makedirs(os.path.dirname(os.path.join(destination, this_file)), exist_ok=True)
+    open(os.path.join(destination, this_file), 'w').write('{{}}')
+    with open(log_file, 'a') as log_handle:
+        log_handle.write(json.dumps({{'level': 'info', 'msg': 'Copied (new)', 'object': this_file, 'objectType': '*local.Object'}}) + "\\n")
+open(os.environ['FAKE_RCLONE_EXITED'], 'w').write(str(time.time()))
+"""
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file_handle:
+        file_handle.write(data)
+
+def copied_line(object_path):
+    return json.dumps({'level': 'info', 'msg': 'Copied (new)', 'object': object_path, 'objectType': '*local.Object'}) + "\n"
+
+def run_events_test():
+    """Run the events test"""
+    print("=" * 60)
+    print("TESTING: Completion event stream")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_events_test_")
+
+    from mirrulations_events import EventPublisher, LogTailer, exchange_paths, get_staging_dir, promote_docket, promote_staged_job
+    from mirrulations_planning import build_rclone_command
+
+    try:
+        # Every sink gets every event
+        events_file = os.path.join(work_dir, 'events.jsonl')
+        events_socket = os.path.join(work_dir, 'events.sock')
+        received = []
+        publisher = EventPublisher(events_file, events_socket, [received.append])
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(events_socket)
+        for this_try in range(50):
+            if publisher.clients:
+                break
+            time.sleep(0.05)
+
+        publisher.publish('run_finished', failed_shards=0)
+        client.settimeout(5)
+        socket_event = json.loads(client.makefile().readline())
+        with open(events_file) as file_handle:
+            file_event = json.loads(file_handle.readline())
+        if [received[0]['event'], socket_event['event'], file_event['event']] != ['run_finished'] * 3 or socket_event['failed_shards'] != 0:
+            print(f"ERROR: Expected the event in the callback, the socket and the file, got {received}, {socket_event}, {file_event}")
+            success = False
+        else:
+            print("✓ Events go to the callback, the socket clients and the JSON-lines file")
+        client.close()
+
+        # Files are published as rclone logs them, a half written line waits for the next look
+        log_file = os.path.join(work_dir, 'rclone.log')
+        job = {'name': 'raw-data/CMS/', 'prefix': 'raw-data/CMS/', 'docket_depth': 1, 'years': [], 'file_types': ['*'], 'log_file': log_file, 'log_offset': 0}
+        with open(log_file, 'w') as file_handle:
+            file_handle.write(json.dumps({'level': 'notice', 'msg': 'stats', 'stats': {}}) + "\n")
+            file_handle.write(copied_line('CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'))
+            file_handle.write(copied_line('CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json')[:20])
+        tailer = LogTailer([job], publisher, os.path.join(work_dir, 'dest'))
+        first_paths = tailer.drain(job)
+        with open(log_file, 'a') as file_handle:
+            file_handle.write(copied_line('CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json')[20:])
+        second_paths = tailer.drain(job)
+        if first_paths != ['raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'] or len(second_paths) != 1:
+            print(f"ERROR: Expected one copied file per look at the log, got {first_paths} and {second_paths}")
+            success = False
+        elif job['copied_dockets'] != {('CMS', 'CMS-2025-0050')} or [this_event['event'] for this_event in received[1:]] != ['file_completed'] * 2:
+            print(f"ERROR: Expected two file_completed events for CMS-2025-0050, got {received[1:]}")
+            success = False
+        else:
+            print("✓ Copied files are read from the rclone log as they happen")
+
+        # A docket is completed as soon as the last file the job lists for it is copied, the rest when the job finishes
+        locks_held = []
+        publisher.callbacks.append(lambda record: locks_held.append(publisher.lock.locked() or tailer.lock.locked()))
+        listed_job = dict(job, name='listed', files=['CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json',
+                                                     'CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json',
+                                                     'CMS-2024-0010/text-CMS-2024-0010/docket/CMS-2024-0010.json'], log_offset=os.path.getsize(log_file))
+        with open(log_file, 'a') as file_handle:
+            file_handle.write(copied_line('CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'))
+            file_handle.write(copied_line('CMS-2024-0010/text-CMS-2024-0010/docket/CMS-2024-0010.json'))
+        received.clear()
+        tailer.drain(listed_job)
+        first_completed = [this_event['docket'] for this_event in received if this_event['event'] == 'docket_completed']
+        with open(log_file, 'a') as file_handle:
+            file_handle.write(copied_line('CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json'))
+        tailer.drain(listed_job)
+        tailer.finish_job(listed_job)
+        completed = [this_event['docket'] for this_event in received if this_event['event'] == 'docket_completed']
+        if first_completed != ['CMS-2024-0010'] or completed != ['CMS-2024-0010', 'CMS-2025-0050']:
+            print(f"ERROR: Expected CMS-2024-0010 to complete on its own and CMS-2025-0050 after its last file, once each, got {first_completed} then {completed}")
+            success = False
+        elif True in locks_held:
+            print("ERROR: Expected the callbacks to run without the publisher's or the tailer's lock held")
+            success = False
+        else:
+            print("✓ Each docket is completed as soon as its listed files are copied, and callbacks run outside the locks")
+        publisher.close()
+
+        # A new docket is renamed into place, an existing one gets the staged files laid over it
+        dest_dir = os.path.join(work_dir, 'dest')
+        staging_dir = get_staging_dir(dest_dir, job)
+        old_comment = 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'
+        new_comment = 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0004.json'
+        write_file(os.path.join(dest_dir, old_comment), b'old')
+        write_file(os.path.join(dest_dir, 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json'), b'kept')
+        write_file(os.path.join(staging_dir, old_comment), b'new')
+        write_file(os.path.join(staging_dir, new_comment), b'added')
+        write_file(os.path.join(staging_dir, 'raw-data/CMS/CMS-2024-0010/text-CMS-2024-0010/docket/CMS-2024-0010.json'), b'{}')
+
+        promoted = promote_staged_job(dest_dir, job)
+        docket_dir = os.path.join(dest_dir, 'raw-data/CMS/CMS-2025-0050')
+        with open(os.path.join(dest_dir, old_comment), 'rb') as file_handle:
+            old_comment_data = file_handle.read()
+        if sorted((agency, docket_id) for agency, docket_id, directory in promoted) != [('CMS', 'CMS-2024-0010'), ('CMS', 'CMS-2025-0050')]:
+            print(f"ERROR: Expected both staged dockets to be promoted, got {promoted}")
+            success = False
+        elif old_comment_data != b'new' or len(os.listdir(os.path.join(docket_dir, 'text-CMS-2025-0050', 'comments'))) != 3:
+            print("ERROR: Expected the changed comment replaced, the new one added and the untouched one kept")
+            success = False
+        elif os.path.exists(staging_dir) or sorted(os.listdir(os.path.join(dest_dir, 'raw-data', 'CMS'))) != ['CMS-2024-0010', 'CMS-2025-0050']:
+            print("ERROR: Expected nothing left behind in staging or next to the dockets")
+            success = False
+        else:
+            print("✓ Staged dockets are promoted into place and staging is cleaned up")
+
+        # With a staging directory rclone copies there, comparing against the destination
+        job['staging_dir'] = staging_dir
+        command = build_rclone_command(job, dest_dir, 'rclone.conf', '')
+        if f"{os.path.join(staging_dir, 'raw-data/CMS/')} --compare-dest {os.path.join(dest_dir, 'raw-data/CMS/')}" not in command:
+            print(f"ERROR: Expected the staged copy to compare against the destination, got {command}")
+            success = False
+        else:
+            print("✓ A staged copy only fetches what the destination does not already have")
+
+        # Where the system can, the updated docket takes the old one's place in a single rename
+        write_file(os.path.join(work_dir, 'first', 'a'), b'')
+        write_file(os.path.join(work_dir, 'second', 'b'), b'')
+        if not exchange_paths(os.path.join(work_dir, 'first'), os.path.join(work_dir, 'second')):
+            print("- This system cannot swap two directories at once, promotions use two renames")
+        elif os.listdir(os.path.join(work_dir, 'first')) != ['b'] or os.listdir(os.path.join(work_dir, 'second')) != ['a']:
+            print("ERROR: Expected the two directories to swap places")
+            success = False
+        else:
+            print("✓ Two directories swap places in one rename")
+
+        # Promoting over a docket twice in a row leaves no leftovers behind
+        write_file(os.path.join(work_dir, 'staged', 'comments', 'a.json'), b'1')
+        promote_docket(os.path.join(work_dir, 'staged'), docket_dir)
+        if os.path.exists(docket_dir + '.old') or os.path.exists(docket_dir + '.promoting'):
+            print("ERROR: Expected the swap directories to be removed")
+            success = False
+        else:
+            print("✓ The swap directories are removed after a promotion")
+
+        # Through the API, a staged docket is in place and announced while the job is still copying the next one
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+            file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+        os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+        config_file = os.path.join(work_dir, 'rclone.conf')
+        open(config_file, 'w').close()
+        files_from = os.path.join(work_dir, 'repair.txt')
+        with open(files_from, 'w') as file_handle:
+            file_handle.write("raw-data/EPA/EPA-2024-0001/text-EPA-2024-0001/docket/EPA-2024-0001.json\n"
+                              "raw-data/EPA/EPA-2024-0001/text-EPA-2024-0001/comments/EPA-2024-0001-0001.json\n"
+                              "raw-data/EPA/EPA-2025-0002/text-EPA-2025-0002/docket/EPA-2025-0002.json\n")
+        api_dest_dir = os.path.join(work_dir, 'api_dest')
+        os.makedirs(api_dest_dir)
+        completed = []
+
+        def on_event(record):
+            if record['event'] == 'docket_completed':
+                completed.append((record['docket'], record['time'], os.path.isfile(os.path.join(record['directory'], 'text-' + record['docket'], 'docket', record['docket'] + '.json'))))
+
+        async def download():
+            handle = await mirrulations_api.download({'files_from': files_from},
+                                                     {'dest_dir': api_dest_dir, 'rclone_config_file': config_file, 'staging': True, 'on_event': on_event})
+            return await handle.wait()
+
+        old_environment = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_RCLONE_EXITED'] = os.path.join(work_dir, 'exited')
+        os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+        os.environ['MIRRULATIONS_REMOTE'] = 's3:bucket/'
+        try:
+            import mirrulations_api
+            asyncio.run(download())
+            with open(os.path.join(work_dir, 'exited')) as file_handle:
+                exited_at = float(file_handle.read())
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environment)
+        if [this_docket for this_docket, event_time, in_place in completed] != ['EPA-2024-0001', 'EPA-2025-0002'] or not all(in_place for this_docket, event_time, in_place in completed):
+            print(f"ERROR: Expected both dockets to be completed in place, got {completed}")
+            success = False
+        elif completed[0][1] >= exited_at:
+            print("ERROR: Expected the first docket to be completed before rclone finished the job")
+            success = False
+        else:
+            print("✓ A staged docket is promoted and completed while its job is still copying others")
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Events test PASSED!")
+    else:
+        print(f"\n❌ Events test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_events_test()
+    sys.exit(0 if success else 1)
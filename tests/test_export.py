@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the Parquet export of downloaded data. Does not need network access, but needs pyarrow.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from test_index import write_comment
+
+def run_export_test():
+    """Run the export test"""
+    print("=" * 60)
+    print("TESTING: Parquet export of downloaded data")
+    print("=" * 60)
+
+    success = True
+    data_root = tempfile.mkdtemp(prefix="mirrulations_export_test_")
+
+    from mirrulations_export import docket_signature, comment_row, pyarrow_available, run_export
+    from mirrulations_archive import pack_prefix
+
+    try:
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0002', '2025-03-01T05:00:00Z', ['att1', 'att2'])
+        write_comment(data_root, 'CMS', 'CMS-2024-0010', 'CMS-2024-0010-0002', '2024-02-01T05:00:00Z')
+        write_comment(data_root, 'FDA', 'FDA-2024-0001', 'FDA-2024-0001-0002', '2024-01-05T05:00:00Z', ['att3'])
+        text_dir = os.path.join(data_root, 'raw-data', 'CMS', 'CMS-2025-0050', 'text-CMS-2025-0050')
+
+        signature = docket_signature(text_dir)
+        if signature != docket_signature(text_dir) or signature[0] != 1:
+            print(f"ERROR: Expected a stable signature covering one file, got {signature}")
+            success = False
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0003', '2025-03-02T05:00:00Z')
+        if docket_signature(text_dir) == signature:
+            print("ERROR: Expected a new comment to change the docket signature")
+            success = False
+        else:
+            print("✓ A docket's signature changes when its comments change")
+
+        row = comment_row({'id': 'X-2025-0001-0001', 'attributes': {'docketId': 'X-2025-0001', 'comment': 'Hello'},
+                           'relationships': {'attachments': {'data': [{'id': 'a'}]}}}, [])
+        if row['comment'] != 'Hello' or row['attachment_count'] != 1 or row['docket_id'] != 'X-2025-0001':
+            print(f"ERROR: Unexpected comment row {row}")
+            success = False
+        else:
+            print("✓ Comment JSON is flattened into a row")
+
+        if not pyarrow_available():
+            print("ERROR: pyarrow is not installed, so the Parquet files cannot be checked. Install it with: pip install pyarrow")
+            success = False
+        else:
+            import pyarrow.dataset
+
+            output_dir = os.path.join(data_root, 'parquet')
+            counts = run_export(data_root, output_dir, workers=2, log=lambda message: None)
+            dataset = pyarrow.dataset.dataset(os.path.join(output_dir, 'comments'), partitioning='hive')
+            table = dataset.to_table(filter=pyarrow.dataset.field('agency') == 'CMS')
+            if counts['exported'] != 3 or table.num_rows != 3:
+                print(f"ERROR: Expected 3 dockets exported and 3 CMS comments, got {counts} and {table.num_rows} rows")
+                success = False
+            elif not os.path.exists(os.path.join(output_dir, 'comments', 'agency=FDA', 'year=2024', 'FDA-2024-0001.parquet')):
+                print("ERROR: Expected the FDA docket under agency=FDA/year=2024")
+                success = False
+            else:
+                print("✓ Comments are exported partitioned by agency and year")
+
+            write_comment(data_root, 'FDA', 'FDA-2024-0001', 'FDA-2024-0001-0003', '2024-01-06T05:00:00Z')
+            counts = run_export(data_root, output_dir, workers=1, log=lambda message: None)
+            if counts['exported'] != 1 or counts['unchanged'] != 2:
+                print(f"ERROR: Expected only the changed docket to be rewritten, got {counts}")
+                success = False
+            else:
+                print("✓ A rerun only rewrites dockets that changed")
+
+            # Packing takes the docket's directory away, but not its export
+            pack_prefix(data_root, os.path.join(data_root, 'packed'), 'raw-data/CMS/CMS-2024-0010/')
+            shutil.rmtree(os.path.join(data_root, 'raw-data', 'FDA'))
+            counts = run_export(data_root, output_dir, workers=1, log=lambda message: None)
+            if counts['removed'] != 1 or not os.path.exists(os.path.join(output_dir, 'comments', 'agency=CMS', 'year=2024', 'CMS-2024-0010.parquet')):
+                print(f"ERROR: Expected only the deleted docket's export to be removed, got {counts}")
+                success = False
+            else:
+                print("✓ A packed docket keeps its export, a deleted one loses it")
+
+    finally:
+        shutil.rmtree(data_root)
+
+    if success:
+        print(f"\n🎉 Export test PASSED!")
+    else:
+        print(f"\n❌ Export test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_export_test()
+    sys.exit(0 if success else 1)
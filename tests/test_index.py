@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the comment level index of downloaded data. Does not need network access.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_record(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file_handle:
+        json.dump(record, file_handle)
+
+def write_comment(data_root, agency, docket_id, comment_id, posted_date, attachment_ids=(), body=''):
+    """Write a comment the way mirrulations saves regulations.gov API responses"""
+    record = {
+        'data': {
+            'id': comment_id,
+            'type': 'comments',
+            'attributes': {'docketId': docket_id, 'agencyId': agency, 'postedDate': posted_date,
+                           'commentOnDocumentId': f"{docket_id}-0001", 'title': f"Comment {comment_id}", 'comment': body},
+            'relationships': {'attachments': {'data': [{'id': this_id, 'type': 'attachments'} for this_id in attachment_ids]}},
+        },
+        'included': [{'id': this_id, 'type': 'attachments',
+                      'attributes': {'title': 'Attachment', 'fileFormats': [{'format': 'pdf', 'fileUrl': f"https://downloads.regulations.gov/{this_id}.pdf"}]}}
+                     for this_id in attachment_ids],
+    }
+    write_record(os.path.join(data_root, 'raw-data', agency, docket_id, f"text-{docket_id}", 'comments', f"{comment_id}.json"), record)
+
+def run_index_test():
+    """Run the index test"""
+    print("=" * 60)
+    print("TESTING: Comment level index of downloaded data")
+    print("=" * 60)
+
+    success = True
+    data_root = tempfile.mkdtemp(prefix="mirrulations_index_test_")
+
+    from mirrulations_index import open_index, index_tree, search_text
+
+    try:
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0002', '2025-03-01T05:00:00Z', ['att1', 'att2'])
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0003', '2025-03-02T05:00:00Z')
+        write_comment(data_root, 'FDA', 'FDA-2024-0001', 'FDA-2024-0001-0002', '2024-01-05T05:00:00Z', ['att3'])
+        write_record(os.path.join(data_root, 'raw-data', 'CMS', 'CMS-2025-0050', 'text-CMS-2025-0050', 'docket', 'CMS-2025-0050.json'),
+                     {'data': {'id': 'CMS-2025-0050', 'type': 'dockets', 'attributes': {'agencyId': 'CMS', 'title': 'A docket', 'docketType': 'Rulemaking'}}})
+        write_record(os.path.join(data_root, 'raw-data', 'CMS', 'CMS-2025-0050', 'text-CMS-2025-0050', 'documents', 'CMS-2025-0050-0001.json'),
+                     {'data': {'id': 'CMS-2025-0050-0001', 'type': 'documents', 'attributes': {'docketId': 'CMS-2025-0050', 'agencyId': 'CMS', 'documentType': 'Proposed Rule'}}})
+        with open(os.path.join(data_root, 'raw-data', 'FDA', 'FDA-2024-0001', 'text-FDA-2024-0001', 'comments', 'broken.json'), 'w') as file_handle:
+            file_handle.write('{"data": ')
+
+        connection = open_index(os.path.join(data_root, 'index.sqlite'))
+        counts = index_tree(connection, data_root, log=lambda message: None)
+        if counts['indexed'] != 5 or counts['failed'] != 1:
+            print(f"ERROR: Expected 5 files indexed and 1 failure, got {counts}")
+            success = False
+        else:
+            print("✓ Comments, documents and dockets are indexed and broken files are reported")
+
+        row = connection.execute("SELECT docket_id, agency, posted_date, attachment_count FROM comments WHERE comment_id = 'CMS-2025-0050-0002'").fetchone()
+        attachments = connection.execute("SELECT attachment_id FROM comment_attachments WHERE comment_id = 'CMS-2025-0050-0002' ORDER BY 1").fetchall()
+        if row != ('CMS-2025-0050', 'CMS', '2025-03-01T05:00:00Z', 2) or attachments != [('att1',), ('att2',)]:
+            print(f"ERROR: Unexpected comment row {row} with attachments {attachments}")
+            success = False
+        else:
+            print("✓ Comments are keyed by ID with docket, agency, posted date and attachments")
+
+        counts = index_tree(connection, data_root, log=lambda message: None)
+        if counts['indexed'] != 0 or counts['skipped_dirs'] != 3 or counts['failed'] != 1:
+            print(f"ERROR: Expected a second run to skip every directory but the one with the broken file, got {counts}")
+            success = False
+        else:
+            print("✓ Unchanged directories are skipped without reading their files")
+
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0004', '2025-03-03T05:00:00Z')
+        counts = index_tree(connection, data_root, log=lambda message: None)
+        total_comments = connection.execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+        if counts['indexed'] != 1 or counts['unchanged'] != 3 or total_comments != 4:
+            print(f"ERROR: Expected only the new comment to be parsed, got {counts} and {total_comments} comments")
+            success = False
+        else:
+            print("✓ Only files added since the last run are parsed")
+
+        # Comment bodies, document pages and extracted attachment text can be searched
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0005', '2025-03-04T05:00:00Z', body="We need <b>prior authorization</b> reform.<br/>")
+        with open(os.path.join(data_root, 'raw-data', 'CMS', 'CMS-2025-0050', 'text-CMS-2025-0050', 'documents', 'CMS-2025-0050-0001_content.htm'), 'w') as file_handle:
+            file_handle.write("<html><head><style>p { color: red }</style></head><body><p>Proposed changes to prior authorization</p></body></html>")
+        extracted_dir = os.path.join(data_root, 'derived-data', 'FDA', 'FDA-2024-0001', 'mirrulations', 'extracted_txt', 'comments_extracted_text', 'pdfminer')
+        os.makedirs(extracted_dir)
+        with open(os.path.join(extracted_dir, 'FDA-2024-0001-0002_attachment_1.txt'), 'w') as file_handle:
+            file_handle.write("Prior authorization delays patient care.")
+        index_tree(connection, data_root, log=lambda message: None)
+
+        matches = search_text(connection, '"prior authorization"')
+        kinds = sorted(this_match['kind'] for this_match in matches)
+        if kinds != ['attachment', 'comment', 'document']:
+            print(f"ERROR: Expected a comment, a document and an attachment to match, got {matches}")
+            success = False
+        elif search_text(connection, '"prior authorization"', agency_list=['FDA'])[0]['record_id'] != 'FDA-2024-0001-0002_attachment_1':
+            print("ERROR: Expected the agency filter to leave only the FDA attachment")
+            success = False
+        elif search_text(connection, 'color') or '[prior authorization]' not in search_text(connection, '"prior authorization"', kinds=['comment'])[0]['snippet']:
+            print("ERROR: Expected the markup and styles to be left out and the match to be marked in the snippet")
+            success = False
+        else:
+            print("✓ Comment bodies, documents and attachment text are searchable, with filters and snippets")
+
+        # A changed file replaces its text in the search. rclone writes it under another name and renames it into place
+        comments_dir = os.path.join(data_root, 'raw-data', 'CMS', 'CMS-2025-0050', 'text-CMS-2025-0050', 'comments')
+        os.rename(os.path.join(comments_dir, 'CMS-2025-0050-0005.json'), os.path.join(data_root, 'old.json'))
+        write_comment(data_root, 'CMS', 'CMS-2025-0050', 'CMS-2025-0050-0005', '2025-03-04T05:00:00Z', body="Telehealth should stay.")
+        index_tree(connection, data_root, log=lambda message: None)
+        if search_text(connection, '"prior authorization"', kinds=['comment']) or len(search_text(connection, 'telehealth')) != 1:
+            print("ERROR: Expected the changed comment's new text to replace the old one")
+            success = False
+        else:
+            print("✓ Changed files replace their text in the search")
+
+        connection.close()
+
+    finally:
+        shutil.rmtree(data_root)
+
+    if success:
+        print(f"\n🎉 Index test PASSED!")
+    else:
+        print(f"\n❌ Index test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_index_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the checkpoint journal that --resume relies on. Does not need network access.
+"""
+
+import os
+import sys
+import asyncio
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Notes the source of every copy it is asked to do, and copies nothing
+FAKE_RCLONE = """#!/bin/sh
+echo "$2" >> "$FAKE_RCLONE_CALLS"
+exit 0
+"""
+
+def run_journal_test():
+    """Run the journal test"""
+    print("=" * 60)
+    print("TESTING: Checkpoint journal and resume")
+    print("=" * 60)
+
+    success = True
+    state_dir = tempfile.mkdtemp(prefix="mirrulations_journal_test_")
+    os.environ['MIRRULATIONS_STATE_PATH'] = state_dir
+
+    from mirrulations_journal import append_journal_event, read_journal, start_journal
+
+    try:
+        units = ['CMS:raw-data/CMS/', 'CMS:derived-data/CMS/', 'FDA:raw-data/FDA/', 'FDA:derived-data/FDA/']
+
+        journal_path, finished_units = start_journal(units, resume=False)
+        append_journal_event(journal_path, 'started', unit=units[0])
+        append_journal_event(journal_path, 'finished', unit=units[0], exit_code=0, elapsed=10)
+        append_journal_event(journal_path, 'started', unit=units[1])
+        append_journal_event(journal_path, 'finished', unit=units[1], exit_code=5, elapsed=10)
+        append_journal_event(journal_path, 'started', unit=units[2])
+        # Simulate the machine going down half way through writing an event
+        with open(journal_path, 'a') as file_handle:
+            file_handle.write('{"event": "finished", "unit": "FDA:raw-da')
+
+        resumed_path, finished_units = start_journal(units, resume=True)
+        if resumed_path != journal_path:
+            print(f"ERROR: Expected the same selection to map to the same journal, got {resumed_path}")
+            success = False
+        elif finished_units != {units[0]}:
+            print(f"ERROR: Expected only {units[0]} to count as finished, got {finished_units}")
+            success = False
+        else:
+            print("✓ Only units that finished successfully are skipped on resume")
+
+        planned_units = [this_event['unit'] for this_event in read_journal(journal_path) if this_event['event'] == 'planned']
+        if planned_units[-3:] != units[1:]:
+            print(f"ERROR: Expected the unfinished units to be planned again after the torn line, got {planned_units}")
+            success = False
+        else:
+            print("✓ A half written event does not corrupt the events after it")
+
+        # A unit that is started again has to finish again before it counts as done
+        append_journal_event(journal_path, 'started', unit=units[0])
+        resumed_path, finished_units = start_journal(units, resume=True)
+        if finished_units:
+            print(f"ERROR: Expected a restarted unit not to count as finished, got {finished_units}")
+            success = False
+        else:
+            print("✓ A restarted unit has to finish again")
+
+        # Without --resume we start over
+        journal_path, finished_units = start_journal(units, resume=False)
+        if finished_units:
+            print(f"ERROR: Expected a fresh run to start from nothing, got {finished_units}")
+            success = False
+        else:
+            print("✓ A run without --resume starts a fresh journal")
+
+        # The same job names copy other files for another selection or slice, so they get a journal of their own
+        selections = [{'years': [2024]}, {'years': [2025]}, {'textonly': True}, {'shard': '1/2'}, {'shard': '2/2'},
+                      {'attributes': {'min_comments': 10}}, {'sampling': {'sample': '5%'}}]
+        paths = {start_journal(units, False, this_key)[0] for this_key in selections}
+        if len(paths) != len(selections) or start_journal(units, True, {'years': [2024]})[0] not in paths:
+            print(f"ERROR: Expected each selection to have its own journal, got {len(paths)} for {len(selections)} selections")
+            success = False
+        else:
+            print("✓ Each selection and shard keeps its own journal")
+
+        # Through the API, resuming another year of the same agency downloads that year
+        bin_dir = os.path.join(state_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+            file_handle.write(FAKE_RCLONE)
+        os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+        config_file = os.path.join(state_dir, 'rclone.conf')
+        open(config_file, 'w').close()
+        calls_file = os.path.join(state_dir, 'calls')
+        old_environment = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_RCLONE_CALLS'] = calls_file
+        os.environ['MIRRULATIONS_REMOTE'] = 's3:bucket/'
+        import mirrulations_api
+
+        async def download(year, resume):
+            handle = await mirrulations_api.download({'agencies': ['CMS'], 'years': [year]}, {'dest_dir': state_dir, 'rclone_config_file': config_file, 'resume': resume})
+            return await handle.wait()
+
+        try:
+            asyncio.run(download(2024, False))
+            asyncio.run(download(2025, True))
+            asyncio.run(download(2025, True))
+            with open(calls_file) as file_handle:
+                calls = sorted(file_handle.read().split())
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environment)
+        if calls != sorted(["s3:bucket/raw-data/CMS/", "s3:bucket/derived-data/CMS/"] * 2):
+            print(f"ERROR: Expected 2025 to be downloaded once after 2024 and skipped when resumed again, got {calls}")
+            success = False
+        else:
+            print("✓ Resuming another year of the same agency downloads it, and only once")
+
+    finally:
+        shutil.rmtree(state_dir)
+
+    if success:
+        print(f"\n🎉 Journal test PASSED!")
+    else:
+        print(f"\n❌ Journal test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_journal_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Test script to build a manifest from a small local stand-in for the bucket and resolve selections against it.
+Does not need network access.
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mirrulations_planning import plan_copy_jobs
+from mirrulations_manifest import iter_remote_listing, open_manifest, record_synced_paths, refresh_manifest, select_job_delta, select_job_paths, summarize_job
+
+#Lists as many objects as FAKE_LISTING_SIZE says the way rclone lsjson does, one entry per line, or fails for 'missing'
+FAKE_RCLONE = """#!{python}
+import os, sys, json
+if any('missing' in this_argument for this_argument in sys.argv):
+    sys.stderr.write("bucket not reachable\\n")
+    sys.exit(1)
+count = int(os.environ['FAKE_LISTING_SIZE'])
+print("[")
+for index in range(count):
+    entry = {{"Path": f"CMS/CMS-2025-{{index // 100:04d}}/text-CMS-2025-{{index // 100:04d}}/comments/{{index:08d}}.json", "Name": "x",
+             "Size": index, "ModTime": "2025-01-02T03:04:05.123456789Z", "IsDir": False}}
+    print(json.dumps(entry) + ("," if index < count - 1 else ""))
+print("]")
+"""
+
+#Copies nothing: the raw-data job finishes straight away and the derived-data job runs until it is stopped
+FAKE_RCLONE_COPY = """#!/bin/sh
+case "$*" in
+    *derived-data*) exec sleep 3 ;;
+esac
+exit 0
+"""
+
+def make_fake_bucket(bucket_dir):
+    """Lay out two CMS dockets the way the mirrulations bucket does"""
+    for docket in ["CMS-2024-0001", "CMS-2025-0050"]:
+        files = [
+            f"raw-data/CMS/{docket}/text-{docket}/docket/{docket}.json",
+            f"raw-data/CMS/{docket}/text-{docket}/comments/{docket}-0001.json",
+            f"raw-data/CMS/{docket}/text-{docket}/documents/{docket}-0001_content.htm",
+            f"raw-data/CMS/{docket}/binary-{docket}/comments_attachements/{docket}-0001_attachment_1.pdf",
+            f"raw-data/CMS/{docket}/binary-{docket}/comments_attachements/{docket}-0001_attachment_2.txt",
+            f"derived-data/CMS/{docket}/mirrulations/extracted_txt/comments_extracted_text/pdfminer/{docket}-0001_attachment_1.txt",
+        ]
+        for this_file in files:
+            file_path = bucket_dir / this_file
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_text(f"contents of {this_file}")
+
+def run_manifest_test():
+    """Run the manifest test"""
+    print("=" * 60)
+    print("TESTING: Manifest building, selection resolution and delta sync")
+    print("=" * 60)
+
+    success = True
+    work_dir = Path(tempfile.mkdtemp(prefix="mirrulations_manifest_test_"))
+
+    try:
+        bucket_dir = work_dir / "bucket"
+        make_fake_bucket(bucket_dir)
+        connection = open_manifest(str(work_dir / "manifest.sqlite"))
+
+        counts = refresh_manifest(connection, iter_remote_listing(str(bucket_dir) + "/", None, "raw-data/"), "raw-data/")
+        counts = refresh_manifest(connection, iter_remote_listing(str(bucket_dir) + "/", None, "derived-data/"), "derived-data/")
+        total = connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+        if total != 12:
+            print(f"ERROR: Expected 12 objects in the manifest, got {total}")
+            success = False
+        else:
+            print("✓ Manifest lists every object in the bucket")
+
+        year, section = connection.execute(
+            "SELECT year, section FROM objects WHERE path LIKE 'raw-data/CMS/CMS-2025-0050/binary-%' LIMIT 1").fetchone()
+        if year != 2025 or section != 'binary':
+            print(f"ERROR: Expected year 2025 and section binary, got {year} and {section}")
+            success = False
+        else:
+            print("✓ Docket year and section are parsed from the path")
+
+        # Refreshing again after a change should only report the difference
+        (bucket_dir / "raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json").write_text("{}")
+        (bucket_dir / "raw-data/CMS/CMS-2024-0001/text-CMS-2024-0001/docket/CMS-2024-0001.json").unlink()
+        counts = refresh_manifest(connection, iter_remote_listing(str(bucket_dir) + "/", None, "raw-data/CMS/"), "raw-data/CMS/")
+        if (counts['added'], counts['removed'], counts['unchanged']) != (1, 1, 9):
+            print(f"ERROR: Expected 1 added, 1 removed and 9 unchanged, got {counts}")
+            success = False
+        else:
+            print("✓ Refresh reports added and removed objects")
+
+        # A textonly selection should not include anything from the binary directories, even .txt files
+        jobs = plan_copy_jobs(['CMS'], [2025], [], ['*.txt', '*.json', '*.htm'])
+        raw_job = [this_job for this_job in jobs if this_job['prefix'] == 'raw-data/CMS/'][0]
+        paths = select_job_paths(connection, raw_job, textonly=True)
+        expected_paths = [
+            "CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0001.json",
+            "CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json",
+            "CMS-2025-0050/text-CMS-2025-0050/docket/CMS-2025-0050.json",
+            "CMS-2025-0050/text-CMS-2025-0050/documents/CMS-2025-0050-0001_content.htm",
+        ]
+        if paths != expected_paths:
+            print(f"ERROR: Expected {expected_paths}, got {paths}")
+            success = False
+        else:
+            print("✓ Textonly selection resolves to the text files of the matching dockets")
+
+        jobs = plan_copy_jobs(['*'], ['*'], ['CMS-2024-0001'], ['*'])
+        paths = [path for this_job in jobs for path in select_job_paths(connection, this_job, textonly=False)]
+        if len(paths) != 5:
+            print(f"ERROR: Expected 5 files for docket CMS-2024-0001, got {paths}")
+            success = False
+        else:
+            print("✓ Docket selection resolves to every file in the docket")
+
+        # The plan summary should split raw text, raw binaries and derived data
+        jobs = plan_copy_jobs(['CMS'], [2025], [], ['*'])
+        summary = sorted(this_row for this_job in jobs for this_row in summarize_job(connection, this_job, textonly=False))
+        kinds = [(kind, object_count) for agency, year, kind, object_count, total_bytes in summary]
+        if kinds != [('derived', 1), ('raw binary', 2), ('raw text', 4)]:
+            print(f"ERROR: Unexpected plan summary: {summary}")
+            success = False
+        else:
+            print("✓ Plan summary splits raw text, raw binaries and derived data")
+
+        # After a successful sync, a delta run should only pick up what changed since
+        jobs = plan_copy_jobs(['CMS'], [2024, 2025], [], ['*'])
+        raw_job = [this_job for this_job in jobs if this_job['prefix'] == 'raw-data/CMS/'][0]
+        paths, docket_counts = select_job_delta(connection, raw_job, textonly=False)
+        record_synced_paths(connection, raw_job['prefix'], paths)
+
+        new_comment = bucket_dir / "raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json"
+        new_comment.write_text("{}")
+        refresh_manifest(connection, iter_remote_listing(str(bucket_dir) + "/", None, "raw-data/CMS/"), "raw-data/CMS/")
+        paths, docket_counts = select_job_delta(connection, raw_job, textonly=False)
+        expected_counts = {
+            'CMS-2024-0001': {'added': 0, 'changed': 0, 'unchanged': 4},
+            'CMS-2025-0050': {'added': 1, 'changed': 0, 'unchanged': 6},
+        }
+        if paths != ["CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json"] or docket_counts != expected_counts:
+            print(f"ERROR: Unexpected delta: {paths} {docket_counts}")
+            success = False
+        else:
+            print("✓ Delta only picks up objects added since the last sync")
+
+        # What a job copied is remembered as soon as it finishes, even when the run is stopped before its end
+        copy_bin_dir = work_dir / "copy_bin"
+        copy_bin_dir.mkdir()
+        (copy_bin_dir / "rclone").write_text(FAKE_RCLONE_COPY)
+        (copy_bin_dir / "rclone").chmod(0o755)
+        (work_dir / "dest").mkdir()
+        (work_dir / "rclone.conf").write_text("")
+        old_environment = dict(os.environ)
+        os.environ['PATH'] = str(copy_bin_dir) + os.pathsep + os.environ['PATH']
+        os.environ['MIRRULATIONS_STATE_PATH'] = str(work_dir / "state")
+        os.environ['MIRRULATIONS_REMOTE'] = str(bucket_dir) + "/"
+        import mirrulations_api
+
+        async def download_until_raw_data_finished():
+            handle = await mirrulations_api.download({'agencies': ['CMS']}, {'dest_dir': str(work_dir / "dest"), 'rclone_config_file': str(work_dir / "rclone.conf"),
+                                                                             'delta': True, 'parallel': 2})
+            deadline = time.time() + 20
+            while time.time() < deadline and 'finished' not in [this_shard['status'] for this_shard in handle.shards() if this_shard['prefix'] == 'raw-data/CMS/']:
+                await asyncio.sleep(0.1)
+            handle.cancel()
+            try:
+                await handle.wait()
+            except mirrulations_api.DownloadCancelled:
+                pass
+
+        try:
+            (work_dir / "state").mkdir()
+            state_connection = open_manifest()
+            for this_prefix in ["raw-data/", "derived-data/"]:
+                refresh_manifest(state_connection, iter_remote_listing(str(bucket_dir) + "/", None, this_prefix), this_prefix)
+            asyncio.run(download_until_raw_data_finished())
+            raw_paths, docket_counts = select_job_delta(state_connection, plan_copy_jobs(['CMS'], ['*'], [], ['*'])[1], textonly=False)
+            derived_paths, docket_counts = select_job_delta(state_connection, plan_copy_jobs(['CMS'], ['*'], [], ['*'])[0], textonly=False)
+            state_connection.close()
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environment)
+        if raw_paths or not derived_paths:
+            print(f"ERROR: Expected the finished raw-data job to be recorded and the stopped derived-data one not, got {raw_paths} and {derived_paths}")
+            success = False
+        else:
+            print("✓ A finished job is recorded for the next delta run even when the run is stopped")
+
+        # A listing far bigger than a batch streams from rclone into the manifest with flat memory
+        bin_dir = work_dir / "bin"
+        bin_dir.mkdir()
+        (bin_dir / "rclone").write_text(FAKE_RCLONE.format(python=sys.executable))
+        (bin_dir / "rclone").chmod(0o755)
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = str(bin_dir) + os.pathsep + old_path
+        try:
+            #Memory should not grow with the size of the listing, only with the batch size
+            peaks = {}
+            for listing_size in [20000, 100000]:
+                os.environ['FAKE_LISTING_SIZE'] = str(listing_size)
+                big_connection = open_manifest(str(work_dir / f"big-{listing_size}.sqlite"))
+                tracemalloc.start()
+                counts = refresh_manifest(big_connection, iter_remote_listing("remote:bucket/", None, "raw-data/"), "raw-data/")
+                peaks[listing_size] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                dockets = big_connection.execute("SELECT COUNT(DISTINCT docket) FROM objects").fetchone()[0]
+                big_connection.close()
+            if counts['added'] != 100000 or dockets != 1000:
+                print(f"ERROR: Expected 100000 objects in 1000 dockets from the streamed listing, got {counts} in {dockets} dockets")
+                success = False
+            elif peaks[100000] > peaks[20000] * 1.5:
+                print(f"ERROR: Expected memory to stay flat, 20000 objects peaked at {peaks[20000] / 1024 ** 2:.1f} MiB and 100000 at {peaks[100000] / 1024 ** 2:.1f} MiB")
+                success = False
+            else:
+                print(f"✓ Listings stream into the manifest with flat memory: {peaks[20000] / 1024 ** 2:.1f} MiB for 20000 objects, {peaks[100000] / 1024 ** 2:.1f} MiB for 100000")
+
+            try:
+                list(iter_remote_listing("remote:missing/", None, "raw-data/"))
+                print("ERROR: Expected a failing rclone lsjson to raise")
+                success = False
+            except RuntimeError as error:
+                if 'bucket not reachable' not in str(error):
+                    print(f"ERROR: Expected rclone's error message, got {error}")
+                    success = False
+                else:
+                    print("✓ A failing listing raises with rclone's error message")
+        finally:
+            os.environ['PATH'] = old_path
+            os.environ.pop('FAKE_LISTING_SIZE', None)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Manifest test PASSED!")
+    else:
+        print(f"\n❌ Manifest test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_manifest_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the live transfer metrics exporter. Does not need network access.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mirrulations_api
+from mirrulations_metrics import MetricsExporter, collect_metrics, write_metrics
+
+def run_metrics_test():
+    """Run the metrics test"""
+    print("=" * 60)
+    print("TESTING: Live transfer metrics")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_metrics_test_")
+
+    try:
+        # One finished shard, one running shard with stats in its log, and one that has not started
+        running_log = os.path.join(work_dir, "rclone-running.log")
+        with open(running_log, 'w') as file_handle:
+            file_handle.write(json.dumps({'stats': {'bytes': 5000, 'speed': 500.0, 'transfers': 20, 'checks': 40, 'errors': 1, 'elapsedTime': 10.0, 'eta': 30}}) + "\n")
+
+        jobs = [
+            {'prefix': 'raw-data/CMS/', 'log_file': 'unused', 'started_at': 1, 'final_stats': {'bytes': 1000, 'transfers': 10, 'checks': 10, 'errors': 0, 'elapsedTime': 5.0}},
+            {'prefix': 'raw-data/CMS/', 'log_file': running_log, 'started_at': 2, 'log_offset': 0},
+            {'prefix': 'derived-data/', 'log_file': os.path.join(work_dir, "rclone-waiting.log")},
+        ]
+
+        groups = collect_metrics(jobs)
+        raw_cms = groups[('raw-data', 'CMS')]
+        if (raw_cms['bytes'], raw_cms['files'], raw_cms['checks'], raw_cms['errors']) != (6000, 30, 50, 1):
+            print(f"ERROR: Expected finished and running shards to add up, got {raw_cms}")
+            success = False
+        else:
+            print("✓ Finished and running shards are added up per agency and data directory")
+
+        if (raw_cms['bytes_per_second'], raw_cms['files_per_second'], raw_cms['eta'], raw_cms['running'], raw_cms['finished']) != (500.0, 2.0, 30, 1, 1):
+            print(f"ERROR: Expected rates and ETA from the running shard only, got {raw_cms}")
+            success = False
+        else:
+            print("✓ Rates and ETA come from the running shards")
+
+        if groups[('derived-data', 'all')]['running'] != 0:
+            print(f"ERROR: Expected the waiting shard not to count as running, got {groups[('derived-data', 'all')]}")
+            success = False
+        else:
+            print("✓ Shards that have not started are not counted as running")
+
+        write_metrics(jobs, work_dir)
+        write_metrics(jobs, work_dir)
+        with open(os.path.join(work_dir, "mirrulations.prom")) as file_handle:
+            prometheus_text = file_handle.read()
+        if 'mirrulations_bytes_transferred_total{agency="CMS",data_directory="raw-data"} 6000' not in prometheus_text:
+            print(f"ERROR: Expected the byte counter in the Prometheus textfile, got:\n{prometheus_text}")
+            success = False
+        else:
+            print("✓ Prometheus textfile is written")
+
+        with open(os.path.join(work_dir, "mirrulations_metrics.jsonl")) as file_handle:
+            records = [json.loads(this_line) for this_line in file_handle]
+        if len(records) != 2 or len(records[0]['groups']) != 2:
+            print(f"ERROR: Expected two JSON-lines snapshots with two groups each, got {records}")
+            success = False
+        else:
+            print("✓ JSON-lines stream gets one snapshot per write")
+
+        # An interval of zero or less would write metrics in a busy loop
+        config_file = os.path.join(work_dir, 'rclone.conf')
+        open(config_file, 'w').close()
+        for this_interval in [0, -5]:
+            try:
+                mirrulations_api.prepare_download({'getall': True}, {'metrics_dir': work_dir, 'metrics_interval': this_interval,
+                                                                     'dest_dir': work_dir, 'rclone_config_file': config_file})
+                print(f"ERROR: Expected a metrics interval of {this_interval} to be refused")
+                success = False
+            except mirrulations_api.ConfigurationError:
+                pass
+            try:
+                MetricsExporter(jobs, work_dir, this_interval)
+                print(f"ERROR: Expected the exporter to refuse an interval of {this_interval}")
+                success = False
+            except ValueError:
+                pass
+        if success:
+            print("✓ Metrics intervals below a second are refused")
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Metrics test PASSED!")
+    else:
+        print(f"\n❌ Metrics test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_metrics_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the bandwidth schedule and the pacing of a combined rate cap. Does not need network access:
+small HTTP servers stand in for the remote control of running rclone processes.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import datetime
+import tempfile
+import threading
+import http.server
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mirrulations_pacing import BandwidthPacer, allocate_bandwidth, parse_rate, parse_schedule, scheduled_rate
+
+MEGABYTE = 1024 * 1024
+
+#Finds its remote control port taken the first time it runs, like rclone it logs that and stops, and remembers its flags
+FAKE_RCLONE = """#!{python}
+import os, sys, json
+arguments = sys.argv[1:]
+calls_file = os.path.join(os.environ['FAKE_RCLONE_STATE'], 'calls')
+open(calls_file, 'a').write(json.dumps(arguments) + "\\n")
+if len(open(calls_file).readlines()) == 1:
+    with open(arguments[arguments.index('--log-file') + 1], 'a') as file_handle:
+        file_handle.write(json.dumps({{'level': 'critical', 'msg': "Failed to start remote control: listen tcp 127.0.0.1:5572: bind: address already in use"}}) + "\\n")
+    sys.exit(1)
+"""
+
+
+def start_fake_rclone(port, wanted_rate):
+    """Answer core/stats and core/bwlimit like rclone would, moving min(wanted_rate, the current limit) bytes per second"""
+    state = {'bytes': 0, 'rate': None, 'updated': time.time(), 'limits': []}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            parameters = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+            now = time.time()
+            moving = wanted_rate if state['rate'] is None else min(wanted_rate, state['rate'])
+            state['bytes'] += moving * (now - state['updated'])
+            state['updated'] = now
+            if self.path == '/core/bwlimit':
+                state['rate'] = parse_rate(parameters['rate'])
+                state['limits'].append(state['rate'])
+            reply = json.dumps({'bytes': int(state['bytes'])}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *arguments):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def run_pacing_test():
+    """Run the pacing test"""
+    print("=" * 60)
+    print("TESTING: Bandwidth schedule and rate pacing")
+    print("=" * 60)
+
+    success = True
+
+    # Rates and timetables use rclone's syntax
+    timetable = parse_schedule("08:00,5M 18:00,off Sat-00:00,1M")
+    wednesday = datetime.datetime(2025, 1, 1)
+    saturday = datetime.datetime(2025, 1, 4)
+    rates = [scheduled_rate(timetable, wednesday.replace(hour=7)), scheduled_rate(timetable, wednesday.replace(hour=12)),
+             scheduled_rate(timetable, wednesday.replace(hour=20)), scheduled_rate(timetable, saturday.replace(hour=12))]
+    if parse_rate('512K') != 512 * 1024 or parse_rate('off') is not None or parse_rate('10') != 10 * 1024:
+        print("ERROR: Expected 512K, off and plain KiB numbers to parse like rclone")
+        success = False
+    elif rates != [None, 5 * MEGABYTE, None, MEGABYTE]:
+        print(f"ERROR: Expected off before 08:00, 5M in the day, off at night and 1M all Saturday, got {rates}")
+        success = False
+    else:
+        print("✓ The timetable gives the right cap for the time and the day of the week")
+
+    for this_schedule in ["8am,5M", "25:00,5M", "08:00,fast", "Someday-08:00,5M"]:
+        try:
+            parse_schedule(this_schedule)
+            print(f"ERROR: Expected {this_schedule} to be rejected")
+            success = False
+        except ValueError:
+            pass
+
+    # The cap is shared out by what each shard can use
+    allocations = allocate_bandwidth(10 * MEGABYTE, {'busy': (5 * MEGABYTE, 5 * MEGABYTE, None), 'slow': (MEGABYTE, 5 * MEGABYTE, None),
+                                                    'capped': (2 * MEGABYTE, 2 * MEGABYTE, 2 * MEGABYTE)})
+    if sum(allocations.values()) > 10 * MEGABYTE + 1 or allocations['capped'] > 2 * MEGABYTE or not allocations['busy'] > allocations['slow'] > MEGABYTE:
+        print(f"ERROR: Expected the busy shard to get what the slow and capped ones cannot use, got {allocations}")
+        success = False
+    else:
+        print("✓ The cap goes to the shards that can use it, within their own limits")
+
+    # Two running rclone processes are kept under the combined cap: one could go much faster, one is slow on its own
+    jobs = [{'name': 'fast'}, {'name': 'slow'}]
+    pacer = BandwidthPacer(jobs, total_rate=4 * MEGABYTE, interval=0.2)
+    servers = []
+    for this_job, wanted_rate in zip(jobs, [50 * MEGABYTE, MEGABYTE // 2]):
+        flags = pacer.start_job(this_job)
+        servers.append(start_fake_rclone(this_job['rc_port'], wanted_rate))
+        servers[-1][1]['rate'] = parse_rate(flags.split('--bwlimit')[1])
+    pacer.start()
+    time.sleep(2.5)
+    pacer.stop()
+    fast_limit = servers[0][1]['rate']
+    slow_limit = servers[1][1]['rate']
+    if not servers[0][1]['limits'] or fast_limit + slow_limit > 4 * MEGABYTE + 1024:
+        print(f"ERROR: Expected the pacer to keep both under 4M together, got {fast_limit} and {slow_limit}")
+        success = False
+    elif fast_limit < 3 * MEGABYTE:
+        print(f"ERROR: Expected the fast shard to get what the slow one leaves, got {fast_limit}")
+        success = False
+    elif pacer.summary()['throttled'] < 1:
+        print(f"ERROR: Expected the run to count as held back by the cap, got {pacer.summary()}")
+        success = False
+    else:
+        print(f"✓ The pacer gave the fast shard {fast_limit / MEGABYTE:.1f}M and the slow one {slow_limit / MEGABYTE:.1f}M of 4M")
+
+    # When the shards move less than the cap allows, the time counts as limited by the network
+    jobs = [{'name': 'slow'}]
+    pacer = BandwidthPacer(jobs, total_rate=100 * MEGABYTE, interval=0.2)
+    pacer.start_job(jobs[0])
+    servers.append(start_fake_rclone(jobs[0]['rc_port'], MEGABYTE))
+    pacer.start()
+    time.sleep(1.5)
+    pacer.stop()
+    if pacer.summary()['network'] < 1 or pacer.summary()['throttled'] != 0:
+        print(f"ERROR: Expected the slow run to count as limited by the network, got {pacer.summary()}")
+        success = False
+    else:
+        print("✓ Time spent below the cap counts as limited by the network")
+
+    # A shard waiting to retry its failed files gives its share back until it starts again
+    jobs = [{'name': 'copying'}, {'name': 'waiting'}]
+    pacer = BandwidthPacer(jobs, total_rate=4 * MEGABYTE)
+    for this_job in jobs:
+        pacer.start_job(this_job)
+    jobs[1]['retry_waiting'] = True
+    if pacer.running_jobs() != [jobs[0]]:
+        print("ERROR: Expected a shard waiting to retry to be left out of the pacing")
+        success = False
+    else:
+        print("✓ A shard waiting to retry is left out of the pacing")
+
+    for this_server, this_state in servers:
+        this_server.shutdown()
+
+    # The remote control only answers what pacing needs, and a shard whose port was taken starts again on another
+    if '--rc-no-auth' in pacer.start_job({'name': 'flags'}):
+        print("ERROR: Expected the remote control to keep its authorisation")
+        success = False
+    else:
+        print("✓ The remote control runs without --rc-no-auth")
+
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_pacing_test_")
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+        file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+    os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+    config_file = os.path.join(work_dir, 'rclone.conf')
+    open(config_file, 'w').close()
+    old_environment = dict(os.environ)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_RCLONE_STATE'] = work_dir
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+    os.environ['MIRRULATIONS_REMOTE'] = 's3:bucket/'
+    import mirrulations_api
+
+    async def download():
+        handle = await mirrulations_api.download({'agencies': ['CMS'], 'textonly': True},
+                                                 {'dest_dir': work_dir, 'rclone_config_file': config_file, 'total_bwlimit': '10M'})
+        return await handle.wait()
+
+    try:
+        result = asyncio.run(download())
+        with open(os.path.join(work_dir, 'calls')) as file_handle:
+            calls = [json.loads(this_line) for this_line in file_handle]
+        ports = [this_call[this_call.index('--rc-addr') + 1] for this_call in calls]
+        if result['failed_shards'] or len(calls) != 3 or ports[0] == ports[1]:
+            print(f"ERROR: Expected the shard to start again on another port and finish, got {ports} and {result['shards']}")
+            success = False
+        else:
+            print("✓ A shard whose remote control port was taken starts again on another port")
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Pacing test PASSED!")
+    else:
+        print(f"\n❌ Pacing test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_pacing_test()
+    sys.exit(0 if success else 1)
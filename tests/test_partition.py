@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Test script to validate splitting a selection between machines with --shard i/N and checking the slices cover it.
+Does not need network access.
+"""
+
+import os
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Writes one file into each docket the filter rules name, in the text or the binary half of a text-first job
+FAKE_RCLONE = """#!{python}
+import os, sys
+arguments = sys.argv[1:]
+destination = arguments[2]
+with open(arguments[arguments.index('--filter-from') + 1]) as file_handle:
+    rule = [this_line for this_line in file_handle if this_line.startswith('+ ')][0]
+for docket_id in rule[2:].split('/')[1].strip('{{}}').split(','):
+    half = 'binary' if 'binary-' in rule else 'text'
+    os.makedirs(os.path.join(destination, docket_id, f"{{half}}-{{docket_id}}"), exist_ok=True)
+    open(os.path.join(destination, docket_id, f"{{half}}-{{docket_id}}", f"{{docket_id}}.{{half}}"), 'w').close()
+"""
+
+def run_partition_test():
+    """Run the partition test"""
+    print("=" * 60)
+    print("TESTING: Multi-machine partitioning and coverage check")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_partition_test_")
+    bucket_dir = os.path.join(work_dir, 'bucket')
+    old_environment = dict(os.environ)
+    os.environ['MIRRULATIONS_REMOTE'] = bucket_dir + '/'
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+
+    from mirrulations_config import docket_shard
+    from mirrulations_synthetic import generate_bucket
+    from mirrulations_planning import TEXT_COMPLETE_DIR_NAME, compile_filter_rules, plan_copy_jobs
+    from mirrulations_manifest import iter_remote_listing, open_manifest, refresh_manifest, select_job_paths
+    from mirrulations_partition import check_coverage, expected_selection_dockets, parse_shard_spec, partition_jobs, write_shard_report
+    import mirrulations_api
+
+    try:
+        generate_bucket(bucket_dir, agencies=2, dockets_per_agency=10, comments_per_docket=2)
+        selection = {'agencies': [], 'years': [], 'dockets': [], 'textonly': False, 'getall': True, 'files_from': '', 'attributes': {}, 'sampling': {}}
+        all_dockets = expected_selection_dockets(selection, None)
+
+        # The spec is checked, and the hash is stable
+        try:
+            parse_shard_spec('3/2')
+            print("ERROR: Expected --shard 3/2 to be rejected")
+            success = False
+        except ValueError:
+            if parse_shard_spec('2/3') != (2, 3) or docket_shard('CMS-2025-0050', 4) != docket_shard('CMS-2025-0050', 4):
+                print("ERROR: Expected 2/3 to parse and the hash to be stable")
+                success = False
+            else:
+                print("✓ i/N is checked and every machine assigns a docket the same shard")
+
+        # Three machines take disjoint slices that add up to every docket
+        slices = []
+        for this_index in [1, 2, 3]:
+            jobs = partition_jobs(plan_copy_jobs(['*'], ['*'], [], ['*']), (this_index, 3), None)
+            slices.append(set().union(*[set(this_job['dockets']) for this_job in jobs]))
+        if set().union(*slices) != all_dockets or sum(len(this_slice) for this_slice in slices) != len(all_dockets):
+            print(f"ERROR: Expected disjoint slices covering all {len(all_dockets)} dockets, got {[len(this_slice) for this_slice in slices]}")
+            success = False
+        elif min(len(this_slice) for this_slice in slices) == 0:
+            print("ERROR: Expected every machine to get some dockets")
+            success = False
+        else:
+            print(f"✓ Three machines split {len(all_dockets)} dockets into disjoint slices of {sorted(len(this_slice) for this_slice in slices)}")
+
+        jobs = partition_jobs(plan_copy_jobs(['CMS'], ['*'], [], ['*']), (1, 3), None)
+        rules = compile_filter_rules([this_job for this_job in jobs if this_job['prefix'] == 'raw-data/CMS/'][0], False)
+        if not rules[0].startswith('+ /{') or 'CMS-' not in rules[0] or rules[-1] != '- **':
+            print(f"ERROR: Expected the filter to name the slice's dockets, got {rules}")
+            success = False
+        else:
+            print("✓ A slice's filter rules name its dockets")
+
+        # With the manifest the slice is selected in SQL
+        connection = open_manifest()
+        for this_prefix in ['raw-data/', 'derived-data/']:
+            refresh_manifest(connection, iter_remote_listing(bucket_dir + '/', None, this_prefix), this_prefix)
+        manifest_dockets = []
+        for this_index in [1, 2, 3]:
+            jobs = partition_jobs(plan_copy_jobs(['*'], ['*'], [], ['*']), (this_index, 3), None, connection)
+            paths = [this_job['prefix'] + this_path for this_job in jobs for this_path in select_job_paths(connection, this_job, False)]
+            manifest_dockets.append({this_path.split('/')[2] for this_path in paths})
+        connection.close()
+        if manifest_dockets != slices:
+            print("ERROR: Expected the manifest to give each machine the same slice as the listing")
+            success = False
+        else:
+            print("✓ The manifest selects the same slices")
+
+        # The reports of all the machines cover everything, a missing or failed machine shows up
+        report_dir = os.path.join(work_dir, 'reports')
+        reports = []
+        for this_index in [1, 2, 3]:
+            jobs = partition_jobs(plan_copy_jobs(['*'], ['*'], [], ['*']), (this_index, 3), None)
+            for this_job in jobs:
+                this_job['name'] = this_job['prefix']
+            #The third machine's first job fails
+            exit_codes = {this_job['name']: 1 if this_index == 3 and this_job is jobs[0] else 0 for this_job in jobs}
+            report_file = write_shard_report(selection, (this_index, 3), jobs, exit_codes, report_dir)
+            with open(report_file) as file_handle:
+                reports.append(json.load(file_handle))
+
+        coverage = check_coverage(reports[:2], all_dockets)
+        if coverage['missing_shards'] != [3] or {this_shard for this_docket, this_shard in coverage['missing']} != {3}:
+            print(f"ERROR: Expected shard 3 to be missing, got {coverage}")
+            success = False
+        elif check_coverage(reports, all_dockets)['missing'] == [] or reports[2]['failed_dockets'] == []:
+            print("ERROR: Expected the dockets of shard 3's failed job to be missing")
+            success = False
+        else:
+            print("✓ The coverage check finds a missing machine and a machine with a failed job")
+
+        reports[2]['finished_dockets'] = sorted(slices[2])
+        coverage = check_coverage(reports, all_dockets)
+        if coverage['missing'] or coverage['missing_shards'] or coverage['misplaced'] or coverage['covered'] != len(all_dockets):
+            print(f"ERROR: Expected full coverage, got {coverage}")
+            success = False
+        else:
+            print("✓ Complete slices cover the whole selection")
+
+        # Slices selected by attributes or sampled report apart from the plain selection, and only the matching dockets are expected
+        rule_docket = sorted(all_dockets)[0]
+        document_file = os.path.join(bucket_dir, 'raw-data', rule_docket.split('-')[0], rule_docket, f"text-{rule_docket}", 'documents', f"{rule_docket}-0001.json")
+        with open(document_file) as file_handle:
+            document = json.load(file_handle)
+        document['data']['attributes']['documentType'] = 'Rule'
+        with open(document_file, 'w') as file_handle:
+            json.dump(document, file_handle)
+        rule_selection = dict(selection, attributes={'document_types': ['Rule']})
+        report_files = {write_shard_report(this_selection, (1, 3), [], {}, report_dir) for this_selection in
+                        [selection, rule_selection, dict(selection, attributes={'min_comments': 2}), dict(selection, sampling={'sample': '5%'})]}
+        with open(write_shard_report(rule_selection, (1, 3), [], {}, report_dir)) as file_handle:
+            reported_selection = json.load(file_handle)['selection']
+        if len(report_files) != 4 or reported_selection['attributes'] != {'document_types': ['Rule']}:
+            print(f"ERROR: Expected each selection's attributes and sampling to get their own report, got {len(report_files)} reports")
+            success = False
+        elif expected_selection_dockets(rule_selection, None) != {rule_docket}:
+            print(f"ERROR: Expected only {rule_docket} to be expected for the final rules, got {expected_selection_dockets(rule_selection, None)}")
+            success = False
+        else:
+            print("✓ Attributes and sampling get their own reports, and only the matching dockets are expected")
+
+        # A machine's slice downloaded text first reports the same dockets
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+            file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+        os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        config_file = os.path.join(work_dir, 'rclone.conf')
+        open(config_file, 'w').close()
+        reports = []
+        for this_index in [1, 2]:
+            dest_dir = os.path.join(work_dir, f"text_first_{this_index}")
+            os.makedirs(dest_dir)
+
+            async def download():
+                handle = await mirrulations_api.download({'agencies': ['CMS']}, {'dest_dir': dest_dir, 'rclone_config_file': config_file,
+                                                                                'shard': f"{this_index}/2", 'text_first': True, 'parallel': 2})
+                return await handle.wait()
+
+            with open(asyncio.run(download())['shard_report']) as file_handle:
+                reports.append(json.load(file_handle))
+        cms_dockets = {this_docket for this_docket in all_dockets if this_docket.startswith('CMS-')}
+        coverage = check_coverage(reports, cms_dockets)
+        if coverage['covered'] != len(cms_dockets) or coverage['missing'] or coverage['misplaced'] or coverage['duplicated']:
+            print(f"ERROR: Expected the text-first slices to cover every CMS docket once, got {coverage}")
+            success = False
+        elif not os.path.exists(os.path.join(work_dir, 'text_first_1', TEXT_COMPLETE_DIR_NAME, 'CMS', sorted(reports[0]['finished_dockets'])[0])):
+            print("ERROR: Expected the dockets of the slice to be marked text complete")
+            success = False
+        else:
+            print("✓ Slices downloaded text first report their dockets and cover the selection")
+
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Partition test PASSED!")
+    else:
+        print(f"\n❌ Partition test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_partition_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Test script to validate retrying only the files that failed to copy. Does not need network access: a stand-in rclone
+on the PATH logs errors for some files the way the real one does.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Fails files in the JSON log by a script per source, one step per call, and remembers every --files-from it was given
+FAKE_RCLONE = """#!{python}
+import os, sys, json
+arguments = sys.argv[1:]
+source = arguments[1]
+log_file = arguments[arguments.index('--log-file') + 1]
+state_dir = os.environ['FAKE_RCLONE_STATE']
+name = source.strip('/').replace('/', '_')
+calls_file = os.path.join(state_dir, name + '.calls')
+calls = int(open(calls_file).read()) + 1 if os.path.exists(calls_file) else 1
+open(calls_file, 'w').write(str(calls))
+if '--files-from' in arguments:
+    with open(arguments[arguments.index('--files-from') + 1]) as file_handle:
+        open(os.path.join(state_dir, name + '.files'), 'a').write(json.dumps([this_line.strip() for this_line in file_handle]) + "\\n")
+
+SLOW_DOWN = "Failed to copy: SlowDown: Please reduce your request rate. status code: 503"
+NO_SUCH_KEY = "Failed to copy: NoSuchKey: The specified key does not exist. status code: 404"
+RESET = "Failed to copy: read tcp 10.0.0.1:443: read: connection reset by peer"
+SCRIPTS = {{
+    'raw-data/CMS/': [{{'CMS-2025-0001/a.json': SLOW_DOWN, 'CMS-2025-0001/b.json': NO_SUCH_KEY}}, {{'CMS-2025-0001/a.json': SLOW_DOWN}}, {{}}],
+    'raw-data/FDA/': [{{'FDA-2025-0001/x.json': RESET}}, {{}}],
+    'derived-data/FDA/': [{{None: "error reading source root directory: directory not found"}}],
+}}
+steps = [this_steps for this_prefix, this_steps in SCRIPTS.items() if source.endswith(this_prefix)]
+errors = steps[0][min(calls, len(steps[0])) - 1] if steps else {{}}
+with open(log_file, 'a') as file_handle:
+    for this_object, message in errors.items():
+        entry = {{'level': 'error', 'msg': message, 'source': 'operations/copy.go:123'}}
+        if this_object:
+            entry.update({{'object': this_object, 'objectType': '*s3.Object'}})
+        file_handle.write(json.dumps(entry) + "\\n")
+    if errors:
+        file_handle.write(json.dumps({{'level': 'error', 'msg': f"Attempt 1/1 failed with {{len(errors)}} errors and: last error"}}) + "\\n")
+    #The first run copies a lot, the retries only a file or two
+    file_handle.write(json.dumps({{'level': 'notice', 'stats': {{'bytes': 1000000 // calls, 'transfers': 100 // calls, 'elapsedTime': 10.0 / calls}}}}) + "\\n")
+sys.exit(1 if errors else 0)
+"""
+
+def run_retry_test():
+    """Run the retry test"""
+    print("=" * 60)
+    print("TESTING: Retry queue for failed files")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_retry_test_")
+    bin_dir = os.path.join(work_dir, 'bin')
+    state_dir = os.path.join(work_dir, 'fake_state')
+    os.makedirs(bin_dir)
+    os.makedirs(state_dir)
+    with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+        file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+    os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+    config_file = os.path.join(work_dir, 'rclone.conf')
+    open(config_file, 'w').close()
+
+    old_environment = dict(os.environ)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_RCLONE_STATE'] = state_dir
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+    os.environ['MIRRULATIONS_REMOTE'] = 's3:bucket/'
+
+    import mirrulations_api
+    import mirrulations_retry
+
+    def read_state(name, kind):
+        path = os.path.join(state_dir, f"{name}.{kind}")
+        if not os.path.exists(path):
+            return None
+        with open(path) as file_handle:
+            return file_handle.read().split("\n")[:-1] if kind == 'files' else int(file_handle.read())
+
+    async def download_and_wait(agency):
+        dest_dir = os.path.join(work_dir, agency)
+        os.makedirs(dest_dir)
+        handle = await mirrulations_api.download({'agencies': [agency]}, {'dest_dir': dest_dir, 'rclone_config_file': config_file, 'retry_failed': True})
+        try:
+            return await handle.wait()
+        except mirrulations_api.ShardsFailedError as error:
+            return error.result
+
+    old_policies = dict(mirrulations_retry.RETRY_POLICIES)
+    for this_class, policy in mirrulations_retry.RETRY_POLICIES.items():
+        if policy['attempts']:
+            mirrulations_retry.RETRY_POLICIES[this_class] = dict(policy, delay=0.05, max_delay=0.1)
+
+    try:
+        # Errors are sorted into classes with their own policies
+        classes = [mirrulations_retry.classify_error(this_message) for this_message in
+                   ["SlowDown: Please reduce your request rate. status code: 503", "NoSuchKey: status code: 404",
+                    "open /data/x.json: no space left on device", "read: connection reset by peer", "something odd"]]
+        if classes != ['throttled', 'not_found', 'local', 'transient', 'other']:
+            print(f"ERROR: Unexpected error classes {classes}")
+            success = False
+        else:
+            print("✓ rclone errors are classified as throttled, not found, local, transient or other")
+
+        # A throttled file is retried until it copies, a missing one is not retried, and only the failed files are copied again
+        result = asyncio.run(download_and_wait('CMS'))
+        statuses = {this_shard['prefix']: this_shard['status'] for this_shard in result['shards']}
+        retried_lists = read_state('s3:bucket_raw-data_CMS', 'files')
+        if result.get('still_failing', {}).keys() != {'raw-data/CMS/CMS-2025-0001/b.json'}:
+            print(f"ERROR: Expected only the missing object to still fail, got {result.get('still_failing')}")
+            success = False
+        elif result['still_failing']['raw-data/CMS/CMS-2025-0001/b.json']['error_class'] != 'not_found' or statuses['raw-data/CMS/'] != 'failed':
+            print(f"ERROR: Expected the missing object to be reported as not found and its shard to fail, got {result}")
+            success = False
+        elif retried_lists != ['["CMS-2025-0001/a.json"]', '["CMS-2025-0001/a.json"]'] or read_state('s3:bucket_raw-data_CMS', 'calls') != 3:
+            print(f"ERROR: Expected two --files-from retries of just the throttled file, got {retried_lists}")
+            success = False
+        else:
+            print("✓ The throttled file was retried twice on its own and the missing one is reported as still failing")
+
+        # The throughput history keeps what the run itself achieved, not what its last retry did
+        with open(os.path.join(work_dir, 'state', 'throughput_history.jsonl')) as file_handle:
+            history = {this_record['job']: this_record for this_record in map(json.loads, file_handle)}
+        if history['raw-data/CMS/']['bytes'] != 1000000 or history['raw-data/CMS/']['elapsed'] != 10.0:
+            print(f"ERROR: Expected the history to hold the first run's stats, got {history['raw-data/CMS/']}")
+            success = False
+        else:
+            print("✓ The throughput history records the run's own stats, not the retries'")
+
+        # A shard whose failed files all copy on retry is finished, an error that is not about a file is not retried
+        result = asyncio.run(download_and_wait('FDA'))
+        statuses = {this_shard['prefix']: this_shard['status'] for this_shard in result['shards']}
+        if statuses != {'raw-data/FDA/': 'finished', 'derived-data/FDA/': 'failed'} or result['still_failing']:
+            print(f"ERROR: Expected the raw-data shard to recover and the derived-data shard to fail, got {statuses}")
+            success = False
+        elif read_state('s3:bucket_derived-data_FDA', 'calls') != 1:
+            print("ERROR: Expected a shard that failed without naming files not to be retried")
+            success = False
+        else:
+            print("✓ A shard recovers when its failed files copy on retry, errors not about files are left alone")
+
+        still_failing_lists = os.listdir(os.path.join(work_dir, 'state', 'retry'))
+        if len([this_name for this_name in still_failing_lists if this_name.endswith('.txt')]) != 1:
+            print(f"ERROR: Expected one still failing list, got {still_failing_lists}")
+            success = False
+        else:
+            print("✓ The files still failing are written as a --files-from list")
+
+    finally:
+        mirrulations_retry.RETRY_POLICIES.update(old_policies)
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Retry test PASSED!")
+    else:
+        print(f"\n❌ Retry test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_retry_test()
+    sys.exit(0 if success else 1)
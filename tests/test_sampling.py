@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Test script to validate sampling the comments of each docket and capping the size of binaries. Does not need network
+access: a synthetic bucket on local disk stands in for the real one, and a stand-in rclone copies the --files-from lists.
+"""
+
+import os
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Copies the files of a --files-from list from the source to the destination, like rclone copy does
+FAKE_RCLONE = """#!{python}
+import os, sys, shutil
+arguments = sys.argv[1:]
+source, destination = arguments[1], arguments[2]
+with open(arguments[arguments.index('--files-from') + 1]) as file_handle:
+    for this_line in file_handle:
+        os.makedirs(os.path.dirname(os.path.join(destination, this_line.strip())), exist_ok=True)
+        shutil.copy2(os.path.join(source, this_line.strip()), os.path.join(destination, this_line.strip()))
+"""
+
+def run_sampling_test():
+    """Run the sampling test"""
+    print("=" * 60)
+    print("TESTING: Comment sampling and size caps")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_sampling_test_")
+    bucket_dir = os.path.join(work_dir, 'bucket')
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'rclone'), 'w') as file_handle:
+        file_handle.write(FAKE_RCLONE.format(python=sys.executable))
+    os.chmod(os.path.join(bin_dir, 'rclone'), 0o755)
+    config_file = os.path.join(work_dir, 'rclone.conf')
+    open(config_file, 'w').close()
+
+    old_environment = dict(os.environ)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['MIRRULATIONS_REMOTE'] = bucket_dir + '/'
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+
+    from mirrulations_synthetic import generate_bucket
+    from mirrulations_config import parse_bucket_path
+    from mirrulations_planning import plan_copy_jobs
+    from mirrulations_sampling import check_sampling, comment_id_of, is_comment_record, sample_jobs
+    import mirrulations_api
+
+    def sample(settings):
+        jobs, summary = sample_jobs(plan_copy_jobs(['CMS'], ['*'], [], ['*']), check_sampling(settings), False)
+        return [this_job['prefix'] + this_file for this_job in jobs for this_file in this_job['files']], summary
+
+    def comments_by_docket(paths):
+        comments = {}
+        for this_path in paths:
+            if is_comment_record(this_path):
+                comments.setdefault(parse_bucket_path(this_path)['docket'], set()).add(comment_id_of(this_path))
+        return comments
+
+    try:
+        generate_bucket(bucket_dir, agencies=2, dockets_per_agency=3, comments_per_docket=20, attachment_rate=0.6, attachment_size=100000)
+
+        # The settings are checked
+        settings = [check_sampling({'sample': '5%'}), check_sampling({'sample': '200', 'max_file_size': '20M'})]
+        if settings[0].get('fraction') != 0.05 or settings[1].get('per_docket') != 200 or settings[1]['max_file_size'] != 20 * 1024 ** 2:
+            print(f"ERROR: Expected 5% to be a fraction and 200 a number per docket, got {settings}")
+            success = False
+        else:
+            for this_settings in [{'sample': 'some'}, {'sample': '0%'}, {'max_docket_size': 'big'}]:
+                try:
+                    check_sampling(this_settings)
+                    print(f"ERROR: Expected {this_settings} to be rejected")
+                    success = False
+                except ValueError:
+                    pass
+            print("✓ Sampling settings are checked")
+
+        # A fixed number of comments per docket, with their derived text but not their attachments
+        paths, summary = sample({'sample': '5'})
+        comments = comments_by_docket(paths)
+        sampled = set().union(*comments.values())
+        derived_comments = {comment_id_of(this_path) for this_path in paths if this_path.startswith('derived-data/')}
+        if sorted(len(this_comments) for this_comments in comments.values()) != [5, 5, 5] or summary['sampled_comments'] != 15:
+            print(f"ERROR: Expected 5 comments in each of the 3 dockets, got {comments}")
+            success = False
+        elif not derived_comments or not derived_comments <= sampled:
+            print("ERROR: Expected the derived text of the sampled comments only")
+            success = False
+        elif any(parse_bucket_path(this_path)['section'] == 'binary' for this_path in paths):
+            print("ERROR: Expected no attachments without 'attachments'")
+            success = False
+        elif len([this_path for this_path in paths if '/docket/' in this_path]) != 3:
+            print("ERROR: Expected every docket's own JSON to be kept")
+            success = False
+        else:
+            print("✓ 5 comments per docket are sampled, with their derived text and without their attachments")
+
+        # The same seed picks the same comments, another seed others
+        if comments_by_docket(sample({'sample': '5'})[0]) != comments or comments_by_docket(sample({'sample': '5', 'seed': 7})[0]) == comments:
+            print("ERROR: Expected the sample to depend on the seed and only on the seed")
+            success = False
+        else:
+            print("✓ The sample is the same for the same seed")
+
+        # A fraction of the comments, with their attachments
+        paths, summary = sample({'sample': '50%', 'attachments': True})
+        sampled = set().union(*comments_by_docket(paths).values())
+        attachments = {comment_id_of(this_path) for this_path in paths if parse_bucket_path(this_path)['section'] == 'binary'}
+        all_attachments = {comment_id_of(this_path) for this_dir, dir_names, file_names in os.walk(os.path.join(bucket_dir, 'raw-data', 'CMS'))
+                           for this_path in [os.path.relpath(os.path.join(this_dir, this_name), bucket_dir) for this_name in file_names]
+                           if parse_bucket_path(this_path)['section'] == 'binary'}
+        if not 15 <= len(sampled) <= 45:
+            print(f"ERROR: Expected about half of the 60 comments, got {len(sampled)}")
+            success = False
+        elif attachments != all_attachments & sampled:
+            print("ERROR: Expected the attachments of exactly the sampled comments")
+            success = False
+        else:
+            print(f"✓ 50% sampled {len(sampled)} of 60 comments, with their attachments")
+
+        # The size caps skip the largest binaries and say which
+        paths, summary = sample({'max_file_size': '150K'})
+        sizes = {this_path: os.path.getsize(os.path.join(bucket_dir, this_path)) for this_path in paths}
+        if not summary['skipped'] or any(sizes[this_path] > 150 * 1024 for this_path in paths if parse_bucket_path(this_path)['section'] == 'binary'):
+            print(f"ERROR: Expected the binaries over 150K to be skipped, got {len(summary['skipped'])} skipped")
+            success = False
+        elif {this_file['reason'] for this_file in summary['skipped'].values()} != {'max_file_size'} or len(comments_by_docket(paths)[sorted(comments)[0]]) != 20:
+            print("ERROR: Expected every comment to be kept with only the size cap")
+            success = False
+        else:
+            print(f"✓ --max-file-size skipped {len(summary['skipped'])} binaries")
+
+        paths, summary = sample({'max_docket_size': '300K'})
+        docket_sizes = {}
+        for this_path in paths:
+            docket_id = parse_bucket_path(this_path)['docket']
+            docket_sizes[docket_id] = docket_sizes.get(docket_id, 0) + os.path.getsize(os.path.join(bucket_dir, this_path))
+        if not summary['skipped'] or max(docket_sizes.values()) > 300 * 1024:
+            print(f"ERROR: Expected every docket to stay under 300K, got {docket_sizes}")
+            success = False
+        else:
+            print(f"✓ --max-docket-size kept every docket under 300K, skipping {len(summary['skipped'])} binaries")
+
+        # A download with sampling copies only the sample and lists what it skipped
+        dest_dir = os.path.join(work_dir, 'dest')
+        os.makedirs(dest_dir)
+
+        async def download():
+            handle = await mirrulations_api.download({'agencies': ['EPA'], 'sampling': {'sample': '3', 'attachments': True, 'max_file_size': '150K'}},
+                                                     {'dest_dir': dest_dir, 'rclone_config_file': config_file})
+            return await handle.wait()
+
+        result = asyncio.run(download())
+        downloaded = [os.path.relpath(os.path.join(this_dir, this_name), dest_dir) for this_dir, dir_names, file_names in os.walk(dest_dir) for this_name in file_names]
+        with open(result['sampling']['skipped_file']) as file_handle:
+            skipped_list = file_handle.read().split()
+        if sorted(len(this_comments) for this_comments in comments_by_docket(downloaded).values()) != [3, 3, 3]:
+            print(f"ERROR: Expected 3 comments of each EPA docket to be downloaded, got {comments_by_docket(downloaded)}")
+            success = False
+        elif skipped_list != sorted(result['sampling']['skipped']) or set(skipped_list) & set(downloaded):
+            print("ERROR: Expected the skipped list to hold what was not downloaded for the size cap")
+            success = False
+        else:
+            print(f"✓ The download copied {len(downloaded)} files of the sample and listed {len(skipped_list)} skipped binaries")
+
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Sampling test PASSED!")
+    else:
+        print(f"\n❌ Sampling test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_sampling_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Test script to validate how a selection is split into shards. Does not need network access.
+"""
+
+import os
+import sys
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mirrulations_planning import build_shards, compile_filter_rules, plan_copy_jobs, split_text_first
+from mirrulations_api import run_commands_in_parallel
+
+def run_shard_planning_test():
+    """Run the shard planning test"""
+    print("=" * 60)
+    print("TESTING: Shard planning, copy planning, filter compiling and parallel execution")
+    print("=" * 60)
+
+    success = True
+
+    # No sharding keeps the old single command behavior
+    shards = build_shards(['CMS', 'FDA'], [2024, 2025], [], 'none')
+    if len(shards) != 1 or shards[0]['agency_list'] != ['CMS', 'FDA']:
+        print(f"ERROR: Expected a single shard, got: {shards}")
+        success = False
+    else:
+        print("✓ No sharding produces one shard")
+
+    shards = build_shards(['CMS', 'FDA'], [2024, 2025], [], 'agency')
+    if [this_shard['name'] for this_shard in shards] != ['CMS', 'FDA']:
+        print(f"ERROR: Expected one shard per agency, got: {shards}")
+        success = False
+    else:
+        print("✓ Agency sharding produces one shard per agency")
+
+    shards = build_shards(['CMS', 'FDA'], [2024, 2025], [], 'agency-year')
+    expected_names = ['CMS-2024', 'CMS-2025', 'FDA-2024', 'FDA-2025']
+    if [this_shard['name'] for this_shard in shards] != expected_names:
+        print(f"ERROR: Expected {expected_names}, got: {shards}")
+        success = False
+    else:
+        print("✓ Agency-year sharding produces one shard per agency and year")
+
+    # Year only selections should not put a '*' in the shard name (it ends up in a log file name)
+    shards = build_shards(['*'], [1995], [], 'agency-year')
+    if shards[0]['name'] != 'all-1995':
+        print(f"ERROR: Expected shard name all-1995, got: {shards[0]['name']}")
+        success = False
+    else:
+        print("✓ Wildcard agency is named 'all' in shard names")
+
+    shards = build_shards(['*'], ['*'], ['CMS-2025-0050', 'CMS-2025-0051'], 'docket')
+    if [this_shard['docket_list'] for this_shard in shards] != [['CMS-2025-0050'], ['CMS-2025-0051']]:
+        print(f"ERROR: Expected one shard per docket, got: {shards}")
+        success = False
+    else:
+        print("✓ Docket sharding produces one shard per docket")
+
+    # A single docket should be copied straight from its own prefixes, with no filtering needed
+    jobs = plan_copy_jobs(['*'], ['*'], ['CMS-2025-0050'], ['*'])
+    if [this_job['prefix'] for this_job in jobs] != ['derived-data/CMS/CMS-2025-0050/', 'raw-data/CMS/CMS-2025-0050/']:
+        print(f"ERROR: Expected the docket prefixes, got: {jobs}")
+        success = False
+    elif any(compile_filter_rules(this_job, textonly=False) for this_job in jobs):
+        print(f"ERROR: Expected no filter rules for a whole docket, got: {jobs}")
+        success = False
+    else:
+        print("✓ Docket selection is rooted at the docket prefixes")
+
+    # An agency and year selection should be rooted at the agency, with the year filter relative to it
+    jobs = plan_copy_jobs(['CMS'], [2025, 2024], [], ['*.json'])
+    if [this_job['prefix'] for this_job in jobs] != ['derived-data/CMS/', 'raw-data/CMS/'] or jobs[0]['years'] != [2024, 2025]:
+        print(f"ERROR: Unexpected jobs for an agency and year selection: {jobs}")
+        success = False
+    else:
+        print("✓ Agency and year selection is rooted at the agency prefixes")
+
+    # A year across all agencies has to start at the top of each data directory
+    jobs = plan_copy_jobs(['*'], [1995], [], ['*'])
+    expected_rules = ['+ /*/*-1995-*/**/*', '- **']
+    if [this_job['prefix'] for this_job in jobs] != ['derived-data/', 'raw-data/'] or compile_filter_rules(jobs[0], textonly=False) != expected_rules:
+        print(f"ERROR: Unexpected jobs for a year across all agencies: {jobs}")
+        success = False
+    else:
+        print("✓ Year selection across all agencies filters at the docket level")
+
+    # However many agencies and years we ask for, each prefix should get the same short list of rules
+    jobs = plan_copy_jobs(['CMS', 'FDA', 'EPA', 'HHS'], list(range(1995, 2026)), [], ['*.txt', '*.json', '*.htm'])
+    raw_cms_rules = compile_filter_rules(jobs[1], textonly=True)
+    year_alternation = "{" + ",".join(str(this_year) for this_year in range(1995, 2026)) + "}"
+    expected_rules = [
+        '- /*/binary-*/**',
+        f"+ /*-{year_alternation}-*/**/*.{{htm,json,txt}}",
+        '- **',
+    ]
+    if jobs[1]['prefix'] != 'raw-data/CMS/' or raw_cms_rules != expected_rules:
+        print(f"ERROR: Expected {expected_rules}, got: {raw_cms_rules}")
+        success = False
+    else:
+        print("✓ Textonly filter for a wide selection compiles to three rules")
+
+    derived_cms_rules = compile_filter_rules(jobs[0], textonly=True)
+    if any('binary-' in this_rule for this_rule in derived_cms_rules):
+        print(f"ERROR: derived-data has no binary directories to prune, got: {derived_cms_rules}")
+        success = False
+    else:
+        print("✓ Binary pruning only applies to raw-data")
+
+    # Text first: every text job runs ahead of every binary job, and derived-data has no binary half
+    jobs = plan_copy_jobs(['CMS', 'FDA'], ['*'], [], ['*'])
+    for this_job in jobs:
+        this_job['name'] = this_job['prefix']
+    phased_jobs = split_text_first(jobs)
+    phases = [(this_job['section'], this_job['prefix']) for this_job in phased_jobs]
+    expected_phases = [('text', 'derived-data/CMS/'), ('text', 'raw-data/CMS/'), ('text', 'derived-data/FDA/'), ('text', 'raw-data/FDA/'),
+                       ('binary', 'raw-data/CMS/'), ('binary', 'raw-data/FDA/')]
+    text_rules = compile_filter_rules(phased_jobs[1], textonly=False)
+    binary_rules = compile_filter_rules(phased_jobs[4], textonly=False)
+    if phases != expected_phases:
+        print(f"ERROR: Expected {expected_phases}, got: {phases}")
+        success = False
+    elif text_rules != ['- /*/binary-*/**', '+ /*/**/*', '- **'] or binary_rules != ['+ /*/binary-*/**', '- **']:
+        print(f"ERROR: Unexpected text-first rules {text_rules} and {binary_rules}")
+        success = False
+    else:
+        print("✓ Text-first splits raw-data into a text phase ahead of a binary phase")
+
+    # Exit codes should be reported in the same order as the commands, whatever order they finish in
+    results = run_commands_in_parallel(["sleep 1; exit 0", "exit 3", "exit 0"], parallel=2)
+    exit_codes = [exit_code for exit_code, elapsed_time in results]
+    if exit_codes != [0, 3, 0]:
+        print(f"ERROR: Expected exit codes [0, 3, 0], got: {exit_codes}")
+        success = False
+    else:
+        print("✓ Parallel runner tracks each command's exit code")
+
+    if success:
+        print(f"\n🎉 Shard planning test PASSED!")
+    else:
+        print(f"\n❌ Shard planning test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_shard_planning_test()
+    sys.exit(0 if success else 1)
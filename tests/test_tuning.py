@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test script to validate reading rclone stats and the --auto-tune concurrency controller. Does not need network access.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mirrulations_tuning import ConcurrencyTuner, read_latest_rclone_stats
+
+def fake_stats(transfers, bytes_per_second, errors=0):
+    """Stats like rclone writes at the end of a 60 second run"""
+    return {'bytes': bytes_per_second * 60, 'speed': bytes_per_second, 'transfers': transfers * 10, 'errors': errors, 'elapsedTime': 60.0}
+
+def run_tuning_test():
+    """Run the tuning test"""
+    print("=" * 60)
+    print("TESTING: rclone stats and auto-tune")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_tuning_test_")
+
+    try:
+        # The latest stats line wins, and other log lines are skipped
+        log_file = os.path.join(work_dir, "rclone.log")
+        with open(log_file, 'w') as file_handle:
+            file_handle.write(json.dumps({'level': 'notice', 'stats': {'bytes': 1}}) + "\n")
+            file_handle.write(json.dumps({'level': 'error', 'msg': 'Failed to copy', 'object': 'a.json'}) + "\n")
+            file_handle.write(json.dumps({'level': 'notice', 'stats': {'bytes': 2}}) + "\n")
+            file_handle.write('{"level": "notice", "stats": {"bytes"')
+        stats = read_latest_rclone_stats(log_file)
+        if stats != {'bytes': 2}:
+            print(f"ERROR: Expected the latest complete stats line, got {stats}")
+            success = False
+        else:
+            print("✓ Latest complete stats line is read from the log")
+
+        messages = []
+        tuner = ConcurrencyTuner(50, log=messages.append)
+
+        # Throughput that keeps improving should keep raising concurrency
+        tuner.record('binary', 50, fake_stats(50, 50000))
+        if tuner.next_transfers('binary') <= 50:
+            print(f"ERROR: Expected concurrency to go up after a good shard, got {tuner.next_transfers('binary')}")
+            success = False
+        else:
+            print("✓ Concurrency goes up while throughput improves")
+
+        # Profiles are tuned separately
+        if tuner.next_transfers('text') != 50:
+            print(f"ERROR: Expected the text profile to be untouched, got {tuner.next_transfers('text')}")
+            success = False
+        else:
+            print("✓ Profiles are tuned separately")
+
+        # No gain from more transfers should turn back towards the best value
+        raised = tuner.next_transfers('binary')
+        tuner.record('binary', raised, fake_stats(raised, 50000))
+        if tuner.next_transfers('binary') >= raised:
+            print(f"ERROR: Expected concurrency to come back down after no improvement, got {tuner.next_transfers('binary')}")
+            success = False
+        else:
+            print("✓ Concurrency turns around when throughput stops improving")
+
+        # Errors always back off
+        current = tuner.next_transfers('binary')
+        tuner.record('binary', current, fake_stats(current, 90000, errors=100))
+        if tuner.next_transfers('binary') != max(4, round(current * 0.5)):
+            print(f"ERROR: Expected concurrency to halve after errors, got {tuner.next_transfers('binary')}")
+            success = False
+        else:
+            print("✓ Concurrency backs off when errors show up")
+
+        if len(messages) != 3:
+            print(f"ERROR: Expected every decision to be logged, got {messages}")
+            success = False
+        else:
+            print("✓ Every decision is logged")
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Tuning test PASSED!")
+    else:
+        print(f"\n❌ Tuning test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_tuning_test()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Test script to validate integrity verification against the bucket listing and the --files-from repair run.
+Does not need network access, a local directory stands in for the bucket.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+# Add parent directory to path so we can import the main script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file_handle:
+        file_handle.write(data)
+
+def run_verify_test():
+    """Run the verify test"""
+    print("=" * 60)
+    print("TESTING: Integrity verification and repair list")
+    print("=" * 60)
+
+    success = True
+    work_dir = tempfile.mkdtemp(prefix="mirrulations_verify_test_")
+    remote_dir = os.path.join(work_dir, 'bucket')
+    dest_dir = os.path.join(work_dir, 'dest')
+    os.environ['MIRRULATIONS_REMOTE'] = remote_dir
+    os.environ['MIRRULATIONS_STATE_PATH'] = os.path.join(work_dir, 'state')
+    os.environ.pop('MIRRULATIONS_ARCHIVE_PATH', None)
+    report_dir = os.path.join(work_dir, 'report')
+
+    import mirrulations_archive
+    from mirrulations_planning import plan_copy_jobs, plan_files_from_jobs, build_rclone_command
+    from mirrulations_verify import verify_jobs
+
+    def read_list(kind):
+        with open(os.path.join(report_dir, f"{kind}.txt")) as file_handle:
+            return sorted(this_line.strip() for this_line in file_handle)
+
+    try:
+        bucket_files = {
+            'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json': b'{"id": 2}',
+            'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0003.json': b'{"id": 3}',
+            'raw-data/CMS/CMS-2025-0050/binary-CMS-2025-0050/comments_attachments/CMS-2025-0050-0002_attachment_1.pdf': b'%PDF',
+            'derived-data/CMS/CMS-2025-0050/mirrulations/extracted_txt/CMS-2025-0050-0002_attachment_1.txt': b'text',
+            'raw-data/CMS/CMS-2025-0060/text-CMS-2025-0060/comments/CMS-2025-0060-0002.json': b'{"id": 2}',
+            'raw-data/CMS/CMS-2025-0060/binary-CMS-2025-0060/comments_attachments/CMS-2025-0060-0002_attachment_1.pdf': b'%PDF',
+        }
+        for this_path, data in bucket_files.items():
+            write_file(os.path.join(remote_dir, this_path), data)
+            write_file(os.path.join(dest_dir, this_path), data)
+
+        corrupt_path = 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json'
+        missing_path = 'derived-data/CMS/CMS-2025-0050/mirrulations/extracted_txt/CMS-2025-0050-0002_attachment_1.txt'
+        extra_path = 'raw-data/CMS/CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0009.json'
+        write_file(os.path.join(dest_dir, corrupt_path), b'{"id": 7}')
+        os.remove(os.path.join(dest_dir, missing_path))
+        write_file(os.path.join(dest_dir, extra_path), b'{}')
+        #rclone is still copying this one
+        write_file(os.path.join(dest_dir, extra_path + mirrulations_archive.PARTIAL_SUFFIX), b'{')
+
+        # A packed docket is checked against its archive, where one member has the right size but the wrong content
+        packed_pdf = 'raw-data/CMS/CMS-2025-0060/binary-CMS-2025-0060/comments_attachments/CMS-2025-0060-0002_attachment_1.pdf'
+        archive_dir = mirrulations_archive.get_archive_dir(dest_dir)
+        mirrulations_archive.pack_prefix(dest_dir, archive_dir, 'raw-data/CMS/CMS-2025-0060/')
+        with mirrulations_archive.DocketArchive(mirrulations_archive.archive_path(archive_dir, 'CMS', 'CMS-2025-0060')) as archive:
+            archive.write(packed_pdf, b'%PDX', 0)
+            archive.commit()
+
+        jobs = plan_copy_jobs(['CMS'], ['*'], [], ['*'])
+        cache_path = os.path.join(work_dir, 'hash_cache.sqlite')
+        report = verify_jobs(dest_dir, jobs, None, cache_path=cache_path, report_dir=report_dir)
+        if read_list('missing') != [missing_path] or read_list('corrupt') != sorted([corrupt_path, packed_pdf]) or read_list('extra') != [extra_path]:
+            print(f"ERROR: Unexpected report {report}, {read_list('missing')}, {read_list('corrupt')}, {read_list('extra')}")
+            success = False
+        elif (report['missing'], report['corrupt'], report['extra'], report['checked'], report['packed']) != (1, 2, 1, 5, 2):
+            print(f"ERROR: Unexpected counts {report}")
+            success = False
+        else:
+            print("✓ Missing, corrupt (same size, different MD5) and extra files are written to the report files")
+            print("✓ Packed dockets are checked against their archive, and .partial files are left out")
+
+        textonly_jobs = plan_copy_jobs(['CMS'], ['*'], [], ['*.txt', '*.json', '*.htm'])
+        os.remove(os.path.join(dest_dir, 'raw-data/CMS/CMS-2025-0050/binary-CMS-2025-0050/comments_attachments/CMS-2025-0050-0002_attachment_1.pdf'))
+        report = verify_jobs(dest_dir, textonly_jobs, None, textonly=True, cache_path=cache_path, report_dir=report_dir)
+        if read_list('missing') != [missing_path] or read_list('corrupt') != [corrupt_path]:
+            print(f"ERROR: Expected a text only check to ignore the missing and corrupt binaries, got {report}")
+            success = False
+        else:
+            print("✓ A text only check ignores binaries")
+
+        with open(report['repair_file']) as file_handle:
+            repair_jobs = plan_files_from_jobs([this_line.strip() for this_line in file_handle])
+        command = build_rclone_command(repair_jobs[0], dest_dir, 'rclone.conf', '') if repair_jobs else ''
+        if [this_job['prefix'] for this_job in repair_jobs] != ['derived-data/CMS/', 'raw-data/CMS/'] or '--ignore-times' not in command:
+            print(f"ERROR: Unexpected repair jobs {repair_jobs}")
+            success = False
+        elif repair_jobs[1]['files'] != ['CMS-2025-0050/text-CMS-2025-0050/comments/CMS-2025-0050-0002.json']:
+            print(f"ERROR: Expected the repair job to list the corrupt file relative to its prefix, got {repair_jobs[1]['files']}")
+            success = False
+        else:
+            print("✓ The repair list turns into --files-from jobs that recopy every listed file")
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    if success:
+        print(f"\n🎉 Verify test PASSED!")
+    else:
+        print(f"\n❌ Verify test FAILED!")
+
+    return success
+
+if __name__ == "__main__":
+    success = run_verify_test()
+    sys.exit(0 if success else 1)